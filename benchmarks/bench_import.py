@@ -0,0 +1,59 @@
+"""
+Measures the start-up cost of the command line entry points.
+
+Usage:
+    python -m benchmarks.bench_import [--runs 10]
+
+Every command runs in a fresh interpreter, like a cron job. The "filter, nothing to send" row is a
+complete filter run over an empty database: it should cost little more than the interpreter itself,
+because the Google client libraries, the credentials and the YAML parser are never loaded. The last
+row shows what importing those libraries up front costs every run.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from src.email_store import EmailStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wall_milliseconds(command, runs):
+    """Returns the median wall time of a command in milliseconds."""
+    environment = dict(os.environ, PYTHONPATH=ROOT)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, env=environment, check=True, stdout=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "email_db.db")
+        EmailStore(db_path).create_schema()
+        commands = [
+            ("interpreter", [sys.executable, "-c", "pass"]),
+            ("python -m src --help", [sys.executable, "-m", "src", "--help"]),
+            ("import src.email_filter", [sys.executable, "-c", "import src.email_filter"]),
+            ("import src.email_fetcher", [sys.executable, "-c", "import src.email_fetcher"]),
+            ("filter, nothing to send", [sys.executable, "-m", "src", "filter", "--db-path", db_path]),
+            ("eager client libraries", [sys.executable, "-c", "import googleapiclient.discovery, "
+                                        "google.auth.transport.requests, google_auth_httplib2, yaml"]),
+        ]
+        print(f"{'command':<28} {'median ms':>10}")
+        for name, command in commands:
+            print(f"{name:<28} {wall_milliseconds(command, args.runs):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Measures the per-message cost of rule matching as the rule set grows.
+
+Usage:
+    python -m benchmarks.bench_rule_index [--messages 2000]
+
+The indexed column should stay flat as the number of sender / subject blocklist rules grows,
+while the rule-by-rule column grows linearly.
+"""
+import argparse
+import random
+import string
+import time
+
+from src.rule_engine import RuleSet
+
+FIELD_REFERENCES = {"From": "from_id", "Subject": "subject"}
+RULE_COUNTS = (3, 30, 300, 3000)
+
+
+def random_word(generator, length=8):
+    return "".join(generator.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def blocklist_rules(generator, count):
+    """Builds sender and subject blocklist rules like the ones in rules.json."""
+    rules = {}
+    for number in range(count):
+        field_name = "From" if number % 2 else "Subject"
+        rules[f"rule_{number}"] = {
+            "predicates": "Any",
+            "criteria": [{"field_name": field_name, "predicate": "Contains", "value": random_word(generator)},
+                         {"field_name": "From", "predicate": "Equals", "value": f"{random_word(generator)}@spam.com"}],
+            "action": [{"addLabelIds": ["SPAM"], "removeLabelIds": []}]
+        }
+    return rules
+
+
+def synthetic_emails(generator, count):
+    return [{
+        "message_id": str(number),
+        "from_id": f"{random_word(generator)}@{random_word(generator, 6)}.com",
+        "subject": " ".join(random_word(generator, generator.randint(3, 9)) for _ in range(8)),
+    } for number in range(count)]
+
+
+def per_message_microseconds(match, emails):
+    start = time.perf_counter()
+    for email in emails:
+        match(email)
+    return (time.perf_counter() - start) / len(emails) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    generator = random.Random(42)
+    emails = synthetic_emails(generator, args.messages)
+
+    print(f"{'rules':>8} {'indexed us/msg':>16} {'rule-by-rule us/msg':>20}")
+    for count in RULE_COUNTS:
+        rule_set = RuleSet(blocklist_rules(generator, count), FIELD_REFERENCES)
+        indexed = per_message_microseconds(rule_set.match, emails)
+        naive = per_message_microseconds(lambda email: [rule for rule in rule_set.rules if rule.matches(email)],
+                                         emails)
+        print(f"{count:>8} {indexed:>16.1f} {naive:>20.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Measures end to end throughput against the local Gmail stand-in.
+
+Usage:
+    python -m benchmarks.bench_throughput [--messages 10000] [--latency 0.005] [--error-rate 0.01]
+
+Reports messages/sec for fetching the inbox into SQLite, evaluating the rules and applying the
+resulting labels, and the peak RSS of the process after each stage. The fake server runs in a
+child process, so its memory is not counted. Runs offline; no Gmail account is needed.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+
+from google.oauth2.credentials import Credentials
+
+from benchmarks.fake_gmail_server import SENDERS, SUBJECT_WORDS, FakeGmailServer, FakeMailbox
+from src.action_planner import ActionPlanner
+from src.api_executor import ApiExecutor
+from src.email_fetcher import EmailFetcher
+from src.email_filter import EmailFilter
+from src.gmail_client import get_gmail_service
+
+
+def serve(connection, messages, latency, error_rate):
+    server = FakeGmailServer(FakeMailbox(messages), latency=latency, error_rate=error_rate)
+    connection.send(server.url)
+    server.serve_forever()
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def benchmark_rules(count, seed=0):
+    """Builds rules on the fields and values the fake mailbox generates, like the ones in rules.json."""
+    generator = random.Random(seed)
+    rules = {}
+    for number in range(count):
+        if number % 2:
+            criterion = {"field_name": "From", "predicate": "Contains", "value": generator.choice(SENDERS)}
+        else:
+            criterion = {"field_name": "Subject", "predicate": "Contains", "value": generator.choice(SUBJECT_WORDS)}
+        rules[f"rule_{number}"] = {
+            "predicates": "Any",
+            "criteria": [criterion, {"field_name": "From", "predicate": "Equals", "value": f"blocked{number}@spam.com"}],
+            "action": [{"addLabelIds": [f"Label_{number % 5}"], "removeLabelIds": ["UNREAD"]}]
+        }
+    return rules
+
+
+def report(stage, messages, elapsed):
+    rate = messages / elapsed if elapsed else float("inf")
+    print(f"{stage:<12} {messages:>10} {elapsed:>10.2f} {rate:>14.0f} {peak_rss_mb():>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--rules", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every HTTP request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--units-per-second", type=float, default=1_000_000,
+                        help="quota throttle; pass 250 to measure at the real Gmail per-user limit")
+    parser.add_argument("--metadata-first", action="store_true")
+    args = parser.parse_args()
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child, args.messages, args.latency, args.error_rate),
+                                     daemon=True)
+    server.start()
+    api_endpoint = parent.recv()
+    # The fake server ignores the token, and a token without expiry is never refreshed.
+    credentials = Credentials(token="benchmark")
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "email_db.db")
+        rules_file = os.path.join(directory, "rules.json")
+        with open(rules_file, "w") as file:
+            json.dump(benchmark_rules(args.rules), file)
+
+        print(f"{'stage':<12} {'messages':>10} {'seconds':>10} {'messages/sec':>14} {'peak RSS MB':>14}")
+
+        fetcher = EmailFetcher(max_workers=args.workers, credentials=credentials, db_path=db_path,
+                               api_endpoint=api_endpoint, units_per_second=args.units_per_second)
+        fetcher.rules_file = rules_file
+        start = time.perf_counter()
+        fetcher.sync_emails(page_size=args.page_size, batch_size=args.batch_size,
+                            metadata_first=args.metadata_first)
+        elapsed = time.perf_counter() - start
+        with sqlite3.connect(db_path) as connection:
+            stored = connection.execute("SELECT COUNT(*) FROM inbox").fetchone()[0]
+        report("fetch", stored, elapsed)
+
+        email_filter = EmailFilter(max_workers=args.workers, credentials=credentials, db_path=db_path,
+                                   rules_file=rules_file, api_endpoint=api_endpoint,
+                                   units_per_second=args.units_per_second)
+        planner = ActionPlanner()
+        start = time.perf_counter()
+        email_filter.match_emails_indexed(planner)
+        report("rules", stored, time.perf_counter() - start)
+
+        service = get_gmail_service(credentials, api_endpoint)
+        start = time.perf_counter()
+        with ApiExecutor(credentials=credentials, max_workers=args.workers,
+                         units_per_second=args.units_per_second) as executor:
+            failed = planner.execute(service, executor)
+        changed = sum(len(message_ids) for message_ids in planner.group().values())
+        report("labels", changed - len(failed), time.perf_counter() - start)
+
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""
+A local stand-in for the Gmail API, serving a synthetic mailbox for benchmarks.
+
+Usage:
+    python -m benchmarks.fake_gmail_server [--messages 10000] [--port 8080] [--latency 0.005]
+
+Implements the calls the fetcher and filter make: getProfile, messages.list, messages.get (raw,
+metadata and full), messages.modify, messages.batchModify, history.list and batch requests.
+Messages are generated from their index on demand, so mailboxes of a million messages cost no
+more memory than small ones; only label changes are stored.
+"""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+from email.parser import BytesParser
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SENDERS = ["alerts@bank.com", "newsletter@shop.com", "noreply@github.com", "team@happyfox.com",
+           "billing@cloud.com", "friend@gmail.com", "promo@deals.com", "hr@company.com"]
+SUBJECT_WORDS = ["invoice", "meeting", "report", "weekly", "update", "offer", "security", "alert",
+                 "interview", "release", "payment", "reminder", "newsletter", "project", "review"]
+BODY_WORDS = SUBJECT_WORDS + ["please", "find", "attached", "the", "details", "regards", "thanks", "team"]
+# The timestamp of the oldest synthetic message.
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+# The oldest history record kept, relative to the current historyId; older checkpoints get a 404.
+HISTORY_RETENTION = 100_000
+# Maps the historyTypes filter values to the keys of the history records.
+HISTORY_TYPE_KEYS = {"messageAdded": "messagesAdded", "messageDeleted": "messagesDeleted",
+                     "labelAdded": "labelsAdded", "labelRemoved": "labelsRemoved"}
+
+
+class FakeMailbox:
+    def __init__(self, size, body_size=2000, seed=0):
+        """
+        Initializes a synthetic mailbox whose messages are derived from their index.
+
+        Args:
+            size (int): The number of messages in the mailbox.
+            body_size (int): The approximate length of each body in characters.
+            seed (int): Varies the generated headers and bodies.
+        """
+        self.size = size
+        self.body_size = body_size
+        self.seed = seed
+        self.history_id = 1000
+        self.history = []
+        self.labels = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def message_id(index):
+        return f"{index:016x}"
+
+    def index(self, message_id):
+        """
+        Returns the index of a message ID, or None if the mailbox has no such message.
+        """
+        try:
+            index = int(message_id, 16)
+        except ValueError:
+            return None
+        return index if 0 <= index < self.size else None
+
+    def label_ids(self, index):
+        labels = self.labels.get(index)
+        if labels is None:
+            labels = {"INBOX", "UNREAD"} if index % 3 else {"INBOX"}
+        return sorted(labels)
+
+    def headers(self, index):
+        generator = random.Random(self.seed * 1_000_003 + index)
+        sender = generator.choice(SENDERS) if index % 2 else f"user{index % 997}@example.com"
+        subject = " ".join(generator.choice(SUBJECT_WORDS) for _ in range(generator.randint(3, 7)))
+        return [
+            {"name": "From", "value": sender},
+            {"name": "To", "value": "me@example.com"},
+            {"name": "Subject", "value": subject.capitalize()},
+            {"name": "Date", "value": format_datetime(EPOCH + timedelta(minutes=index))},
+            {"name": "Content-Type", "value": 'text/plain; charset="UTF-8"'},
+        ]
+
+    def body(self, index):
+        generator = random.Random(self.seed * 7_000_003 + index)
+        words = []
+        length = 0
+        while length < self.body_size:
+            word = generator.choice(BODY_WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return " ".join(words)
+
+    def resource(self, index, format="full", metadata_headers=None):
+        """
+        Builds the message resource of a message in the given format.
+        """
+        headers = self.headers(index)
+        resource = {
+            "id": self.message_id(index),
+            "threadId": self.message_id(index),
+            "labelIds": self.label_ids(index),
+            "historyId": str(self.history_id),
+            "internalDate": str(int((EPOCH + timedelta(minutes=index)).timestamp() * 1000)),
+            "snippet": self.body(index)[:100],
+        }
+        if format == "minimal":
+            return resource
+        if format == "raw":
+            lines = [f"{header['name']}: {header['value']}" for header in headers]
+            raw = "\r\n".join(lines) + "\r\n\r\n" + self.body(index)
+            resource["raw"] = base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+            return resource
+        if format == "metadata":
+            if metadata_headers:
+                wanted = {name.lower() for name in metadata_headers}
+                headers = [header for header in headers if header["name"].lower() in wanted]
+            resource["payload"] = {"mimeType": "text/plain", "headers": headers}
+            return resource
+        body = base64.urlsafe_b64encode(self.body(index).encode("utf-8")).decode("ascii")
+        resource["payload"] = {"mimeType": "text/plain", "headers": headers,
+                               "body": {"size": len(body), "data": body}}
+        return resource
+
+    def list(self, label_ids=None, max_results=100, page_token=None):
+        """
+        Lists message IDs newest first, following the page token of the previous page.
+        """
+        max_results = max(1, min(int(max_results), 500))
+        position = int(page_token) if page_token else self.size - 1
+        wanted = set(label_ids or [])
+        messages = []
+        with self.lock:
+            while position >= 0 and len(messages) < max_results:
+                if not wanted or wanted.issubset(self.label_ids(position)):
+                    messages.append({"id": self.message_id(position), "threadId": self.message_id(position)})
+                position -= 1
+        response = {"messages": messages, "resultSizeEstimate": len(messages)}
+        if position >= 0:
+            response["nextPageToken"] = str(position)
+        return response
+
+    def deliver(self, count):
+        """
+        Adds new inbox messages to the mailbox and records them in the history.
+
+        Args:
+            count (int): The number of messages to add.
+
+        Returns:
+            list: The IDs of the new messages.
+        """
+        with self.lock:
+            start, self.size = self.size, self.size + count
+            message_ids = [self.message_id(index) for index in range(start, self.size)]
+            for message_id in message_ids:
+                self.history_id += 1
+                self.history.append({"id": str(self.history_id), "messagesAdded": [
+                    {"message": {"id": message_id, "threadId": message_id, "labelIds": ["INBOX", "UNREAD"]}}]})
+            return message_ids
+
+    def modify(self, message_ids, add_label_ids=(), remove_label_ids=()):
+        """
+        Changes the labels of messages and records the changes in the history.
+
+        Returns:
+            list: The IDs of the messages that exist.
+        """
+        modified = []
+        with self.lock:
+            for message_id in message_ids:
+                index = self.index(message_id)
+                if index is None:
+                    continue
+                labels = set(self.label_ids(index))
+                labels.update(add_label_ids)
+                labels.difference_update(remove_label_ids)
+                self.labels[index] = labels
+                self.history_id += 1
+                record = {"id": str(self.history_id)}
+                if add_label_ids:
+                    record["labelsAdded"] = [{"message": {"id": message_id}, "labelIds": list(add_label_ids)}]
+                if remove_label_ids:
+                    record["labelsRemoved"] = [{"message": {"id": message_id}, "labelIds": list(remove_label_ids)}]
+                self.history.append(record)
+                modified.append(message_id)
+            del self.history[:-HISTORY_RETENTION]
+        return modified
+
+    def history_since(self, start_history_id, history_types=None, max_results=100, page_token=None):
+        """
+        Lists the history records after the given historyId.
+
+        Returns:
+            dict: The history.list response, or None if the historyId is too old to be served.
+        """
+        max_results = max(1, min(int(max_results), 500))
+        start = int(page_token or start_history_id)
+        with self.lock:
+            oldest = int(self.history[0]["id"]) - 1 if self.history else self.history_id
+            if start < oldest:
+                return None
+            records = [record for record in self.history if int(record["id"]) > start]
+            current = self.history_id
+        if history_types:
+            keys = [HISTORY_TYPE_KEYS[history_type] for history_type in history_types]
+            records = [record for record in records if any(record.get(key) for key in keys)]
+        response = {"history": records[:max_results], "historyId": str(current)}
+        if len(records) > max_results:
+            response["nextPageToken"] = records[max_results - 1]["id"]
+        return response
+
+
+def error_body(status, reason, message):
+    return {"error": {"code": status, "message": message, "errors": [{"reason": reason, "message": message}]}}
+
+
+class FakeGmailServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, mailbox, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, seed=0):
+        """
+        Initializes the server; call serve_forever, or start, to handle requests.
+
+        Args:
+            mailbox (FakeMailbox): The mailbox served.
+            host (str): The interface to listen on.
+            port (int): The port to listen on, 0 picks a free one.
+            latency (float): Seconds every HTTP request is delayed by.
+            error_rate (float): The fraction of calls, batch items included, answered with a 429
+                rateLimitExceeded error.
+            seed (int): Seeds the choice of the failing calls.
+        """
+        super().__init__((host, port), FakeGmailHandler)
+        self.mailbox = mailbox
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.calls = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        """
+        Serves requests on a daemon thread.
+
+        Returns:
+            threading.Thread: The serving thread.
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def throttled(self):
+        with self.random_lock:
+            self.calls += 1
+            return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    def dispatch(self, method, path, query, body):
+        """
+        Answers a single Gmail API call.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The URL path, e.g. /gmail/v1/users/me/messages.
+            query (dict): The parsed query string, as returned by parse_qs.
+            body (bytes): The request body.
+
+        Returns:
+            tuple: The HTTP status and the JSON response.
+        """
+        if self.throttled():
+            return 429, error_body(429, "rateLimitExceeded", "Rate Limit Exceeded")
+
+        parts = path.strip("/").split("/")
+        if parts[:3] != ["gmail", "v1", "users"] or len(parts) < 5:
+            return 404, error_body(404, "notFound", "Not Found")
+        resource = parts[4:]
+        mailbox = self.mailbox
+
+        def first(name, default=None):
+            return query.get(name, [default])[0]
+
+        if method == "GET" and resource == ["profile"]:
+            return 200, {"emailAddress": "me@example.com", "messagesTotal": mailbox.size,
+                         "historyId": str(mailbox.history_id)}
+        if method == "GET" and resource == ["messages"]:
+            return 200, mailbox.list(query.get("labelIds"), first("maxResults", 100), first("pageToken"))
+        if method == "POST" and resource == ["messages", "batchModify"]:
+            request = json.loads(body or b"{}")
+            mailbox.modify(request.get("ids", []), request.get("addLabelIds", []),
+                           request.get("removeLabelIds", []))
+            return 204, None
+        if len(resource) >= 2 and resource[0] == "messages":
+            index = mailbox.index(resource[1])
+            if index is None:
+                return 404, error_body(404, "notFound", "Requested entity was not found.")
+            if method == "GET" and len(resource) == 2:
+                return 200, mailbox.resource(index, first("format", "full"), query.get("metadataHeaders"))
+            if method == "POST" and resource[2:] == ["modify"]:
+                request = json.loads(body or b"{}")
+                mailbox.modify([resource[1]], request.get("addLabelIds", []), request.get("removeLabelIds", []))
+                return 200, mailbox.resource(index, "minimal")
+        if method == "GET" and resource == ["history"]:
+            response = mailbox.history_since(first("startHistoryId", 0), query.get("historyTypes"),
+                                             first("maxResults", 100), first("pageToken"))
+            if response is None:
+                return 404, error_body(404, "notFound", "Requested entity was not found.")
+            return 200, response
+        return 404, error_body(404, "notFound", "Not Found")
+
+    def dispatch_batch(self, content_type, body):
+        """
+        Answers a multipart/mixed batch request by dispatching each of its parts.
+
+        Returns:
+            tuple: The multipart response body and its boundary.
+        """
+        parsed = BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        boundary = f"batch_{threading.get_ident()}_{time.monotonic_ns()}"
+        chunks = []
+        for part in parsed.get_payload():
+            payload = part.get_payload(decode=False)
+            head, _, item_body = payload.replace("\r\n", "\n").partition("\n\n")
+            request_line = head.split("\n", 1)[0]
+            method, target = request_line.split(" ")[:2]
+            url = urlparse(target)
+            status, response = self.dispatch(method, url.path, parse_qs(url.query), item_body.encode())
+            content = "" if response is None else json.dumps(response)
+            content_id = part.get("Content-ID", "<>")
+            chunks.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id[1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\n"
+                f"Content-Type: application/json; charset=UTF-8\r\nContent-Length: {len(content)}\r\n\r\n"
+                f"{content}\r\n")
+        chunks.append(f"--{boundary}--\r\n")
+        return "".join(chunks).encode("utf-8"), boundary
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    # Keeps connections alive like the real API, so pooled transports are exercised.
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, content, content_type="application/json; charset=UTF-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _handle(self, method):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        url = urlparse(self.path)
+        if method == "POST" and url.path.rstrip("/") in ("/batch", "/batch/gmail/v1"):
+            content, boundary = self.server.dispatch_batch(self.headers.get("Content-Type", ""), body)
+            self._respond(200, content, f"multipart/mixed; boundary={boundary}")
+            return
+
+        status, response = self.server.dispatch(method, url.path, parse_qs(url.query), body)
+        self._respond(status, b"" if response is None else json.dumps(response).encode("utf-8"))
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every HTTP request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    args = parser.parse_args()
+
+    server = FakeGmailServer(FakeMailbox(args.messages), args.host, args.port, args.latency, args.error_rate)
+    print(f"Serving {args.messages} messages on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import argparse
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.api_executor import USER_UNITS_PER_SECOND
+from src.email_fetcher import EmailFetcher
+from src.email_store import EmailStore
+from src.oauth_token_manager import OAuthTokenManager
+
+# Gmail allows a project 1,200,000 quota units per minute across all of its users.
+PROJECT_UNITS_PER_SECOND = 20_000
+
+
+class Account:
+    def __init__(self, name, directory):
+        """
+        Initializes a mailbox whose token, database and optional rules live in their own directory.
+
+        Args:
+            name (str): The account name, also the name of its directory.
+            directory (str): The account directory holding token.json, email_db.db and rules.json.
+        """
+        self.name = name
+        self.directory = directory
+        self.token_file = os.path.join(directory, "token.json")
+        self.db_path = os.path.join(directory, "email_db.db")
+        self.rules_file = os.path.join(directory, "rules.json")
+        self.metrics_dir = os.path.join(directory, "metrics")
+
+    def __repr__(self):
+        return f"Account({self.name!r})"
+
+    def last_synced_at(self):
+        """
+        Reads when the account was last synced.
+
+        Returns:
+            float: The Unix time of the last sync, or 0 if the account has never been synced.
+        """
+        if not os.path.exists(self.db_path):
+            return 0.0
+        try:
+            return float(EmailStore(self.db_path).get_state("last_synced_at") or 0)
+        except (sqlite3.Error, ValueError):
+            return 0.0
+
+
+def discover_accounts(accounts_dir):
+    """
+    Finds the accounts below a directory; every subdirectory with a token.json is one mailbox.
+
+    Args:
+        accounts_dir (str): The directory holding one subdirectory per account.
+
+    Returns:
+        list: The Account objects, sorted by name.
+    """
+    accounts = []
+    for name in sorted(os.listdir(accounts_dir)):
+        directory = os.path.join(accounts_dir, name)
+        if os.path.isfile(os.path.join(directory, "token.json")):
+            accounts.append(Account(name, directory))
+    return accounts
+
+
+def sync_account(account, units_per_second, apply_rules=True, batch_size=None, metadata_first=False,
+                 api_endpoint=None, max_workers=8):
+    """
+    Syncs one mailbox; runs in a worker process of the scheduler.
+
+    Args:
+        account (Account): The mailbox to sync.
+        units_per_second (float): The quota budget of the account.
+        apply_rules (bool): Applies the rules to the new messages in the same run.
+        batch_size (int): When set, messages are retrieved through Gmail batch requests.
+        metadata_first (bool): Downloads the full message only for emails a "Message" rule could match.
+        api_endpoint (str): Overrides the root URL of the Gmail API.
+        max_workers (int): The maximum number of concurrent API calls for the account.
+
+    Returns:
+        tuple: The account name, the number of messages stored and the seconds the sync took.
+
+    Raises:
+        RuntimeError: If the sync failed or left messages for a retry; last_synced_at is then kept,
+            so the account goes first in the next round.
+    """
+    start = time.monotonic()
+    credentials = OAuthTokenManager(account.token_file).get_valid_credentials()
+    # The accounts already sync one per process, so each parses its pages without a pool of its own.
+    fetcher = EmailFetcher(max_workers=max_workers, credentials=credentials, db_path=account.db_path,
+                           api_endpoint=api_endpoint, units_per_second=units_per_second,
+                           metrics_dir=account.metrics_dir, parse_processes=1)
+    if os.path.exists(account.rules_file):
+        fetcher.rules_file = account.rules_file
+    if not fetcher.sync_emails(batch_size=batch_size, apply_rules=apply_rules, metadata_first=metadata_first):
+        raise RuntimeError("The sync failed or left emails for a retry")
+    fetcher.store.set_state("last_synced_at", time.time())
+    stored = fetcher.metrics.value("gmail_stage_items_total", stage="db_write")
+    return account.name, stored, time.monotonic() - start
+
+
+class AccountScheduler:
+    def __init__(self, accounts_dir, processes=None, project_units_per_second=PROJECT_UNITS_PER_SECOND,
+                 apply_rules=True, batch_size=None, metadata_first=False, api_endpoint=None):
+        """
+        Initializes a scheduler that spreads the sync of many mailboxes over a process pool.
+
+        Args:
+            accounts_dir (str): The directory holding one subdirectory per account.
+            processes (int): The number of worker processes, defaults to the number of CPUs.
+            project_units_per_second (float): The quota of the whole project, shared by the accounts
+                that sync at the same time.
+            apply_rules (bool): Applies the rules to the new messages of every account.
+            batch_size (int): When set, messages are retrieved through Gmail batch requests.
+            metadata_first (bool): Downloads the full message only for emails a "Message" rule could match.
+            api_endpoint (str): Overrides the root URL of the Gmail API.
+        """
+        self.accounts_dir = accounts_dir
+        self.processes = processes or os.cpu_count() or 1
+        self.project_units_per_second = project_units_per_second
+        self.apply_rules = apply_rules
+        self.batch_size = batch_size
+        self.metadata_first = metadata_first
+        self.api_endpoint = api_endpoint
+
+    @property
+    def units_per_account(self):
+        """
+        The quota budget of one account: the Gmail per-user limit, or its share of the project quota
+        when that is smaller.
+        """
+        return min(USER_UNITS_PER_SECOND, self.project_units_per_second / self.processes)
+
+    @staticmethod
+    def fair_order(accounts):
+        """
+        Orders accounts by the time of their last sync, never synced accounts first, so a round
+        that is cut short does not starve the same mailboxes every time.
+
+        Args:
+            accounts (list): The Account objects.
+
+        Returns:
+            list: The accounts in the order they should be synced.
+        """
+        return sorted(accounts, key=lambda account: (account.last_synced_at(), account.name))
+
+    def run_round(self, accounts=None):
+        """
+        Syncs every account once, each in a worker process.
+
+        A failing account is logged as failed, left out of the results and does not affect the others.
+
+        Args:
+            accounts (list): The accounts to sync, defaults to every account in the accounts directory.
+
+        Returns:
+            dict: Maps the name of every synced account to the number of messages stored.
+        """
+        accounts = self.fair_order(accounts if accounts is not None else discover_accounts(self.accounts_dir))
+        results = {}
+        with ProcessPoolExecutor(max_workers=min(self.processes, max(1, len(accounts)))) as pool:
+            futures = {pool.submit(sync_account, account, self.units_per_account, self.apply_rules,
+                                   self.batch_size, self.metadata_first, self.api_endpoint): account
+                       for account in accounts}
+            for future in as_completed(futures):
+                account = futures[future]
+                try:
+                    name, stored, seconds = future.result()
+                    results[name] = stored
+                    logging.info(f"Synced {stored} emails of account '{name}' in {seconds:.1f}s")
+                except Exception as error:
+                    logging.error(f"Error syncing account '{account.name}': {error}")
+        return results
+
+    def run_forever(self, interval):
+        """
+        Runs a round, then waits until interval seconds have passed since it started, and repeats.
+
+        Args:
+            interval (float): The target number of seconds between the starts of two rounds.
+        """
+        while True:
+            start = time.monotonic()
+            self.run_round()
+            time.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync many Gmail accounts across worker processes.")
+    parser.add_argument("accounts_dir", help="directory with one subdirectory holding token.json per account")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--project-units-per-second", type=float, default=PROJECT_UNITS_PER_SECOND)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--metadata-first", action="store_true")
+    parser.add_argument("--interval", type=float, default=None, help="repeat a round every this many seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    scheduler = AccountScheduler(args.accounts_dir, args.processes, args.project_units_per_second,
+                                 batch_size=args.batch_size, metadata_first=args.metadata_first)
+    if args.interval:
+        scheduler.run_forever(args.interval)
+    else:
+        scheduler.run_round()
@@ -0,0 +1,187 @@
+import logging
+
+from src.api_executor import QUOTA_UNITS
+
+# Gmail accepts at most 1000 message IDs per batchModify call.
+BATCH_MODIFY_LIMIT = 1000
+
+
+class ActionPlanner:
+    def __init__(self):
+        """
+        Initializes an empty plan of label changes keyed by message ID.
+        """
+        self.plan = {}
+        # The actions behind each plan, in the order they were added, and the rules they came from.
+        self.actions = {}
+        self.rule_hashes = {}
+
+    def add(self, message_id, add_label_ids=(), remove_label_ids=(), rule_hash=None):
+        """
+        Merges a label action into the plan of a message.
+
+        Actions are merged in the order they are added, so a later rule that adds a label
+        cancels an earlier rule removing it and vice versa.
+
+        Args:
+            message_id (str): The Gmail message ID.
+            add_label_ids (list): Labels to add to the message.
+            remove_label_ids (list): Labels to remove from the message.
+            rule_hash (str): The hash of the rule the action belongs to, used to journal it once applied.
+        """
+        add_labels, remove_labels = self.plan.setdefault(message_id, (set(), set()))
+        self._merge(add_labels, remove_labels, add_label_ids, remove_label_ids)
+        self.actions.setdefault(message_id, []).append((rule_hash, tuple(add_label_ids), tuple(remove_label_ids)))
+        if rule_hash is not None:
+            self.rule_hashes.setdefault(message_id, set()).add(rule_hash)
+
+    @staticmethod
+    def _merge(add_labels, remove_labels, add_label_ids, remove_label_ids):
+        for label_id in add_label_ids:
+            add_labels.add(label_id)
+            remove_labels.discard(label_id)
+        for label_id in remove_label_ids:
+            remove_labels.add(label_id)
+            add_labels.discard(label_id)
+
+    def skip_applied(self, store):
+        """
+        Reduces the plan to the changes that would actually alter a message.
+
+        The actions of rules journaled as applied to a message are dropped, so a label the user
+        changed by hand afterwards is left alone until the rule itself changes. Of the remaining
+        actions, labels the message already has are not added again and labels it lacks are not
+        removed. Messages whose labels are not stored keep their full plan.
+
+        Args:
+            store (EmailStore): Provides the stored labels and the applied rules journal.
+
+        Returns:
+            int: The number of messages whose planned change turned out to be a no-op.
+        """
+        message_ids = list(self.plan)
+        labels = store.get_labels_by_message(message_ids)
+        applied = store.get_applied_rules(message_ids)
+
+        skipped = 0
+        for message_id in message_ids:
+            done = applied.get(message_id, set())
+            add_labels, remove_labels = set(), set()
+            for rule_hash, add_label_ids, remove_label_ids in self.actions[message_id]:
+                if rule_hash is None or rule_hash not in done:
+                    self._merge(add_labels, remove_labels, add_label_ids, remove_label_ids)
+            current = labels.get(message_id)
+            if current is not None:
+                add_labels -= current
+                remove_labels &= current
+
+            planned_add, planned_remove = self.plan[message_id]
+            if (planned_add or planned_remove) and not (add_labels or remove_labels):
+                skipped += 1
+            self.plan[message_id] = (add_labels, remove_labels)
+        return skipped
+
+    def group(self):
+        """
+        Groups the planned messages by their label delta.
+
+        Returns:
+            dict: Maps (addLabelIds, removeLabelIds) tuples to the list of message IDs that need
+            exactly that change. Messages without any change are left out.
+        """
+        groups = {}
+        for message_id, (add_labels, remove_labels) in self.plan.items():
+            if add_labels or remove_labels:
+                delta = (tuple(sorted(add_labels)), tuple(sorted(remove_labels)))
+                groups.setdefault(delta, []).append(message_id)
+        return groups
+
+    def enqueue(self, store):
+        """
+        Writes the plan to the durable action outbox of the store in one transaction.
+
+        Messages that need no change are not enqueued; their rules are journaled as applied instead.
+
+        Args:
+            store (EmailStore): The store holding the outbox.
+
+        Returns:
+            int: The number of messages enqueued.
+        """
+        actions, applied_rules = [], {}
+        for message_id, (add_labels, remove_labels) in self.plan.items():
+            rule_hashes = self.rule_hashes.get(message_id, set())
+            if add_labels or remove_labels:
+                actions.append((message_id, add_labels, remove_labels, rule_hashes))
+            elif rule_hashes:
+                applied_rules[message_id] = rule_hashes
+        return store.enqueue_actions(actions, applied_rules)
+
+    def execute(self, service, executor, chunk_size=BATCH_MODIFY_LIMIT, store=None):
+        """
+        Applies the plan through messages().batchModify, one call per label delta and chunk.
+
+        Args:
+            service (Resource): The Gmail API service.
+            executor (ApiExecutor): Runs the batchModify calls concurrently.
+            chunk_size (int): The number of message IDs per call, capped at the Gmail limit.
+            store (EmailStore): When given, changes the stored state already reflects are skipped
+                (see skip_applied), and the label changes and rules of the successful calls are
+                recorded in the local database.
+
+        Returns:
+            list: The IDs of the messages whose modification failed.
+        """
+        chunk_size = max(1, min(chunk_size, BATCH_MODIFY_LIMIT))
+        chunks = []
+
+        if store is not None:
+            try:
+                executor.metrics.inc("gmail_modify_skipped_total", self.skip_applied(store))
+            except Exception as error:
+                logging.error(f"Error reading the stored label state: {error}")
+
+        for (add_labels, remove_labels), message_ids in self.group().items():
+            for start in range(0, len(message_ids), chunk_size):
+                chunks.append((message_ids[start:start + chunk_size], add_labels, remove_labels))
+
+        requests, errors = {}, {}
+        for index, (chunk, add_labels, remove_labels) in enumerate(chunks):
+            try:
+                requests[index] = service.users().messages().batchModify(
+                    userId='me',
+                    body={"ids": chunk, "addLabelIds": list(add_labels), "removeLabelIds": list(remove_labels)}
+                )
+            except Exception as error:
+                errors[index] = error
+
+        with executor.metrics.timer("gmail_stage_seconds", stage="modify"):
+            _, execute_errors = executor.execute_all(requests, QUOTA_UNITS["messages.batchModify"])
+        errors.update(execute_errors)
+
+        if store is not None:
+            # Messages without a change need no call, so their rules count as applied right away.
+            applied = [message_id for message_id, (add_labels, remove_labels) in self.plan.items()
+                       if not add_labels and not remove_labels]
+            for index, (chunk, add_labels, remove_labels) in enumerate(chunks):
+                if index not in errors:
+                    applied.extend(chunk)
+                    try:
+                        store.apply_label_changes(chunk, add_labels, remove_labels)
+                    except Exception as error:
+                        logging.error(f"Error recording label changes of {len(chunk)} emails: {error}")
+            try:
+                store.record_applied_rules({message_id: self.rule_hashes[message_id] for message_id in applied
+                                            if message_id in self.rule_hashes})
+            except Exception as error:
+                logging.error(f"Error journaling the applied rules: {error}")
+
+        failed_ids = []
+        for index, error in sorted(errors.items()):
+            chunk = chunks[index][0]
+            logging.error(f"Error modifying {len(chunk)} emails: {error}")
+            failed_ids.extend(chunk)
+
+        modified = sum(len(chunk) for chunk, _, _ in chunks) - len(failed_ids)
+        executor.metrics.inc("gmail_stage_items_total", modified, stage="modify")
+        return failed_ids
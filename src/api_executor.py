@@ -0,0 +1,263 @@
+import logging
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.gmail_client import get_authorized_http
+from src.metrics import Metrics
+
+# Quota units charged by Gmail per method call.
+QUOTA_UNITS = {
+    "getProfile": 1,
+    "history.list": 2,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+}
+
+# Gmail allows 250 quota units per user per second.
+USER_UNITS_PER_SECOND = 250
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+def is_retryable(error):
+    """
+    Checks whether a failed API call is worth retrying.
+
+    Args:
+        error (Exception): The error raised by the call.
+
+    Returns:
+        bool: True for throttling, server side and transient network errors.
+    """
+    # Imported here like in gmail_client: a failed call means the client library is loaded already.
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    if isinstance(error, HttpError):
+        if error.resp.status in RETRYABLE_STATUSES:
+            return True
+        if error.resp.status == 403:
+            return any(detail.get("reason") in RATE_LIMIT_REASONS
+                       for detail in (error.error_details or []) if isinstance(detail, dict))
+        return False
+    return isinstance(error, (ConnectionError, TimeoutError, socket.timeout, httplib2.ServerNotFoundError))
+
+
+def method_name(request):
+    """
+    Returns the API method of a request for metric labels, e.g. gmail.users.messages.get.
+    """
+    method = getattr(request, "methodId", None)
+    return method if isinstance(method, str) else "batch"
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        """
+        Initializes a token bucket that refills continuously.
+
+        Args:
+            rate (float): The number of tokens added per second.
+            capacity (float): The maximum number of tokens held, defaults to one second of refill.
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Takes the requested number of tokens, blocking until the bucket has refilled what they overdraw.
+
+        The tokens are taken at once, so the balance may go negative: a call costing more than the
+        capacity, like a batch of many gets, is charged in full and waits until the debt is repaid,
+        and later callers queue behind that debt.
+
+        Args:
+            tokens (float): The number of tokens to take.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ApiExecutor:
+    def __init__(self, credentials=None, max_workers=8, units_per_second=USER_UNITS_PER_SECOND, max_retries=5,
+                 backoff_base=1.0, backoff_max=32.0, metrics=None):
+        """
+        Initializes a bounded thread pool that runs Gmail API requests within the user quota.
+
+        Args:
+            credentials (Credentials): Used to run every request on the authorized transport of the worker
+                thread, as httplib2 connections cannot be shared between threads. Without credentials,
+                requests run on the transport they were built with.
+            max_workers (int): The maximum number of concurrent API calls.
+            units_per_second (float): The quota units the token bucket lets through per second.
+            max_retries (int): How many times a retryable failure is retried.
+            backoff_base (float): The initial backoff delay in seconds.
+            backoff_max (float): The upper bound of the backoff delay in seconds.
+            metrics (Metrics): Collects call, retry and error counts and call latencies.
+        """
+        self.credentials = credentials
+        self.metrics = metrics or Metrics()
+        self.bucket = TokenBucket(units_per_second)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.results_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Waits for the running calls and stops the worker threads.
+        """
+        self.pool.shutdown(wait=True)
+
+    def backoff_delay(self, attempt, error=None):
+        """
+        Calculates an exponential backoff delay with full jitter.
+
+        Args:
+            attempt (int): The zero based number of the failed attempt.
+            error (Exception): The error that caused the retry; a Retry-After header is honoured.
+
+        Returns:
+            float: The delay in seconds.
+        """
+        from googleapiclient.errors import HttpError
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if isinstance(error, HttpError):
+            retry_after = error.resp.get("retry-after")
+            if retry_after and str(retry_after).isdigit():
+                delay = max(delay, float(retry_after))
+        return delay
+
+    def execute(self, request, cost=1):
+        """
+        Executes a request once the token bucket allows it, retrying retryable errors with backoff.
+
+        Args:
+            request (HttpRequest): The request, or batch request, to execute.
+            cost (float): The quota units the request consumes.
+
+        Returns:
+            The deserialized response.
+
+        Raises:
+            Exception: The last error once the request is not retryable or out of retries.
+        """
+        method = method_name(request)
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire(cost)
+            self.metrics.inc("gmail_api_calls_total", method=method)
+            try:
+                with self.metrics.timer("gmail_api_call_seconds", method=method):
+                    if self.credentials is not None:
+                        return request.execute(http=get_authorized_http(self.credentials))
+                    return request.execute()
+            except Exception as error:
+                if attempt >= self.max_retries or not is_retryable(error):
+                    self.metrics.inc("gmail_api_errors_total", method=method)
+                    raise
+                self.metrics.inc("gmail_api_retries_total", method=method)
+                delay = self.backoff_delay(attempt, error)
+                logging.warning(f"Retrying API call in {delay:.2f}s after error: {error}")
+                time.sleep(delay)
+
+    def execute_all(self, requests, cost=1):
+        """
+        Executes keyed requests concurrently on the thread pool.
+
+        Args:
+            requests (dict): Maps a key to the request to execute.
+            cost (float): The quota units each request consumes.
+
+        Returns:
+            tuple: A dict of responses and a dict of errors, both keyed like requests.
+        """
+        futures = {key: self.pool.submit(self.execute, request, cost) for key, request in requests.items()}
+        results, errors = {}, {}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as error:
+                errors[key] = error
+        return results, errors
+
+    def execute_batch(self, service, requests, cost, batch_size):
+        """
+        Executes keyed requests as concurrent Gmail batch requests.
+
+        Items that fail with a retryable error are collected and sent again in a later round, so a
+        throttled item neither aborts its batch nor gets dropped.
+
+        Args:
+            service (Resource): The Gmail API service used to create the batch requests.
+            requests (dict): Maps a key, used as the batch request ID, to the request to execute.
+            cost (float): The quota units each item consumes.
+            batch_size (int): The number of items per batch request.
+
+        Returns:
+            tuple: A dict of responses and a dict of errors, both keyed like requests.
+        """
+        results, errors = {}, {}
+        pending = dict(requests)
+
+        for attempt in range(self.max_retries + 1):
+            retry = {}
+
+            def collect(request_id, response, exception):
+                with self.results_lock:
+                    if exception is None:
+                        results[request_id] = response
+                    elif attempt < self.max_retries and is_retryable(exception):
+                        retry[request_id] = pending[request_id]
+                        self.metrics.inc("gmail_api_retries_total", method=method_name(pending[request_id]))
+                    else:
+                        errors[request_id] = exception
+                        self.metrics.inc("gmail_api_errors_total", method=method_name(pending[request_id]))
+
+            keys = list(pending)
+            batches = {}
+            for start in range(0, len(keys), batch_size):
+                batch = service.new_batch_http_request(callback=collect)
+                for key in keys[start:start + batch_size]:
+                    batch.add(pending[key], request_id=key)
+                batches[tuple(keys[start:start + batch_size])] = batch
+
+            futures = {chunk: self.pool.submit(self.execute, batch, cost * len(chunk))
+                       for chunk, batch in batches.items()}
+            for chunk, future in futures.items():
+                try:
+                    future.result()
+                except Exception as error:
+                    logging.error(f"Error executing batch request: {error}")
+                    with self.results_lock:
+                        for key in chunk:
+                            errors[key] = error
+
+            if not retry:
+                break
+            time.sleep(self.backoff_delay(attempt))
+            pending = retry
+
+        return results, errors
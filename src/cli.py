@@ -0,0 +1,93 @@
+import argparse
+import logging
+
+# Only argparse and logging are imported up front: every command imports the modules it runs, so
+# the Google client libraries are loaded by the commands that call the API and `--help` stays instant.
+
+
+def run_fetch(args):
+    """Fetch the newest inbox messages into the database."""
+    from src.email_fetcher import EmailFetcher
+
+    fetcher = EmailFetcher(max_workers=args.max_workers, db_path=args.db_path, api_endpoint=args.api_endpoint,
+                           metrics_dir=args.metrics_dir)
+    return 0 if fetcher.fetch_emails(max_results=args.max_results, batch_size=args.batch_size) else 1
+
+
+def run_sync(args):
+    """Synchronise the inbox incrementally, optionally applying the rules to the new messages."""
+    from src.email_fetcher import EmailFetcher
+
+    fetcher = EmailFetcher(max_workers=args.max_workers, db_path=args.db_path, api_endpoint=args.api_endpoint,
+                           metrics_dir=args.metrics_dir)
+    if args.rules_file:
+        fetcher.rules_file = args.rules_file
+    synced = fetcher.sync_emails(page_size=args.page_size, batch_size=args.batch_size, apply_rules=args.apply_rules,
+                                 metadata_first=args.metadata_first, fetch_bodies=args.fetch_bodies)
+    # Messages left for a retry are picked up by the next sync, but cron should still see the failure.
+    return 0 if synced else 1
+
+
+def run_filter(args):
+    """Apply the rules to the stored messages."""
+    from src.email_filter import EmailFilter
+
+    email_filter = EmailFilter(max_workers=args.max_workers, db_path=args.db_path, rules_file=args.rules_file,
+                               api_endpoint=args.api_endpoint, metrics_dir=args.metrics_dir)
+    try:
+        email_filter.apply_filters(use_index=args.use_index)
+    finally:
+        email_filter.close()
+    # Failed changes stay in the outbox for the next run, but cron should still see the failure.
+    return 1 if email_filter.failed_message_ids else 0
+
+
+def build_parser():
+    """
+    Builds the parser of the command line.
+
+    Returns:
+        ArgumentParser: The parser; the chosen command's handler is stored as `handler`.
+    """
+    parser = argparse.ArgumentParser(prog="python -m src", description="Fetch Gmail messages and apply rules.")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--db-path", default=None, help="SQLite database, defaults to src/email_db.db")
+    common.add_argument("--api-endpoint", default=None, help="root URL of the Gmail API, e.g. a test server")
+    common.add_argument("--metrics-dir", default=None, help="directory for the .prom and .json run metrics")
+    common.add_argument("--max-workers", type=int, default=8, help="concurrent Gmail API calls")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    fetch = commands.add_parser("fetch", parents=[common], help="fetch the newest inbox messages")
+    fetch.add_argument("--max-results", type=int, default=50)
+    fetch.add_argument("--batch-size", type=int, default=None)
+    fetch.set_defaults(handler=run_fetch)
+
+    sync = commands.add_parser("sync", parents=[common], help="fetch the messages added since the last sync")
+    sync.add_argument("--page-size", type=int, default=100)
+    sync.add_argument("--batch-size", type=int, default=None)
+    sync.add_argument("--apply-rules", action="store_true", help="label the new messages in the same run")
+    sync.add_argument("--rules-file", default=None)
+    sync.add_argument("--metadata-first", action="store_true")
+    sync.add_argument("--fetch-bodies", action="store_true")
+    sync.set_defaults(handler=run_sync)
+
+    filter_command = commands.add_parser("filter", parents=[common], help="apply the rules to the stored messages")
+    filter_command.add_argument("--rules-file", default=None)
+    filter_command.add_argument("--use-index", action="store_true", help="match in Python through the rule index")
+    filter_command.set_defaults(handler=run_filter)
+    return parser
+
+
+def main(argv=None):
+    """
+    Runs the command given on the command line.
+
+    Args:
+        argv (list): The arguments, defaults to sys.argv[1:].
+
+    Returns:
+        int: The exit status.
+    """
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    return args.handler(args)
@@ -0,0 +1,146 @@
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# The subdirectory of the user cache directory that holds the JSON copies of the configuration files.
+CACHE_DIRECTORY_NAME = "gmail-rules"
+
+
+def file_stamp(path):
+    """
+    Identifies the version of a file by its modification time and size.
+
+    Args:
+        path (str): The file.
+
+    Returns:
+        tuple: (st_mtime_ns, st_size).
+    """
+    status = os.stat(path)
+    return status.st_mtime_ns, status.st_size
+
+
+class FileCache:
+    def __init__(self):
+        """
+        Initializes a cache of values built from files, kept until one of the files changes.
+
+        Short runs of the same process - the rounds of the account scheduler, a watcher, or the
+        filter and fetcher sharing one rules file - then parse and compile each file only once.
+        """
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, paths, build):
+        """
+        Returns the value built from the files, calling build() only if a file changed since the
+        value was built.
+
+        The files are stamped before build() reads them, so a file edited while it is read is read
+        again on the next call.
+
+        Args:
+            paths (list): The files the value is built from.
+            build (callable): Builds the value from the current contents of the files.
+
+        Returns:
+            object: The shared value; callers that modify it have to copy it first.
+        """
+        key = tuple(os.path.abspath(path) for path in paths)
+        stamps = tuple(file_stamp(path) for path in paths)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == stamps:
+                return entry[1]
+        value = build()
+        with self.lock:
+            self.entries[key] = (stamps, value)
+        return value
+
+    def clear(self):
+        """Drop every cached value."""
+        with self.lock:
+            self.entries.clear()
+
+
+_constants_cache = FileCache()
+
+
+def cache_directory():
+    """
+    Returns the user cache directory of this application: under $XDG_CACHE_HOME, %LOCALAPPDATA% or
+    ~/.cache, so the package directory is never written to.
+    """
+    base = (os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA")
+            or os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, CACHE_DIRECTORY_NAME)
+
+
+def constants_cache_path(config_file):
+    """
+    Returns the JSON copy of a YAML configuration file, named after a hash of its absolute path so
+    that every configuration file has a copy of its own.
+    """
+    path = os.path.abspath(config_file)
+    digest = hashlib.sha1(path.encode("UTF-8")).hexdigest()[:16]
+    return os.path.join(cache_directory(), f"{os.path.basename(path)}-{digest}.json")
+
+
+def _read_constants(config_file):
+    """
+    Parses a YAML configuration file, from its JSON copy while that is current.
+
+    Importing and running the YAML parser takes longer than a short filter run spends on its actual
+    work, so the parsed constants are kept as JSON tagged with the stamp of the YAML file.
+    """
+    stamp = list(file_stamp(config_file))
+    cache_file = constants_cache_path(config_file)
+    try:
+        with open(cache_file, "r") as file:
+            cached = json.load(file)
+        if cached.get("stamp") == stamp:
+            return cached["constants"]
+    except (OSError, ValueError, AttributeError, KeyError):
+        pass
+
+    import yaml
+
+    try:
+        with open(config_file, "r") as file:
+            constants = yaml.safe_load(file)
+    except yaml.YAMLError as error:
+        raise ValueError(f"Error parsing the YAML configuration file: {error}")
+
+    # The copy is only an optimisation: when it cannot be written, the YAML file is parsed again next time.
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix=".tmp")
+        try:
+            with os.fdopen(handle, "w") as file:
+                json.dump({"stamp": stamp, "constants": constants}, file)
+            os.replace(temporary_path, cache_file)
+        except (OSError, TypeError, ValueError):
+            os.remove(temporary_path)
+    except OSError:
+        pass
+    return constants
+
+
+def load_constants(config_file):
+    """
+    Loads the configuration constants of constants.yaml.
+
+    Args:
+        config_file (str): The path of constants.yaml.
+
+    Returns:
+        dict: The constants, a copy the caller may modify.
+
+    Raises:
+        FileNotFoundError: If the file does not exist.
+        ValueError: If the file is not valid YAML.
+    """
+    return copy.deepcopy(_constants_cache.get([config_file], lambda: _read_constants(config_file)))
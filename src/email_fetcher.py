@@ -1,126 +1,761 @@
 import base64
+import json
+import multiprocessing
 import os
-import re
-import sqlite3
 import logging
-from datetime import datetime
-from email import message_from_string
-
-import pandas as pd
-from googleapiclient.discovery import build
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from email.message import Message
 
+from src.action_planner import ActionPlanner
+from src.api_executor import ApiExecutor, QUOTA_UNITS, USER_UNITS_PER_SECOND
+from src.email_store import EmailStore
+from src.gmail_client import get_gmail_service
+from src.message_parser import extract_body, format_timestamp, header_text, parse_source, received_timestamp
+from src.metrics import Metrics
 from src.oauth_token_manager import OAuthTokenManager
+from src.outbox_drainer import OutboxDrainer
+from src.rule_engine import RuleSet
+
+# Gmail rejects batch requests that carry more than 100 calls.
+GMAIL_BATCH_LIMIT = 100
+
+# The headers behind the Fields_References columns of constants.yaml, plus the content type.
+METADATA_HEADERS = ["From", "To", "Subject", "Date", "Content-Type"]
+
+# Pages of fewer raw bytes are parsed in the process: shipping them to the parse pool costs more
+# than parsing them.
+PARALLEL_PARSE_MIN_BYTES = 4 * 1024 * 1024
+
+# The number of downloaded pages waiting to be parsed and stored before the download blocks.
+PIPELINE_DEPTH = 2
+
+# Marks the end of the pages put on the parse queue.
+STOP = object()
+
+# The number of syncs that retry a message which could not be downloaded or stored before it is given up.
+MAX_MESSAGE_RETRIES = 5
 
 
 class EmailFetcher:
-    def __init__(self):
+    def __init__(self, max_workers=8, credentials=None, db_path=None, api_endpoint=None,
+                 units_per_second=USER_UNITS_PER_SECOND, metrics_dir=None, parse_processes=None):
         """
         Initializes the InboxFetcher by checking OAuth credentials.
+
+        Args:
+            max_workers (int): The maximum number of concurrent Gmail API calls.
+            credentials (Credentials): The OAuth credentials, loaded through OAuthTokenManager when omitted.
+            db_path (str): The SQLite database, defaults to email_db.db next to this module.
+            api_endpoint (str): Overrides the root URL of the Gmail API, e.g. to target a local test server.
+            units_per_second (float): The quota units per second the API calls are throttled to.
+            metrics_dir (str): When set, every run writes its metrics there as fetch.prom / sync.prom
+                for the Prometheus textfile collector, and fetch.json / sync.json run summaries.
+            parse_processes (int): The worker processes large pages of raw messages are parsed in,
+                defaults to the number of CPUs; 1 parses every page in this process.
         """
         base_path = os.path.dirname(__file__)
-        self.db_path = os.path.join(base_path, 'email_db.db')
-        self.creds = OAuthTokenManager().get_valid_credentials()
+        self.db_path = db_path or os.path.join(base_path, 'email_db.db')
+        self.config_file = os.path.join(base_path, 'constants.yaml')
+        self.rules_file = os.path.join(base_path, 'rules.json')
+        self.creds = credentials or OAuthTokenManager().get_valid_credentials()
+        self.api_endpoint = api_endpoint
+        self.max_workers = max_workers
+        self.units_per_second = units_per_second
+        self.metrics_dir = metrics_dir
+        self.metrics = Metrics()
+        self.rule_set = None
+        self.parse_processes = parse_processes or os.cpu_count() or 1
+        self.parse_pool = None
 
-    def fetch_emails(self, max_results=50):
+    def fetch_emails(self, max_results=50, batch_size=None):
         """
         Fetches emails from the Gmail inbox and stores them in a SQLite database.
 
         Args:
             max_results (int): The maximum number of emails to fetch.
+            batch_size (int): When set, messages are retrieved through Gmail batch requests of
+                this many calls each instead of one request per message.
+
+        Returns:
+            bool: True if the fetched emails were stored, False if the fetch failed.
         """
+        self.metrics = Metrics()
         try:
             # Create the table if it doesn't exist (only when starting the application)
             self.create_table()
 
-            service = build('gmail', 'v1', credentials=self.creds)
-            message_data = service.users().messages().list(userId='me', labelIds=['INBOX'],
-                                                           maxResults=max_results).execute()
-            messages = message_data.get('messages', [])
+            service = get_gmail_service(self.creds, self.api_endpoint)
+            with ApiExecutor(credentials=self.creds, max_workers=self.max_workers,
+                             units_per_second=self.units_per_second, metrics=self.metrics) as executor:
+                with self.metrics.timer("gmail_stage_seconds", stage="list"):
+                    message_data = executor.execute(
+                        service.users().messages().list(userId='me', labelIds=['INBOX'], maxResults=max_results),
+                        QUOTA_UNITS["messages.list"])
+                messages = message_data.get('messages', [])
+                message_ids = [message["id"] for message in messages]
 
-            inbox_data = []
+                fetched = self.save_to_database(self.download_emails(service, executor, message_ids, batch_size))
+
+        except Exception as error:
+            logging.error(f"Error fetching emails: {error}")
+            fetched = False
+        finally:
+            self.close_parse_pool()
+        self.export_metrics("fetch")
+        return fetched
+
+    def sync_emails(self, page_size=100, batch_size=None, apply_rules=False, metadata_first=False,
+                    fetch_bodies=False):
+        """
+        Incrementally synchronises the Gmail inbox with the SQLite database.
+
+        Only the messages added since the stored history checkpoint are fetched. Without a usable
+        checkpoint the whole inbox is listed page by page. Pages are parsed and committed on a
+        separate stage while the next page downloads, and at most PIPELINE_DEPTH pages wait for
+        it, so memory use stays bounded by the page size.
+
+        Args:
+            page_size (int): The number of message IDs requested per page.
+            batch_size (int): When set, messages are retrieved through Gmail batch requests.
+            apply_rules (bool): Evaluates the rules against every fetched message and applies the
+                resulting label actions at the end of the sync, so no separate filter run is needed.
+            metadata_first (bool): Downloads only the headers rules can refer to, and the full message
+                only for the emails whose body a "Message" rule could need.
+            fetch_bodies (bool): With metadata_first, downloads the full message of every email anyway.
+
+        Messages that could not be downloaded, parsed or stored are kept in the sync state and
+        retried by the next syncs, so the checkpoint can advance without losing them.
+
+        Returns:
+            bool: True if every listed message was stored, False if the sync failed or some messages
+            are left for a retry.
+        """
+        self.metrics = Metrics()
+        try:
+            self.create_table()
+            rule_set = self.load_rule_set() if apply_rules else None
+            planner = ActionPlanner()
+
+            service = get_gmail_service(self.creds, self.api_endpoint)
+            with ApiExecutor(credentials=self.creds, max_workers=self.max_workers,
+                             units_per_second=self.units_per_second, metrics=self.metrics) as executor:
+                # Taken before listing so that changes made during the sync are picked up next time.
+                history_id = executor.execute(service.users().getProfile(userId='me'),
+                                              QUOTA_UNITS["getProfile"]).get("historyId")
+
+                retries = self.get_retry_ids()
+                pages = self.iter_sync_pages(service, executor, retries, page_size)
+                downloads = ((message_ids, *self.download_messages(service, executor, message_ids, batch_size,
+                                                                   metadata_first, fetch_bodies))
+                             for message_ids in pages)
+                failed_ids = self.store_pages(executor.metrics, downloads, rule_set, planner)
+
+                modify_failed_ids = self.apply_actions(service, executor, planner)
+                if modify_failed_ids:
+                    logging.error(f"Failed to modify emails with IDs, retrying from the outbox: "
+                                  f"{', '.join(modify_failed_ids)}")
+
+            self.save_checkpoint(history_id, self.count_retries(retries, failed_ids))
+            synced = not failed_ids
+
+        except Exception as error:
+            logging.error(f"Error syncing emails: {error}")
+            synced = False
+        finally:
+            self.close_parse_pool()
+        self.export_metrics("sync")
+        return synced
+
+    def export_metrics(self, name):
+        """
+        Writes the metrics of the last run to the metrics directory, if one is configured.
+
+        Args:
+            name (str): The base name of the files, e.g. "sync".
+        """
+        if not self.metrics_dir:
+            return
+        try:
+            self.metrics.export(self.metrics_dir, name)
+        except Exception as error:
+            logging.error(f"Error writing metrics: {error}")
+
+    def load_rule_set(self):
+        """
+        Compiles the rules on first use and keeps them for the following syncs.
+
+        Returns:
+            RuleSet: The compiled rules.
+        """
+        if self.rule_set is None:
+            self.rule_set = RuleSet.from_files(self.rules_file, self.config_file)
+        return self.rule_set
+
+    def iter_sync_pages(self, service, executor, retries, page_size):
+        """
+        Yields the pages of message IDs a sync downloads: the messages left for a retry by earlier
+        syncs first, then the messages added since the history checkpoint.
+
+        Args:
+            service (Resource): The Gmail API service.
+            executor (ApiExecutor): Runs the API calls.
+            retries (dict): The retry map returned by get_retry_ids.
+            page_size (int): The number of message IDs per page.
+
+        Yields:
+            list: The message IDs of one page.
+        """
+        retry_ids = list(retries)
+        for start in range(0, len(retry_ids), page_size):
+            yield retry_ids[start:start + page_size]
+        yield from self.iter_message_id_pages(service, executor, self.get_checkpoint(), page_size)
+
+    @staticmethod
+    def count_retries(retries, failed_ids):
+        """
+        Counts another failed attempt for every message that could not be stored, giving up on
+        the messages that failed MAX_MESSAGE_RETRIES syncs.
+
+        Args:
+            retries (dict): The retry map returned by get_retry_ids before the sync.
+            failed_ids (list): The IDs of the messages this sync could not store.
+
+        Returns:
+            dict: The retry map to save with the new checkpoint.
+        """
+        retries = {message_id: retries.get(message_id, 0) + 1 for message_id in failed_ids}
+        for message_id, attempts in list(retries.items()):
+            if attempts >= MAX_MESSAGE_RETRIES:
+                logging.error(f"Giving up on email with ID {message_id} after {attempts} failed syncs")
+                del retries[message_id]
+        if retries:
+            logging.error(f"Failed to store emails with IDs, retrying next sync: {', '.join(retries)}")
+        return retries
+
+    @staticmethod
+    def missing_ids(message_ids, inbox_data):
+        """
+        Returns the listed IDs that have no email in the downloaded page, in listing order.
+        """
+        stored_ids = {email["message_id"] for email in inbox_data}
+        return [message_id for message_id in message_ids if message_id not in stored_ids]
+
+    def iter_message_id_pages(self, service, executor, checkpoint, page_size):
+        """
+        Yields pages of message IDs to download, falling back to a full listing when the
+        history checkpoint is missing or has expired.
+
+        Args:
+            service (Resource): The Gmail API service.
+            executor (ApiExecutor): Runs the API calls.
+            checkpoint (str): The historyId stored by the previous sync, if any.
+            page_size (int): The number of results requested per page.
+
+        Yields:
+            list: The message IDs of one page.
+        """
+        if checkpoint:
+            from googleapiclient.errors import HttpError
+
+            try:
+                yield from self.iter_history_pages(service, executor, checkpoint, page_size, self.store)
+                return
+            except HttpError as error:
+                # Gmail answers 404 once a startHistoryId is too old to be served.
+                if error.resp.status != 404:
+                    raise
+                logging.warning(f"History checkpoint {checkpoint} expired, running a full sync")
+
+        yield from self.iter_inbox_pages(service, executor, page_size)
+
+    @staticmethod
+    def iter_inbox_pages(service, executor, page_size):
+        """
+        Yields every page of message IDs in the inbox by following nextPageToken.
+
+        Args:
+            service (Resource): The Gmail API service.
+            executor (ApiExecutor): Runs the API calls.
+            page_size (int): The number of results requested per page.
+
+        Yields:
+            list: The message IDs of one page.
+        """
+        page_token = None
+        while True:
+            with executor.metrics.timer("gmail_stage_seconds", stage="list"):
+                message_data = executor.execute(
+                    service.users().messages().list(userId='me', labelIds=['INBOX'], maxResults=page_size,
+                                                    pageToken=page_token),
+                    QUOTA_UNITS["messages.list"])
+            message_ids = [message["id"] for message in message_data.get('messages', [])]
+            if message_ids:
+                yield message_ids
+            page_token = message_data.get("nextPageToken")
+            if not page_token:
+                return
+
+    @staticmethod
+    def iter_history_pages(service, executor, start_history_id, page_size, store=None):
+        """
+        Yields the IDs of inbox messages added since the given history checkpoint.
+
+        Args:
+            service (Resource): The Gmail API service.
+            executor (ApiExecutor): Runs the API calls.
+            start_history_id (str): The historyId to list changes from.
+            page_size (int): The number of history records requested per page.
+            store (EmailStore): When given, labels added to or removed from stored messages in Gmail
+                are recorded there, so the local labels do not drift.
+
+        Yields:
+            list: The new message IDs of one page.
+
+        Raises:
+            HttpError: With status 404 if the checkpoint is no longer available.
+        """
+        history_types = ['messageAdded', 'labelAdded', 'labelRemoved'] if store is not None else ['messageAdded']
+        page_token = None
+        while True:
+            with executor.metrics.timer("gmail_stage_seconds", stage="list"):
+                history_data = executor.execute(
+                    service.users().history().list(userId='me', startHistoryId=start_history_id,
+                                                   labelId='INBOX', historyTypes=history_types,
+                                                   maxResults=page_size, pageToken=page_token),
+                    QUOTA_UNITS["history.list"])
+            message_ids = []
+            for record in history_data.get("history", []):
+                for added in record.get("messagesAdded", []):
+                    message_id = added["message"]["id"]
+                    if message_id not in message_ids:
+                        message_ids.append(message_id)
+                if store is not None:
+                    for change in record.get("labelsAdded", []):
+                        store.apply_label_changes([change["message"]["id"]], add_label_ids=change["labelIds"])
+                    for change in record.get("labelsRemoved", []):
+                        store.apply_label_changes([change["message"]["id"]], remove_label_ids=change["labelIds"])
+            if message_ids:
+                yield message_ids
+            page_token = history_data.get("nextPageToken")
+            if not page_token:
+                return
+
+    def download_emails(self, service, executor, message_ids, batch_size=None, metadata_first=False,
+                        fetch_bodies=False):
+        """
+        Downloads and parses the given messages.
+
+        See download_messages for the arguments.
+
+        Returns:
+            list: List of dictionaries containing email data.
+        """
+        return self.parse_page(executor.metrics, *self.download_messages(
+            service, executor, message_ids, batch_size, metadata_first, fetch_bodies))
+
+    def download_messages(self, service, executor, message_ids, batch_size=None, metadata_first=False,
+                          fetch_bodies=False):
+        """
+        Downloads the given messages, leaving the raw messages to parse_page.
+
+        The downloads run concurrently on the executor. A message that cannot be downloaded is
+        logged and skipped.
+
+        Args:
+            service (Resource): The Gmail API service.
+            executor (ApiExecutor): Runs the API calls.
+            message_ids (list): IDs of the messages to download.
+            batch_size (int): When set, messages are retrieved through Gmail batch requests.
+            metadata_first (bool): Downloads only the headers rules can refer to, and the full message
+                only for the emails whose body a rule could need.
+            fetch_bodies (bool): With metadata_first, downloads the full message of every email anyway.
+
+        Returns:
+            tuple: The email data parsed from the metadata, empty without metadata_first, and the
+            raw messages still to parse.
+        """
+        if not metadata_first:
+            return [], self.get_messages(service, executor, message_ids, batch_size, format="raw")
+
+        metadata_messages = self.get_messages(service, executor, message_ids, batch_size, format="metadata",
+                                              metadataHeaders=METADATA_HEADERS)
+        with executor.metrics.timer("gmail_stage_seconds", stage="parse"):
+            inbox_data = [email for email in map(self.parse_metadata, metadata_messages) if email]
+        executor.metrics.inc("gmail_stage_items_total", len(metadata_messages), stage="parse")
+
+        if not fetch_bodies:
+            rule_set = self.load_rule_set()
+            body_ids = [email["message_id"] for email in inbox_data if rule_set.may_need_body(email)]
+        else:
+            body_ids = [email["message_id"] for email in inbox_data]
+
+        raw_messages = self.get_messages(service, executor, body_ids, batch_size, format="raw") if body_ids else []
+        return inbox_data, raw_messages
+
+    def parse_page(self, metrics, inbox_data, raw_messages):
+        """
+        Parses the raw messages of a page, replacing the metadata rows of the same messages.
 
-            for message in messages:
-                content_data = {}
-                raw_message = service.users().messages().get(userId='me', id=message["id"], format="raw").execute()
-                parsed_message = message_from_string(base64.urlsafe_b64decode(raw_message.get("raw")).decode("UTF-8"))
-
-                if isinstance(parsed_message.get_payload(), list):
-                    # Skipping this part as some emails have multiple payloads.
-                    pass
-                else:
-                    date_match = re.findall(r",(.*)\+", parsed_message.get("Date"))
-                    if date_match:
-                        date = date_match[0].strip()
-                        content_data = {
-                            "from_id": parsed_message.get("From"),
-                            "to_id": parsed_message.get("To"),
-                            "date": datetime.strptime(date, "%d %b %Y %H:%M:%S").strftime("%Y-%m-%d %H:%M"),
-                            "message_id": raw_message.get("id"),
-                            "content_type": parsed_message.get("Content-Type"),
-                            "content": parsed_message.get_payload(),
-                            "subject": parsed_message.get("Subject"),
-                            "labels": ",".join(raw_message.get("labelIds"))
-                        }
-                        inbox_data.append(content_data)
-                    else:
+        Args:
+            metrics (Metrics): Records the parse stage.
+            inbox_data (list): The email data parsed from the metadata, or an empty list.
+            raw_messages (list): The raw messages of the page.
+
+        Returns:
+            list: The email data of the page.
+        """
+        full_emails = self.parse_messages(metrics, raw_messages) if raw_messages else []
+        if not inbox_data:
+            return full_emails
+        full_emails = {email["message_id"]: email for email in full_emails}
+        return [full_emails.get(email["message_id"], email) for email in inbox_data]
+
+    def store_pages(self, metrics, downloads, rule_set=None, planner=None):
+        """
+        Parses and stores downloaded pages on a separate thread, so a page is parsed and committed
+        while the next one is downloading.
+
+        Args:
+            metrics (Metrics): Records the parse stage.
+            downloads (iterable): The (message_ids, inbox_data, raw_messages) pages, the listed IDs
+                followed by the result of download_messages, downloaded on this thread as they are iterated.
+            rule_set (RuleSet): When given, the rules are evaluated against every stored message.
+            planner (ActionPlanner): Collects the actions of the matching rules.
+
+        Returns:
+            list: The listed IDs whose message could not be downloaded, parsed or stored, in listing order.
+
+        Raises:
+            Exception: The first error of the parse stage; no further page is downloaded after it.
+        """
+        pages = queue.Queue(maxsize=PIPELINE_DEPTH)
+        errors = []
+        failed_ids = []
+
+        def parse_and_store():
+            while True:
+                page = pages.get()
+                if page is STOP:
+                    return
+                if errors:
+                    continue
+                try:
+                    message_ids, inbox_data, raw_messages = page
+                    inbox_data = self.parse_page(metrics, inbox_data, raw_messages)
+                    if inbox_data and not self.save_to_database(inbox_data):
+                        failed_ids.extend(message_ids)
                         continue
+                    failed_ids.extend(self.missing_ids(message_ids, inbox_data))
+                    if rule_set:
+                        for email in inbox_data:
+                            for rule in rule_set.plan_actions(email, planner):
+                                self.metrics.inc("gmail_rule_matches_total", rule=rule.name)
+                except Exception as error:
+                    errors.append(error)
+
+        stage = threading.Thread(target=parse_and_store, name="sync-parse")
+        stage.start()
+        try:
+            for page in downloads:
+                if errors:
+                    break
+                pages.put(page)
+        finally:
+            pages.put(STOP)
+            stage.join()
+        if errors:
+            raise errors[0]
+        return failed_ids
+
+    def apply_actions(self, service, executor, planner):
+        """
+        Writes the planned label changes to the durable action outbox and drains it.
+
+        Changes that fail stay in the outbox and are retried by later drains, so they are not lost
+        when the history checkpoint advances.
+
+        Args:
+            service (Resource): The Gmail API service.
+            executor (ApiExecutor): Runs the batchModify calls and records the metrics.
+            planner (ActionPlanner): The planned label changes.
+
+        Returns:
+            list: The IDs of the messages whose modification failed during this drain.
+        """
+        store = self.store
+        executor.metrics.inc("gmail_modify_skipped_total", planner.skip_applied(store))
+        planner.enqueue(store)
+        if not store.count_actions()["pending"]:
+            return []
+        return OutboxDrainer(store, executor).drain(service)
+
+    def parse_messages(self, metrics, raw_messages):
+        """
+        Parses raw messages into inbox rows, recording the parse time and the bytes downloaded.
+
+        Args:
+            metrics (Metrics): Records the parse stage.
+            raw_messages (list): The message resources returned by messages().get(format="raw").
+
+        Returns:
+            list: The email data of the messages that are not skipped.
+        """
+        # The raw field is base64url, four characters for every three bytes of message source.
+        raw_bytes = sum(len(message.get("raw") or "") for message in raw_messages) * 3 // 4
+        with metrics.timer("gmail_stage_seconds", stage="parse"):
+            results = None
+            pool = self.get_parse_pool() if raw_bytes >= PARALLEL_PARSE_MIN_BYTES else None
+            if pool:
+                try:
+                    chunk_size = max(1, len(raw_messages) // (self.parse_processes * 4))
+                    results = list(pool.map(self.try_parse_message, raw_messages, chunksize=chunk_size))
+                except Exception as error:
+                    logging.error(f"Error parsing emails in worker processes: {error}")
+                    self.close_parse_pool()
+            if results is None:
+                results = map(self.try_parse_message, raw_messages)
+
+            inbox_data = []
+            for raw_message, (email, error) in zip(raw_messages, results):
+                if error:
+                    logging.error(f"Error parsing email with ID {raw_message.get('id')}: {error}")
+                elif email:
+                    inbox_data.append(email)
+        metrics.inc("gmail_stage_items_total", len(raw_messages), stage="parse")
+        metrics.inc("gmail_message_bytes_total", raw_bytes)
+        return inbox_data
+
+    def get_parse_pool(self):
+        """
+        Returns the worker processes raw messages are parsed in, started on first use and kept until
+        close_parse_pool(), or None if parse_processes is 1.
+        """
+        if self.parse_processes <= 1:
+            return None
+        if self.parse_pool is None:
+            # A forked child would inherit locks held by the API threads; a fork server starts
+            # clean workers instead. Windows only offers spawn.
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self.parse_pool = ProcessPoolExecutor(max_workers=self.parse_processes, mp_context=context)
+        return self.parse_pool
+
+    def close_parse_pool(self):
+        """Stop the parse worker processes, if they were started."""
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+            self.parse_pool = None
+
+    def get_messages(self, service, executor, message_ids, batch_size, **params):
+        """
+        Retrieves message resources concurrently, one request per message or grouped into batches.
+
+        A failed item is logged and left out of the result.
+
+        Args:
+            service (Resource): The Gmail API service.
+            executor (ApiExecutor): Runs the API calls.
+            message_ids (list): IDs of the messages to retrieve.
+            batch_size (int): When set, the calls are grouped into Gmail batch requests.
+            **params: Further arguments of messages().get(), e.g. format.
+
+        Returns:
+            list: The message resources that were retrieved, in the order of message_ids.
+        """
+        if batch_size:
+            return self.get_messages_batched(service, executor, message_ids, batch_size, **params)
+
+        # Every users() call builds the resource and its methods anew, which costs more than the request.
+        messages = service.users().messages()
+        requests = {message_id: messages.get(userId='me', id=message_id, **params) for message_id in message_ids}
+        with executor.metrics.timer("gmail_stage_seconds", stage="get"):
+            results, errors = executor.execute_all(requests, QUOTA_UNITS["messages.get"])
+        executor.metrics.inc("gmail_stage_items_total", len(results), stage="get")
+        for message_id, error in errors.items():
+            logging.error(f"Error fetching email with ID {message_id}: {error}")
+        return [results[message_id] for message_id in message_ids if message_id in results]
+
+    @staticmethod
+    def get_messages_batched(service, executor, message_ids, batch_size, format="raw", **params):
+        """
+        Retrieves messages by grouping the get calls into Gmail batch requests.
+
+        A failed item is logged and left out of the result without aborting the rest of its batch.
+
+        Args:
+            service (Resource): The Gmail API service.
+            executor (ApiExecutor): Runs the batch requests.
+            message_ids (list): IDs of the messages to retrieve.
+            batch_size (int): The number of calls per batch request, capped at the Gmail limit.
+            format (str): The format of the message resources.
+            **params: Further arguments of messages().get().
+
+        Returns:
+            list: The message resources that were retrieved, in the order of message_ids.
+        """
+        batch_size = max(1, min(batch_size, GMAIL_BATCH_LIMIT))
+        resource = service.users().messages()
+        requests = {message_id: resource.get(userId='me', id=message_id, format=format, **params)
+                    for message_id in message_ids}
+        with executor.metrics.timer("gmail_stage_seconds", stage="get"):
+            messages, errors = executor.execute_batch(service, requests, QUOTA_UNITS["messages.get"], batch_size)
+        executor.metrics.inc("gmail_stage_items_total", len(messages), stage="get")
 
-            self.save_to_database(inbox_data)
+        for message_id, error in errors.items():
+            logging.error(f"Error fetching email with ID {message_id}: {error}")
 
+        return [messages[message_id] for message_id in message_ids if message_id in messages]
+
+    @staticmethod
+    def parse_message(raw_message):
+        """
+        Parses a raw Gmail message into a row for the inbox table.
+
+        The message is parsed from its bytes, so any charset is accepted. Multipart messages are
+        walked for their text/plain part, falling back to text/html.
+
+        Args:
+            raw_message (dict): The message resource returned by messages().get(format="raw").
+
+        Returns:
+            dict: The email data, or None if the message is skipped.
+        """
+        parsed_message = parse_source(base64.urlsafe_b64decode(raw_message.get("raw")))
+        return EmailFetcher.build_email(parsed_message, raw_message, extract_body(parsed_message))
+
+    @staticmethod
+    def try_parse_message(raw_message):
+        """
+        Parses a raw message like parse_message, returning the error instead of raising it, so a
+        malformed message is skipped without losing the rest of its page, also in a worker process.
+
+        Args:
+            raw_message (dict): The message resource returned by messages().get(format="raw").
+
+        Returns:
+            tuple: The email data or None, and the error message or None.
+        """
+        try:
+            return EmailFetcher.parse_message(raw_message), None
         except Exception as error:
-            logging.error(f"Error fetching emails: {error}")
+            return None, str(error) or type(error).__name__
+
+    @staticmethod
+    def parse_metadata(metadata_message):
+        """
+        Parses a message fetched with format="metadata" into a row for the inbox table, without content.
+
+        Args:
+            metadata_message (dict): The message resource returned by messages().get(format="metadata").
+
+        Returns:
+            dict: The email data, or None if the message is skipped.
+        """
+        headers = Message()
+        for header in metadata_message.get("payload", {}).get("headers", []):
+            headers[header["name"]] = header["value"]
+        return EmailFetcher.build_email(headers, metadata_message, None)
+
+    @staticmethod
+    def build_email(headers, message_resource, content):
+        """
+        Builds the inbox row of a message from its headers.
+
+        The received time comes from the Gmail internalDate, falling back to the Date header. A
+        message without either is still stored, without a date.
+
+        Args:
+            headers (Message): The message headers.
+            message_resource (dict): The Gmail message resource, for its ID, labels and internalDate.
+            content (str): The body text, or None if it was not downloaded.
+
+        Returns:
+            dict: The email data.
+        """
+        received_at = received_timestamp(header_text(headers.get("Date")), message_resource.get("internalDate"))
+        return {
+            "from_id": header_text(headers.get("From")),
+            "to_id": header_text(headers.get("To")),
+            "date": format_timestamp(received_at),
+            "received_at": received_at,
+            "message_id": message_resource.get("id"),
+            "content_type": header_text(headers.get("Content-Type")),
+            "content": content,
+            "subject": header_text(headers.get("Subject")),
+            "labels": ",".join(message_resource.get("labelIds", []))
+        }
+
+    @property
+    def store(self):
+        """
+        Returns the EmailStore for the configured database path.
+        """
+        return EmailStore(self.db_path)
 
     def create_table(self):
         """
-        Creates the inbox table in the SQLite database if it doesn't exist.
+        Creates the inbox and sync_state tables in the SQLite database if they don't exist.
         """
         try:
-            with sqlite3.connect(self.db_path) as connection:
-                cursor = connection.cursor()
-
-                # Check if the table exists
-                cursor.execute("""
-                           SELECT name FROM sqlite_master 
-                           WHERE type='table' AND name='inbox';
-                       """)
-                if cursor.fetchone() is None:
-                    cursor.execute("""
-                               CREATE TABLE inbox (
-                                   id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                   message_id TEXT,
-                                   from_id TEXT,
-                                   to_id TEXT,
-                                   date TEXT,
-                                   content_type TEXT,
-                                   content TEXT,
-                                   subject TEXT,
-                                   labels TEXT
-                               )
-                           """)
-                    connection.commit()
-                cursor.close()
-
+            self.store.create_schema()
         except Exception as error:
             logging.error(f"Error creating table: {error}")
 
+    def get_checkpoint(self):
+        """
+        Reads the history checkpoint stored by the last successful sync.
+
+        Returns:
+            str: The stored historyId, or None if the mailbox has not been synced yet.
+        """
+        return self.store.get_state("history_id")
+
+    def get_retry_ids(self):
+        """
+        Reads the messages earlier syncs listed but could not store.
+
+        Returns:
+            dict: Maps each message ID to the number of syncs that failed to store it.
+        """
+        return json.loads(self.store.get_state("retry_message_ids") or "{}")
+
+    def save_checkpoint(self, history_id, retries=None):
+        """
+        Stores the history checkpoint for the next incremental sync, together with the messages
+        that sync has to retry.
+
+        Args:
+            history_id (str): The mailbox historyId the database is now in sync with.
+            retries (dict): Maps the IDs of the messages to retry to their failed attempts.
+        """
+        self.store.set_states({"history_id": history_id, "retry_message_ids": json.dumps(retries or {})})
+
     def save_to_database(self, inbox_data):
         """
         Saves the fetched email data to the SQLite database.
 
+        Rows are upserted on message_id within a single transaction, so fetching a message again
+        updates its row instead of duplicating it.
+
         Args:
             inbox_data (list): List of dictionaries containing email data.
+
+        Returns:
+            bool: True if the rows were stored, False if the write failed.
         """
         try:
-            connection = sqlite3.connect(self.db_path)
-            email_df = pd.DataFrame.from_records(inbox_data)
-            email_df.to_sql("inbox", con=connection, if_exists='append', index=False)
+            with self.metrics.timer("gmail_stage_seconds", stage="db_write"):
+                self.store.upsert_emails(inbox_data)
+            self.metrics.inc("gmail_stage_items_total", len(inbox_data), stage="db_write")
+            return True
         except Exception as error:
             logging.error(f"Error saving data to the database: {error}")
-        finally:
-            connection.close()
+            return False
 
 
 # Usage example:
 if __name__ == "__main__":
     fetcher = EmailFetcher()
-    fetcher.fetch_emails()
+    fetcher.sync_emails()
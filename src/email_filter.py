@@ -1,101 +1,227 @@
 import sqlite3
 import os
-import yaml
-import json
 import logging
-from datetime import datetime, timedelta
-from googleapiclient.discovery import build
-from src.oauth_token_manager import OAuthTokenManager
+from src.action_planner import ActionPlanner
+from src.api_executor import ApiExecutor, USER_UNITS_PER_SECOND
+from src.config_cache import load_constants
+from src.gmail_client import get_gmail_service
+from src.metrics import Metrics
+from src.email_store import BODY_COLUMN, EmailStore, LazyEmail, decompress_body
+from src.outbox_drainer import OutboxDrainer
+from src.rule_compiler import DEFAULT_MAX_PARAMETERS, MASK_BITS, RuleCompiler
+from src.rule_engine import RuleSet, load_rules, rule_hash, validate_rules
+
+# Prepared statements kept per connection; one per rule shape is reused by every rule of that shape.
+STATEMENT_CACHE_SIZE = 256
 
 
 class EmailFilter:
 
-    def __init__(self):
-        # Check and validate credentials
-        self.credentials = OAuthTokenManager().get_valid_credentials()
+    def __init__(self, max_workers=8, credentials=None, db_path=None, rules_file=None, api_endpoint=None,
+                 units_per_second=USER_UNITS_PER_SECOND, metrics_dir=None):
+        self.max_workers = max_workers
+        self.units_per_second = units_per_second
+        # When set, every run writes filter.prom and a filter.json summary there.
+        self.metrics_dir = metrics_dir
+        self.metrics = Metrics()
+        # Loaded on first use: a run without label changes to send never needs them.
+        self._credentials = credentials
+        self.api_endpoint = api_endpoint
         base_path = os.path.dirname(__file__)
         self.config_file = os.path.join(base_path, 'constants.yaml')
-        self.rules_file = os.path.join(base_path, 'rules.json')
-        self.db_path = os.path.join(base_path, 'email_db.db')
+        self.rules_file = rules_file or os.path.join(base_path, 'rules.json')
+        self.db_path = db_path or os.path.join(base_path, 'email_db.db')
+        # Opened by connect() and kept for the lifetime of the filter.
+        self.connection = None
+        self.compiler = None
+
+        # Parsed and validated once per process and file version, see config_cache.
+        self.constants = load_constants(self.config_file)
+        self.rules = load_rules(self.rules_file)
+
+    @property
+    def credentials(self):
+        """The OAuth credentials, checked and refreshed through OAuthTokenManager on first use."""
+        if self._credentials is None:
+            from src.oauth_token_manager import OAuthTokenManager
 
-        # Load constants from YAML file
-        with open(self.config_file, "r") as file:
-            self.constants = yaml.safe_load(file)
+            self._credentials = OAuthTokenManager().get_valid_credentials()
+        return self._credentials
 
-        # Load and validate rules from JSON file
-        with open(self.rules_file, "r") as file:
-            self.rules = json.load(file)
-        self._validate_rules()
+    @credentials.setter
+    def credentials(self, credentials):
+        self._credentials = credentials
 
     def _validate_rules(self):
         """Validate the rules format and criteria."""
-        for rule_name, rule_data in self.rules.items():
-            for criterion in rule_data.get("criteria", []):
-                predicate = criterion.get("predicate")
-                value = criterion.get("value")
-                if predicate in ["Greater than", "Less than"] and not value.isdigit():
-                    raise TypeError(f"Invalid value for predicate '{predicate}' in rule '{rule_name}'")
+        validate_rules(self.rules)
+
+    def connect(self):
+        """
+        Returns the connection the rules run on, opened on first use and kept for later queries,
+        so the prepared statements of the compiled rules are reused across rules and runs.
+        """
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.db_path, uri=self.db_path.startswith("file:"),
+                                              cached_statements=STATEMENT_CACHE_SIZE)
+            self.connection.create_function("body_text", 1, decompress_body, deterministic=True)
+            self.compiler = RuleCompiler(self.constants['Fields_References'], self.constants['CONDITION_SYMBOL'],
+                                         use_fts=self._has_fts_index(self.connection.cursor()),
+                                         use_store=self._has_store_schema(self.connection.cursor()))
+        return self.connection
+
+    def close(self):
+        """Close the database connection."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
     def search_emails(self, predicate, conditions):
         """Search emails in the database based on given criteria."""
-        query_conditions = self._form_query_conditions(predicate, conditions)
+        cursor = self.connect().cursor()
+        query_conditions, parameters = self._form_query_conditions(predicate, conditions)
+        cursor.execute(f"SELECT message_id FROM inbox WHERE {query_conditions}", parameters)
+
+        return [dict(zip([col[0] for col in cursor.description], row)) for row in cursor.fetchall()]
+
+    def search_rules(self, rules):
+        """
+        Evaluate a rule set: rules an index can answer run as their own statement, all others
+        together in a single pass over the inbox. Each statement is timed in gmail_rule_query_seconds,
+        labeled with the rule name when it evaluates a single rule and with "scan" otherwise.
+
+        Args:
+            rules (dict): The rules loaded from rules.json.
+
+        Returns:
+            list: A (message_id, rule_name) pair for every rule a message matches. The pairs of a
+            message follow each other in rule order.
+        """
+        positions = {name: position for position, name in enumerate(rules)}
+        matched = {}
+        cursor = self.connect().cursor()
+        for sql, parameters, names in self.compiler.compile_rule_set(rules, self._max_parameters()):
+            with self.metrics.timer("gmail_rule_query_seconds", rule=names[0] if len(names) == 1 else "scan"):
+                rows = cursor.execute(sql, parameters).fetchall()
+            for message_id, *masks in rows:
+                found = matched.setdefault(message_id, [])
+                for index, mask in enumerate(masks):
+                    while mask:
+                        bit = mask & -mask
+                        found.append(names[index * MASK_BITS + bit.bit_length() - 1])
+                        mask ^= bit
+        return [(message_id, name) for message_id, found in matched.items()
+                for name in sorted(found, key=positions.get)]
+
+    def _max_parameters(self):
+        """Return the number of host parameters SQLite accepts per statement."""
+        getlimit = getattr(self.connection, "getlimit", None)
+        return getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) if getlimit else DEFAULT_MAX_PARAMETERS
 
-        # Establish SQLite connection and execute query
-        connection = sqlite3.connect(self.db_path)
-        cursor = connection.cursor()
-        cursor.execute(f"SELECT message_id FROM inbox WHERE {query_conditions}")
+    @staticmethod
+    def _has_fts_index(cursor):
+        """Check whether the database carries the inbox_fts full-text index."""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'inbox_fts'")
+        return cursor.fetchone() is not None
 
-        emails = [dict(zip([col[0] for col in cursor.description], row)) for row in cursor.fetchall()]
-        connection.close()
-        return emails
+    @staticmethod
+    def _has_store_schema(cursor):
+        """Check whether the database carries the message_labels and email_bodies tables of EmailStore."""
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' "
+                       "AND name IN ('message_labels', 'email_bodies')")
+        return cursor.fetchone()[0] == 2
 
     def _form_query_conditions(self, predicate, conditions):
-        """Formulate SQL query conditions based on provided criteria."""
-        query_parts = []
-
-        for condition in conditions:
-            field_name = self.constants['Fields_References'].get(condition['field_name'])
-            predicate_symbol = self.constants['CONDITION_SYMBOL'].get(condition['predicate'])
-
-            if condition['field_name'] == "Date Received":
-                date_range = self._get_date_range(condition['predicate'], int(condition['value']))
-                query_parts.append(f"{field_name} BETWEEN '{date_range[0]}' AND '{date_range[1]}'")
-            else:
-                condition_value = condition['value']
-                if predicate_symbol == 'LIKE':
-                    query_parts.append(f"{field_name} {predicate_symbol} '%{condition_value}%'")
+        """
+        Formulate the SQL condition and its bound parameters for the given criteria.
+        """
+        self.connect()
+        return self.compiler.compile(predicate, conditions)
+
+    def match_emails_indexed(self, planner):
+        """
+        Evaluate every rule in a single pass over the inbox through the rule index and add the
+        actions of the matching rules to the planner.
+        """
+        rule_set = RuleSet(self.rules, self.constants['Fields_References'])
+
+        cursor = self.connect().cursor()
+        inbox_columns = {row[1] for row in cursor.execute("PRAGMA table_info(inbox)")}
+        columns = sorted(set(self.constants['Fields_References'].values()) & inbox_columns - {BODY_COLUMN})
+        # Bodies are only read, and only decompressed on access, when a rule refers to the message. A
+        # migrated database keeps the emptied legacy content column, so the bodies table decides.
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'email_bodies'")
+        join_bodies = rule_set.needs_body and cursor.fetchone() is not None
+
+        if join_bodies:
+            cursor.execute(f"SELECT i.message_id, {', '.join('i.' + column for column in columns)}, b.body "
+                           f"FROM inbox i LEFT JOIN email_bodies b ON b.message_id = i.message_id")
+        else:
+            if rule_set.needs_body:
+                columns.append(BODY_COLUMN)
+            cursor.execute(f"SELECT message_id, {', '.join(columns)} FROM inbox")
+
+        names = ["message_id"] + columns
+        with self.metrics.timer("gmail_rule_query_seconds", rule="indexed"):
+            for row in cursor:
+                if join_bodies:
+                    email = LazyEmail(zip(names, row[:-1]), row[-1])
                 else:
-                    query_parts.append(f"{field_name} {predicate_symbol} '{condition_value}'")
-
-        return " AND ".join(query_parts) if predicate == "All" else " OR ".join(query_parts)
-
-    @staticmethod
-    def _get_date_range(predicate, value):
-        """Calculate date range based on the predicate and value."""
-        current_date = datetime.now()
-        if predicate == "Greater than":
-            return current_date.strftime("%Y-%m-%d"), (current_date + timedelta(days=value)).strftime("%Y-%m-%d")
+                    email = dict(zip(names, row))
+                for rule in rule_set.plan_actions(email, planner):
+                    self.metrics.inc("gmail_rule_matches_total", rule=rule.name)
+
+    def apply_filters(self, use_index=False):
+        """
+        Apply the defined filters to the emails and modify them based on actions.
+
+        The actions of every matching rule are merged per message and enqueued in the durable
+        action outbox in one transaction, then drain workers send them through batchModify, one
+        call per distinct label change. Changes the stored labels already reflect, and actions of
+        rules journaled as applied to a message, are not enqueued, so a run over an unchanged inbox
+        makes no modify calls and a restarted run does not redo finished work. IDs that could not
+        be modified are kept in failed_message_ids; they stay in the outbox and are retried by
+        later runs.
+
+        Args:
+            use_index (bool): Match in Python through the rule index instead of the compiled SQL
+                statements, which use the database indexes and are faster for any number of rules.
+        """
+        self.metrics = Metrics()
+        planner = ActionPlanner()
+
+        if use_index:
+            self.match_emails_indexed(planner)
         else:
-            return (current_date - timedelta(days=value)).strftime("%Y-%m-%d"), current_date.strftime("%Y-%m-%d")
-
-    def apply_filters(self):
-        """Apply the defined filters to the emails and modify them based on actions."""
-        service = build('gmail', 'v1', credentials=self.credentials)
-
-        for rule_name, rule_data in self.rules.items():
-            filtered_emails = self.search_emails(rule_data.get("predicates"), rule_data.get("criteria"))
-
-            # Apply actions to filtered emails
-            for email in filtered_emails:
-                for action in rule_data.get("action", []):
-                    try:
-                        service.users().messages().modify(
-                            userId='me',
-                            id=email["message_id"],
-                            body={"addLabelIds": action.get('addLabelIds', []), "removeLabelIds": action.get("removeLabelIds", [])}
-                        ).execute()
-                    except Exception as error:
-                        logging.error(f"Error modifying email with ID {email['message_id']}: {error}")
+            matches = self.search_rules(self.rules)
+
+            hashes = {rule_name: rule_hash(rule_data) for rule_name, rule_data in self.rules.items()}
+            for message_id, rule_name in matches:
+                self.metrics.inc("gmail_rule_matches_total", rule=rule_name)
+                for action in self.rules[rule_name].get("action", []):
+                    planner.add(message_id, action.get('addLabelIds', []), action.get("removeLabelIds", []),
+                                hashes[rule_name])
+
+        store = EmailStore(self.db_path)
+        store.create_schema()
+        store.prune_applied_rules([rule_hash(rule_data) for rule_data in self.rules.values()])
+        self.metrics.inc("gmail_modify_skipped_total", planner.skip_applied(store))
+        planner.enqueue(store)
+
+        self.failed_message_ids = []
+        if store.count_actions()["pending"]:
+            service = get_gmail_service(self.credentials, self.api_endpoint)
+            with ApiExecutor(credentials=self.credentials, max_workers=self.max_workers,
+                             units_per_second=self.units_per_second, metrics=self.metrics) as executor:
+                self.failed_message_ids = OutboxDrainer(store, executor).drain(service)
+        if self.failed_message_ids:
+            logging.error(f"Failed to modify emails with IDs: {', '.join(self.failed_message_ids)}")
+
+        if self.metrics_dir:
+            try:
+                self.metrics.export(self.metrics_dir, "filter")
+            except Exception as error:
+                logging.error(f"Error writing metrics: {error}")
 
         return True
 
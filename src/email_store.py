@@ -0,0 +1,761 @@
+import sqlite3
+import time
+import zlib
+from contextlib import contextmanager
+
+# Message bodies are kept compressed in email_bodies instead of this table.
+INBOX_COLUMNS = ("message_id", "from_id", "to_id", "date", "received_at", "content_type", "subject", "labels")
+
+# Columns mirrored into the inbox_fts trigram index for substring searches.
+FTS_COLUMNS = ("subject", "from_id", "to_id")
+
+# The rule field that refers to the message body.
+BODY_COLUMN = "content"
+
+# The trigram tokenizer can only serve LIKE patterns with at least this many characters.
+TRIGRAM_LENGTH = 3
+
+# The inbox column holding the comma separated label IDs, mirrored row by row into message_labels.
+LABELS_COLUMN = "labels"
+
+# The number of message IDs bound to one IN (...) list, below SQLite's host parameter limit.
+IN_CLAUSE_LIMIT = 500
+
+
+def split_labels(labels):
+    """
+    Splits the comma separated label IDs of the inbox labels column.
+
+    Args:
+        labels (str): The label IDs, or None.
+
+    Returns:
+        list: The label IDs.
+    """
+    return [label_id for label_id in labels.split(",") if label_id] if labels else []
+
+
+def compress_body(body):
+    """
+    Compresses a message body for storage.
+
+    Args:
+        body (str): The body text.
+
+    Returns:
+        bytes: The zlib compressed UTF-8 text.
+    """
+    return zlib.compress(body.encode("UTF-8"))
+
+
+def decompress_body(blob):
+    """
+    Restores a body stored by compress_body.
+
+    Args:
+        blob (bytes): The compressed body, or None.
+
+    Returns:
+        str: The body text, or None if there is no body.
+    """
+    return zlib.decompress(blob).decode("UTF-8") if blob is not None else None
+
+
+def body_match_phrase(value):
+    """
+    Builds the body_fts query that matches a substring of the body.
+
+    Args:
+        value (str): The substring, at least TRIGRAM_LENGTH characters long.
+
+    Returns:
+        str: An FTS5 phrase query on the body column.
+    """
+    escaped = value.replace('"', '""')
+    return f'body:"{escaped}"'
+
+
+def trigram_supported(connection):
+    """
+    Checks whether SQLite provides FTS5 with the trigram tokenizer, which needs version 3.34.
+
+    Args:
+        connection (sqlite3.Connection): An open connection.
+
+    Returns:
+        bool: True if trigram full-text tables can be created.
+    """
+    try:
+        connection.execute("CREATE VIRTUAL TABLE temp.trigram_probe USING fts5(probe, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        return False
+    connection.execute("DROP TABLE temp.trigram_probe")
+    return True
+
+
+def has_table(connection, name):
+    """
+    Checks whether the database has a table.
+
+    Args:
+        connection (sqlite3.Connection): An open connection.
+        name (str): The table name.
+
+    Returns:
+        bool: True if the table exists.
+    """
+    return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              (name,)).fetchone() is not None
+
+
+class LazyEmail(dict):
+    """
+    An inbox row whose compressed body is only decompressed when something reads its content.
+    """
+
+    def __init__(self, row, compressed_body):
+        super().__init__(row)
+        self.compressed_body = compressed_body
+
+    def get(self, key, default=None):
+        if key == BODY_COLUMN and BODY_COLUMN not in self:
+            self[BODY_COLUMN] = decompress_body(self.compressed_body)
+        return super().get(key, default)
+
+
+class EmailStore:
+    def __init__(self, db_path):
+        """
+        Initializes the EmailStore for the SQLite database at the given path.
+
+        Args:
+            db_path (str): The path, or SQLite URI, of the database.
+        """
+        self.db_path = db_path
+
+    def connect(self):
+        """
+        Opens a connection in autocommit mode with WAL journaling, so readers are not blocked
+        by a running ingest.
+
+        Returns:
+            sqlite3.Connection: The open connection.
+        """
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None,
+                                     uri=self.db_path.startswith("file:"))
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the enclosed statements in a single write transaction that is rolled back on error.
+
+        Yields:
+            sqlite3.Connection: The connection the transaction runs on.
+        """
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            yield connection
+            connection.execute("COMMIT")
+        except Exception:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+
+    def create_schema(self):
+        """
+        Creates the tables if they don't exist and migrates databases created by older versions.
+
+        The inbox_fts and body_fts full-text indexes are only created if SQLite supports the trigram
+        tokenizer; without them, rules fall back to scanning the inbox.
+        """
+        with self.transaction() as connection:
+            fts = trigram_supported(connection)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS inbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message_id TEXT,
+                    from_id TEXT,
+                    to_id TEXT,
+                    date TEXT,
+                    received_at INTEGER,
+                    content_type TEXT,
+                    subject TEXT,
+                    labels TEXT
+                )
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+            # Journal of the rule actions already applied to a message, keyed by a hash of the rule.
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS applied_rules (
+                    message_id TEXT NOT NULL,
+                    rule_hash TEXT NOT NULL,
+                    PRIMARY KEY (message_id, rule_hash)
+                ) WITHOUT ROWID
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS email_bodies (
+                    message_id TEXT PRIMARY KEY,
+                    body BLOB
+                )
+            """)
+            if fts:
+                self._create_body_index(connection)
+            self._migrate_unique_message_id(connection)
+            self._migrate_received_at(connection)
+            self._migrate_inline_bodies(connection)
+            if fts:
+                self._create_fts_index(connection)
+            self._create_label_index(connection)
+            self._create_outbox(connection)
+
+    @staticmethod
+    def _migrate_unique_message_id(connection):
+        """
+        Makes message_id unique, keeping only the most recently stored copy of duplicated rows.
+
+        Args:
+            connection (sqlite3.Connection): A connection inside an open transaction.
+        """
+        exists = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'inbox_message_id'").fetchone()
+        if exists:
+            return
+        connection.execute("DELETE FROM inbox WHERE id NOT IN (SELECT MAX(id) FROM inbox GROUP BY message_id)")
+        connection.execute("CREATE UNIQUE INDEX inbox_message_id ON inbox (message_id)")
+
+    @staticmethod
+    def _migrate_received_at(connection):
+        """
+        Adds the received_at column, filled from the date text of rows stored by older versions,
+        and the index that turns date criteria into range scans.
+
+        Args:
+            connection (sqlite3.Connection): A connection inside an open transaction.
+        """
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(inbox)")]
+        if "received_at" not in columns:
+            connection.execute("ALTER TABLE inbox ADD COLUMN received_at INTEGER")
+            connection.execute("UPDATE inbox SET received_at = CAST(strftime('%s', date) AS INTEGER) "
+                               "WHERE date IS NOT NULL")
+        connection.execute("CREATE INDEX IF NOT EXISTS inbox_received_at ON inbox (received_at)")
+
+    @staticmethod
+    def _migrate_inline_bodies(connection):
+        """
+        Moves bodies stored in the legacy inbox.content column into email_bodies and drops the
+        inbox_fts index that covered that column, so it is rebuilt for the headers only.
+
+        Args:
+            connection (sqlite3.Connection): A connection inside an open transaction.
+        """
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(inbox)")]
+        if BODY_COLUMN not in columns:
+            return
+
+        fts_columns = []
+        if has_table(connection, "inbox_fts"):
+            fts_columns = [column[0] for column in connection.execute("SELECT * FROM inbox_fts LIMIT 0").description]
+        if BODY_COLUMN in fts_columns:
+            for trigger in ("inbox_fts_insert", "inbox_fts_delete", "inbox_fts_update"):
+                connection.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            connection.execute("DROP TABLE inbox_fts")
+
+        rows = connection.execute(f"SELECT id, message_id, {BODY_COLUMN} FROM inbox "
+                                  f"WHERE {BODY_COLUMN} IS NOT NULL").fetchall()
+        indexed = has_table(connection, "body_fts")
+        for row_id, message_id, body in rows:
+            EmailStore._insert_body(connection, row_id, message_id, body, indexed)
+        connection.execute(f"UPDATE inbox SET {BODY_COLUMN} = NULL WHERE {BODY_COLUMN} IS NOT NULL")
+
+    @staticmethod
+    def _insert_body(connection, row_id, message_id, body, indexed):
+        """
+        Stores the compressed body of a message and indexes it, unless the body is already stored.
+
+        Args:
+            connection (sqlite3.Connection): A connection inside an open transaction.
+            row_id (int): The inbox row ID of the message.
+            message_id (str): The Gmail message ID.
+            body (str): The body text.
+            indexed (bool): Whether the database has the body_fts index.
+        """
+        cursor = connection.execute("INSERT OR IGNORE INTO email_bodies (message_id, body) VALUES (?, ?)",
+                                    (message_id, compress_body(body)))
+        if cursor.rowcount and indexed:
+            connection.execute("INSERT INTO body_fts (rowid, body) VALUES (?, ?)", (row_id, body))
+
+    @staticmethod
+    def _create_body_index(connection):
+        """
+        Creates the body_fts index, indexing the bodies already stored when the index is new, e.g.
+        on a database created while SQLite lacked the trigram tokenizer.
+
+        Args:
+            connection (sqlite3.Connection): A connection inside an open transaction, after
+                email_bodies was created.
+        """
+        if has_table(connection, "body_fts"):
+            return
+        # Bodies never change once stored, so a contentless index fed at ingest is enough.
+        connection.execute("CREATE VIRTUAL TABLE body_fts USING fts5(body, content='', tokenize='trigram')")
+        rows = connection.execute("SELECT i.id, b.body FROM email_bodies b "
+                                  "JOIN inbox i ON i.message_id = b.message_id").fetchall()
+        connection.executemany("INSERT INTO body_fts (rowid, body) VALUES (?, ?)",
+                                [(row_id, decompress_body(body)) for row_id, body in rows])
+
+    @staticmethod
+    def _create_fts_index(connection):
+        """
+        Creates the inbox_fts index and the triggers that keep it in sync with the inbox table,
+        indexing the rows already stored when the index is new.
+
+        Args:
+            connection (sqlite3.Connection): A connection inside an open transaction.
+        """
+        if has_table(connection, "inbox_fts"):
+            return
+
+        columns = ", ".join(FTS_COLUMNS)
+        new_values = ", ".join(f"new.{column}" for column in FTS_COLUMNS)
+        old_values = ", ".join(f"old.{column}" for column in FTS_COLUMNS)
+        delete = f"INSERT INTO inbox_fts (inbox_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});"
+        insert = f"INSERT INTO inbox_fts (rowid, {columns}) VALUES (new.id, {new_values});"
+
+        connection.execute(f"CREATE VIRTUAL TABLE inbox_fts USING fts5({columns}, content='inbox', "
+                           f"content_rowid='id', tokenize='trigram')")
+        connection.execute(f"CREATE TRIGGER inbox_fts_insert AFTER INSERT ON inbox BEGIN {insert} END")
+        connection.execute(f"CREATE TRIGGER inbox_fts_delete AFTER DELETE ON inbox BEGIN {delete} END")
+        connection.execute(f"CREATE TRIGGER inbox_fts_update AFTER UPDATE ON inbox BEGIN {delete} {insert} END")
+        connection.execute("INSERT INTO inbox_fts (inbox_fts) VALUES ('rebuild')")
+
+    @staticmethod
+    def _create_label_index(connection):
+        """
+        Creates the message_labels junction table, filled from the labels column of the rows already
+        stored when the table is new. The primary key serves label lookups, the second index the
+        labels of a message.
+
+        Args:
+            connection (sqlite3.Connection): A connection inside an open transaction.
+        """
+        if has_table(connection, "message_labels"):
+            return
+
+        connection.execute("""
+            CREATE TABLE message_labels (
+                label_id TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                PRIMARY KEY (label_id, message_id)
+            ) WITHOUT ROWID
+        """)
+        connection.execute("CREATE INDEX message_labels_message_id ON message_labels (message_id)")
+        rows = connection.execute(f"SELECT message_id, {LABELS_COLUMN} FROM inbox "
+                                  f"WHERE {LABELS_COLUMN} IS NOT NULL").fetchall()
+        connection.executemany("INSERT OR IGNORE INTO message_labels (label_id, message_id) VALUES (?, ?)",
+                               [(label_id, message_id) for message_id, labels in rows
+                                for label_id in split_labels(labels)])
+
+    @staticmethod
+    def _create_outbox(connection):
+        """
+        Creates the action_outbox table holding planned label changes until Gmail has applied them.
+
+        A row is pending until a drain worker completes it (done) or gives up on it (dead). While
+        a worker works on a row it holds a lease on it; a lease that expires, e.g. because the
+        worker crashed, makes the row available again. At most one pending row exists per message.
+
+        Args:
+            connection (sqlite3.Connection): A connection inside an open transaction.
+        """
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS action_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id TEXT NOT NULL,
+                add_label_ids TEXT NOT NULL,
+                remove_label_ids TEXT NOT NULL,
+                rule_hashes TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                lease_owner TEXT,
+                lease_expires_at REAL,
+                last_error TEXT,
+                updated_at REAL
+            )
+        """)
+        connection.execute("CREATE INDEX IF NOT EXISTS action_outbox_ready ON action_outbox (status, available_at)")
+        connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS action_outbox_pending ON action_outbox (message_id) "
+                           "WHERE status = 'pending'")
+
+    def upsert_emails(self, inbox_data):
+        """
+        Inserts the emails, updating the stored row of any message that is already present.
+
+        The header fields go to the inbox table; the content field is compressed into email_bodies.
+
+        Args:
+            inbox_data (list): List of dictionaries containing email data.
+        """
+        if not inbox_data:
+            return
+        updates = ", ".join(f"{column} = excluded.{column}" for column in INBOX_COLUMNS if column != "message_id")
+        with self.transaction() as connection:
+            connection.executemany(
+                f"INSERT INTO inbox ({', '.join(INBOX_COLUMNS)}) VALUES ({', '.join('?' * len(INBOX_COLUMNS))}) "
+                f"ON CONFLICT (message_id) DO UPDATE SET {updates}",
+                [tuple(email.get(column) for column in INBOX_COLUMNS) for email in inbox_data]
+            )
+            labeled = [email for email in inbox_data if email.get(LABELS_COLUMN) is not None]
+            connection.executemany("DELETE FROM message_labels WHERE message_id = ?",
+                                   [(email["message_id"],) for email in labeled])
+            connection.executemany("INSERT OR IGNORE INTO message_labels (label_id, message_id) VALUES (?, ?)",
+                                   [(label_id, email["message_id"]) for email in labeled
+                                    for label_id in split_labels(email[LABELS_COLUMN])])
+            bodies = [email for email in inbox_data if email.get(BODY_COLUMN) is not None]
+            if bodies:
+                row_ids = self._row_ids(connection, [email["message_id"] for email in bodies])
+                indexed = has_table(connection, "body_fts")
+                for email in bodies:
+                    self._insert_body(connection, row_ids[email["message_id"]], email["message_id"],
+                                      email[BODY_COLUMN], indexed)
+
+    @staticmethod
+    def _row_ids(connection, message_ids):
+        """
+        Looks up the inbox row IDs of the given messages.
+
+        Args:
+            connection (sqlite3.Connection): An open connection.
+            message_ids (list): The Gmail message IDs.
+
+        Returns:
+            dict: Maps each message ID to its inbox row ID.
+        """
+        placeholders = ", ".join("?" * len(message_ids))
+        return dict(connection.execute(f"SELECT message_id, id FROM inbox WHERE message_id IN ({placeholders})",
+                                       message_ids).fetchall())
+
+    def apply_label_changes(self, message_ids, add_label_ids=(), remove_label_ids=()):
+        """
+        Records label changes made in Gmail, keeping message_labels and the labels column in sync.
+
+        Messages that are not stored are ignored.
+
+        Args:
+            message_ids (list): The Gmail message IDs.
+            add_label_ids (list): The labels added to the messages.
+            remove_label_ids (list): The labels removed from the messages.
+        """
+        if not message_ids:
+            return
+        with self.transaction() as connection:
+            self._apply_label_changes(connection, message_ids, add_label_ids, remove_label_ids)
+
+    @staticmethod
+    def _apply_label_changes(connection, message_ids, add_label_ids, remove_label_ids):
+        placeholders = ", ".join("?" * len(message_ids))
+        for label_id in add_label_ids:
+            connection.execute(f"INSERT OR IGNORE INTO message_labels (label_id, message_id) "
+                               f"SELECT ?, message_id FROM inbox WHERE message_id IN ({placeholders})",
+                               (label_id, *message_ids))
+        for label_id in remove_label_ids:
+            connection.execute(f"DELETE FROM message_labels WHERE label_id = ? AND message_id IN ({placeholders})",
+                               (label_id, *message_ids))
+        connection.execute(f"UPDATE inbox SET {LABELS_COLUMN} = (SELECT COALESCE(group_concat(label_id, ','), '') "
+                           f"FROM message_labels WHERE message_labels.message_id = inbox.message_id) "
+                           f"WHERE message_id IN ({placeholders})", message_ids)
+
+    def get_labels(self, message_id):
+        """
+        Loads the labels of a message.
+
+        Args:
+            message_id (str): The Gmail message ID.
+
+        Returns:
+            set: The label IDs stored for the message.
+        """
+        connection = self.connect()
+        try:
+            rows = connection.execute("SELECT label_id FROM message_labels WHERE message_id = ?",
+                                      (message_id,)).fetchall()
+        finally:
+            connection.close()
+        return {row[0] for row in rows}
+
+    def get_labels_by_message(self, message_ids):
+        """
+        Loads the labels of many messages at once.
+
+        Args:
+            message_ids (list): The Gmail message IDs.
+
+        Returns:
+            dict: Maps the ID of every stored message with known labels to the set of its label IDs.
+        """
+        labels = {}
+        connection = self.connect()
+        try:
+            for start in range(0, len(message_ids), IN_CLAUSE_LIMIT):
+                chunk = message_ids[start:start + IN_CLAUSE_LIMIT]
+                placeholders = ", ".join("?" * len(chunk))
+                for message_id, label_ids in connection.execute(
+                        f"SELECT message_id, {LABELS_COLUMN} FROM inbox "
+                        f"WHERE message_id IN ({placeholders}) AND {LABELS_COLUMN} IS NOT NULL", chunk):
+                    labels[message_id] = set(split_labels(label_ids))
+        finally:
+            connection.close()
+        return labels
+
+    def get_applied_rules(self, message_ids):
+        """
+        Loads the hashes of the rules whose actions were already applied to the messages.
+
+        Args:
+            message_ids (list): The Gmail message IDs.
+
+        Returns:
+            dict: Maps the ID of every message with journaled rules to the set of their hashes.
+        """
+        applied = {}
+        connection = self.connect()
+        try:
+            for start in range(0, len(message_ids), IN_CLAUSE_LIMIT):
+                chunk = message_ids[start:start + IN_CLAUSE_LIMIT]
+                placeholders = ", ".join("?" * len(chunk))
+                for message_id, rule_hash in connection.execute(
+                        f"SELECT message_id, rule_hash FROM applied_rules WHERE message_id IN ({placeholders})",
+                        chunk):
+                    applied.setdefault(message_id, set()).add(rule_hash)
+        finally:
+            connection.close()
+        return applied
+
+    def record_applied_rules(self, rule_hashes):
+        """
+        Journals the rules whose actions have been applied.
+
+        Args:
+            rule_hashes (dict): Maps message IDs to the hashes of the rules applied to them.
+        """
+        with self.transaction() as connection:
+            self._record_applied_rules(connection, rule_hashes)
+
+    @staticmethod
+    def _record_applied_rules(connection, rule_hashes):
+        connection.executemany("INSERT OR IGNORE INTO applied_rules (message_id, rule_hash) VALUES (?, ?)",
+                               [(message_id, rule_hash) for message_id, hashes in rule_hashes.items()
+                                for rule_hash in hashes])
+
+    def prune_applied_rules(self, rule_hashes):
+        """
+        Drops the journal entries of rules that have changed or no longer exist.
+
+        Args:
+            rule_hashes (list): The hashes of the current rules.
+        """
+        placeholders = ", ".join("?" * len(rule_hashes))
+        with self.transaction() as connection:
+            connection.execute(f"DELETE FROM applied_rules WHERE rule_hash NOT IN ({placeholders})",
+                               list(rule_hashes))
+
+    def enqueue_actions(self, actions, applied_rules=None):
+        """
+        Adds planned label changes to the outbox in a single transaction.
+
+        A pending row of the same message is replaced by a different plan, unless a worker holds a
+        lease on it. A pending row with the same plan keeps its attempts and retry time, and a plan
+        already dead-lettered is not enqueued again, so a change that keeps failing is backed off and
+        given up however often it is planned.
+
+        Args:
+            actions (list): (message_id, add_label_ids, remove_label_ids, rule_hashes) tuples.
+            applied_rules (dict): Maps the IDs of messages that need no change to the hashes of
+                their rules, journaled as applied in the same transaction.
+
+        Returns:
+            int: The number of actions enqueued.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            # The WHERE clause also keeps SQLite from reading ON CONFLICT as part of the SELECT.
+            connection.executemany("""
+                INSERT INTO action_outbox (message_id, add_label_ids, remove_label_ids, rule_hashes, available_at,
+                                           updated_at)
+                SELECT ?1, ?2, ?3, ?4, ?5, ?5
+                WHERE NOT EXISTS (SELECT 1 FROM action_outbox WHERE message_id = ?1 AND status = 'dead'
+                                  AND add_label_ids = ?2 AND remove_label_ids = ?3 AND rule_hashes = ?4)
+                ON CONFLICT (message_id) WHERE status = 'pending' DO UPDATE SET
+                    add_label_ids = excluded.add_label_ids, remove_label_ids = excluded.remove_label_ids,
+                    rule_hashes = excluded.rule_hashes, attempts = 0, available_at = excluded.available_at,
+                    last_error = NULL, updated_at = excluded.updated_at
+                WHERE (lease_expires_at IS NULL OR lease_expires_at <= excluded.available_at)
+                    AND (add_label_ids IS NOT excluded.add_label_ids
+                         OR remove_label_ids IS NOT excluded.remove_label_ids
+                         OR rule_hashes IS NOT excluded.rule_hashes)
+            """, [(message_id, ",".join(sorted(add_label_ids)), ",".join(sorted(remove_label_ids)),
+                   ",".join(sorted(rule_hashes)), now)
+                  for message_id, add_label_ids, remove_label_ids, rule_hashes in actions])
+            if applied_rules:
+                self._record_applied_rules(connection, applied_rules)
+        return len(actions)
+
+    def claim_actions(self, owner, limit, lease_seconds):
+        """
+        Leases the oldest pending actions that are due and not leased by another worker.
+
+        Args:
+            owner (str): Identifies the claiming worker.
+            limit (int): The maximum number of actions claimed.
+            lease_seconds (float): How long the worker may hold the actions before others can claim them.
+
+        Returns:
+            list: One dict per claimed action with its id, message_id, add_label_ids and
+            remove_label_ids tuples, rule_hashes list and attempts so far.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            rows = connection.execute("""
+                SELECT id, message_id, add_label_ids, remove_label_ids, rule_hashes, attempts FROM action_outbox
+                WHERE status = 'pending' AND available_at <= ? AND (lease_expires_at IS NULL OR lease_expires_at <= ?)
+                ORDER BY id LIMIT ?
+            """, (now, now, limit)).fetchall()
+            connection.executemany("UPDATE action_outbox SET lease_owner = ?, lease_expires_at = ? WHERE id = ?",
+                                   [(owner, now + lease_seconds, row[0]) for row in rows])
+        return [{"id": action_id, "message_id": message_id, "add_label_ids": tuple(split_labels(add_label_ids)),
+                 "remove_label_ids": tuple(split_labels(remove_label_ids)), "rule_hashes": split_labels(rule_hashes),
+                 "attempts": attempts}
+                for action_id, message_id, add_label_ids, remove_label_ids, rule_hashes, attempts in rows]
+
+    def complete_actions(self, owner, actions):
+        """
+        Marks claimed actions as done, recording their label changes and rules in the same transaction.
+
+        Args:
+            owner (str): The worker holding the lease.
+            actions (list): The claimed actions Gmail has applied.
+        """
+        if not actions:
+            return
+        groups = {}
+        for action in actions:
+            groups.setdefault((action["add_label_ids"], action["remove_label_ids"]), []).append(action["message_id"])
+        with self.transaction() as connection:
+            connection.executemany("UPDATE action_outbox SET status = 'done', lease_owner = NULL, "
+                                   "lease_expires_at = NULL, updated_at = ? WHERE id = ? AND lease_owner = ?",
+                                   [(time.time(), action["id"], owner) for action in actions])
+            for (add_label_ids, remove_label_ids), message_ids in groups.items():
+                for start in range(0, len(message_ids), IN_CLAUSE_LIMIT):
+                    self._apply_label_changes(connection, message_ids[start:start + IN_CLAUSE_LIMIT],
+                                              add_label_ids, remove_label_ids)
+            self._record_applied_rules(connection, {action["message_id"]: action["rule_hashes"]
+                                                    for action in actions})
+
+    def fail_actions(self, owner, failures, error):
+        """
+        Releases claimed actions that failed, either to be retried later or as dead letters.
+
+        Args:
+            owner (str): The worker holding the lease.
+            failures (list): (action, retry_at) tuples; retry_at is the Unix time of the next
+                attempt, or None to give the action up.
+            error (str): The error, kept for inspection.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            connection.executemany("""
+                UPDATE action_outbox SET status = ?, attempts = attempts + 1, available_at = ?, last_error = ?,
+                    lease_owner = NULL, lease_expires_at = NULL, updated_at = ?
+                WHERE id = ? AND lease_owner = ?
+            """, [("pending" if retry_at is not None else "dead", retry_at if retry_at is not None else now,
+                   error, now, action["id"], owner) for action, retry_at in failures])
+
+    def count_actions(self):
+        """
+        Counts the outbox rows per status.
+
+        Returns:
+            dict: Maps "pending", "done" and "dead" to the number of rows.
+        """
+        connection = self.connect()
+        try:
+            counts = dict(connection.execute("SELECT status, COUNT(*) FROM action_outbox GROUP BY status"))
+        finally:
+            connection.close()
+        return {status: counts.get(status, 0) for status in ("pending", "done", "dead")}
+
+    def purge_done_actions(self, before):
+        """
+        Deletes the done actions completed before the given time.
+
+        Args:
+            before (float): The Unix time up to which done rows are deleted.
+        """
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM action_outbox WHERE status = 'done' AND updated_at < ?", (before,))
+
+    def get_body(self, message_id):
+        """
+        Loads the body of a message.
+
+        Args:
+            message_id (str): The Gmail message ID.
+
+        Returns:
+            str: The body text, or None if no body is stored.
+        """
+        connection = self.connect()
+        try:
+            row = connection.execute("SELECT body FROM email_bodies WHERE message_id = ?", (message_id,)).fetchone()
+        finally:
+            connection.close()
+        return decompress_body(row[0]) if row else None
+
+    def get_state(self, key):
+        """
+        Reads a value from the sync_state table.
+
+        Args:
+            key (str): The state key.
+
+        Returns:
+            str: The stored value, or None if the key is not set.
+        """
+        connection = self.connect()
+        try:
+            row = connection.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        finally:
+            connection.close()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        """
+        Stores a value in the sync_state table.
+
+        Args:
+            key (str): The state key.
+            value (str): The value to store.
+        """
+        self.set_states({key: value})
+
+    def set_states(self, values):
+        """
+        Stores several values in the sync_state table in one transaction.
+
+        Args:
+            values (dict): Maps state keys to the values to store.
+        """
+        with self.transaction() as connection:
+            connection.executemany("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+                                   [(key, str(value)) for key, value in values.items()])
@@ -0,0 +1,229 @@
+import argparse
+import logging
+import queue
+import signal
+import threading
+
+from src.action_planner import ActionPlanner
+from src.api_executor import ApiExecutor, QUOTA_UNITS
+from src.email_fetcher import EmailFetcher
+from src.gmail_client import get_gmail_service
+from src.oauth_token_manager import OAuthTokenManager
+
+# Marks the end of the work put on a queue.
+STOP = object()
+
+
+class EmailWatcher:
+    def __init__(self, fetcher, token_manager=None, min_interval=10.0, max_interval=300.0, backoff_factor=2.0,
+                 queue_size=4, page_size=100, batch_size=None, metadata_first=False):
+        """
+        Initializes a watcher that keeps one process polling the inbox and labeling new mail.
+
+        New messages flow through three stages connected by bounded queues: the polling thread
+        downloads and stores them, an evaluation thread matches them against the rules, and an
+        action thread applies the label changes. A full queue blocks the stage before it, so a slow
+        stage throttles the fetch instead of piling up pages in memory.
+
+        Args:
+            fetcher (EmailFetcher): Provides the credentials, database and rules.
+            token_manager (OAuthTokenManager): When given, the credentials are re-validated before every
+                poll, so a long-running process keeps a fresh token.
+            min_interval (float): The seconds between polls while mail is arriving.
+            max_interval (float): The upper bound of the seconds between polls of an idle mailbox.
+            backoff_factor (float): How much the interval grows after every poll that found no mail.
+            queue_size (int): The number of pages each queue holds before the stage feeding it blocks.
+            page_size (int): The number of message IDs requested per page.
+            batch_size (int): When set, messages are retrieved through Gmail batch requests.
+            metadata_first (bool): Downloads the full message only for emails a "Message" rule could match.
+        """
+        self.fetcher = fetcher
+        self.token_manager = token_manager
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.metadata_first = metadata_first
+        self.evaluate_queue = queue.Queue(maxsize=queue_size)
+        self.action_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        # Set by a stage that lost work, so the poll does not advance the checkpoint past it.
+        self.failed_event = threading.Event()
+        self.executor = None
+
+    def stop(self, *_):
+        """
+        Asks the watcher to stop once the work in flight is done. Safe to call from a signal handler.
+        """
+        self.stop_event.set()
+
+    def install_signal_handlers(self):
+        """
+        Stops the watcher gracefully on SIGTERM and SIGINT. Only possible from the main thread.
+        """
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.stop)
+
+    def next_interval(self, interval, found):
+        """
+        Calculates the wait before the next poll.
+
+        Args:
+            interval (float): The current wait in seconds.
+            found (int): The number of new messages the last poll found.
+
+        Returns:
+            float: The minimum interval while mail arrives, otherwise the interval grown by the backoff
+            factor up to the maximum.
+        """
+        if found:
+            return self.min_interval
+        return min(self.max_interval, max(self.min_interval, interval * self.backoff_factor))
+
+    def run(self):
+        """
+        Polls until stop() is called, then drains the queued pages and returns.
+        """
+        if threading.current_thread() is threading.main_thread():
+            self.install_signal_handlers()
+
+        self.fetcher.create_table()
+        rule_set = self.fetcher.load_rule_set()
+        workers = [threading.Thread(target=self._evaluate_worker, args=(rule_set,), name="watch-evaluate"),
+                   threading.Thread(target=self._action_worker, name="watch-actions")]
+
+        with ApiExecutor(credentials=self.fetcher.creds, max_workers=self.fetcher.max_workers,
+                         units_per_second=self.fetcher.units_per_second,
+                         metrics=self.fetcher.metrics) as executor:
+            self.executor = executor
+            for worker in workers:
+                worker.start()
+            try:
+                interval = self.min_interval
+                while not self.stop_event.is_set():
+                    try:
+                        found = self.poll_once()
+                    except Exception as error:
+                        logging.error(f"Error polling for new emails: {error}")
+                        found = 0
+                    interval = self.next_interval(interval, found)
+                    self.stop_event.wait(interval)
+            finally:
+                self.evaluate_queue.put(STOP)
+                for worker in workers:
+                    worker.join()
+                self.fetcher.close_parse_pool()
+
+    def poll_once(self):
+        """
+        Fetches the messages added since the stored checkpoint and hands them to the pipeline.
+
+        The checkpoint only advances once every stored message of the poll has its label changes
+        written to the action outbox, so work cut short by a crash, a stop request or an error is
+        picked up again by the next poll. Messages that could not be downloaded or stored are kept
+        for a retry like in EmailFetcher.sync_emails, and label changes that fail stay in the outbox;
+        both are retried by the following polls.
+
+        Returns:
+            int: The number of new messages found.
+        """
+        executor = self.executor
+        if self.token_manager:
+            self.fetcher.creds = executor.credentials = self.token_manager.get_valid_credentials()
+        service = get_gmail_service(self.fetcher.creds, self.fetcher.api_endpoint)
+
+        history_id = executor.execute(service.users().getProfile(userId='me'),
+                                      QUOTA_UNITS["getProfile"]).get("historyId")
+        retries = self.fetcher.get_retry_ids()
+        checkpoint = self.fetcher.get_checkpoint()
+        if checkpoint and checkpoint == history_id and not retries:
+            if self.fetcher.store.count_actions()["pending"]:
+                # Nothing new to label, but failed changes may be due for a retry.
+                self.action_queue.put(ActionPlanner())
+            return 0
+
+        self.failed_event.clear()
+        found = 0
+        failed_ids = []
+        for message_ids in self.fetcher.iter_sync_pages(service, executor, retries, self.page_size):
+            inbox_data = self.fetcher.download_emails(service, executor, message_ids, self.batch_size,
+                                                      self.metadata_first)
+            if inbox_data and not self.fetcher.save_to_database(inbox_data):
+                failed_ids.extend(message_ids)
+            else:
+                failed_ids.extend(self.fetcher.missing_ids(message_ids, inbox_data))
+                if inbox_data:
+                    self.evaluate_queue.put(inbox_data)
+            found += len(message_ids)
+            if self.stop_event.is_set():
+                return found
+
+        self.evaluate_queue.join()
+        self.action_queue.join()
+        if self.failed_event.is_set():
+            logging.error("Keeping the history checkpoint, the new emails are processed again by the next poll")
+        else:
+            self.fetcher.save_checkpoint(history_id, self.fetcher.count_retries(retries, failed_ids))
+        self.fetcher.export_metrics("watch")
+        return found
+
+    def _evaluate_worker(self, rule_set):
+        """
+        Matches each queued page against the rules and queues the resulting label changes.
+        """
+        while True:
+            inbox_data = self.evaluate_queue.get()
+            try:
+                if inbox_data is STOP:
+                    self.action_queue.put(STOP)
+                    return
+                planner = ActionPlanner()
+                for email in inbox_data:
+                    for rule in rule_set.plan_actions(email, planner):
+                        self.fetcher.metrics.inc("gmail_rule_matches_total", rule=rule.name)
+                if planner.plan:
+                    self.action_queue.put(planner)
+            except Exception as error:
+                logging.error(f"Error evaluating rules: {error}")
+                self.failed_event.set()
+            finally:
+                self.evaluate_queue.task_done()
+
+    def _action_worker(self):
+        """
+        Writes each queued plan to the action outbox and drains it through batchModify.
+        """
+        while True:
+            planner = self.action_queue.get()
+            try:
+                if planner is STOP:
+                    return
+                service = get_gmail_service(self.executor.credentials, self.fetcher.api_endpoint)
+                failed_ids = self.fetcher.apply_actions(service, self.executor, planner)
+                if failed_ids:
+                    logging.error(f"Failed to modify emails with IDs, retrying from the outbox: "
+                                  f"{', '.join(failed_ids)}")
+            except Exception as error:
+                logging.error(f"Error applying label actions: {error}")
+                self.failed_event.set()
+            finally:
+                self.action_queue.task_done()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch the Gmail inbox and apply the rules to new mail.")
+    parser.add_argument("--interval", type=float, default=10.0, help="seconds between polls while mail arrives")
+    parser.add_argument("--max-interval", type=float, default=300.0, help="longest wait while the inbox is idle")
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--metadata-first", action="store_true")
+    parser.add_argument("--metrics-dir", default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    token_manager = OAuthTokenManager()
+    watcher = EmailWatcher(EmailFetcher(credentials=token_manager.get_valid_credentials(),
+                                        metrics_dir=args.metrics_dir),
+                           token_manager=token_manager, min_interval=args.interval, max_interval=args.max_interval,
+                           batch_size=args.batch_size, metadata_first=args.metadata_first)
+    watcher.run()
@@ -0,0 +1,95 @@
+import json
+import threading
+
+# httplib2 and googleapiclient take longer to import than a filter run with nothing to modify takes
+# in total, so they are imported by the functions below on first use rather than with this module.
+
+# Seconds before an idle or stalled HTTP connection is given up.
+HTTP_TIMEOUT = 60
+
+_discovery_document = None
+_discovery_lock = threading.Lock()
+# httplib2 connections must not be shared between threads, so transports and services are per thread.
+_thread_local = threading.local()
+
+
+def get_discovery_document():
+    """
+    Loads and parses the Gmail discovery document bundled with the client library, once per process.
+
+    Returns:
+        dict: The parsed discovery document.
+    """
+    from googleapiclient.discovery_cache import get_static_doc
+
+    global _discovery_document
+    with _discovery_lock:
+        if _discovery_document is None:
+            _discovery_document = json.loads(get_static_doc("gmail", "v1"))
+        return _discovery_document
+
+
+def _thread_cache(name):
+    """
+    Returns a dictionary that belongs to the current thread.
+    """
+    cache = getattr(_thread_local, name, None)
+    if cache is None:
+        cache = {}
+        setattr(_thread_local, name, cache)
+    return cache
+
+
+def get_authorized_http(credentials):
+    """
+    Returns the authorized transport of the current thread for the credentials.
+
+    The transport keeps its connections alive, so later calls on the same thread skip the TCP and
+    TLS handshakes.
+
+    Args:
+        credentials (Credentials): The OAuth credentials.
+
+    Returns:
+        AuthorizedHttp: The transport.
+    """
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+
+    transports = _thread_cache("transports")
+    http = transports.get(id(credentials))
+    if http is None or http.credentials is not credentials:
+        http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        transports[id(credentials)] = http
+    return http
+
+
+def get_gmail_service(credentials, api_endpoint=None):
+    """
+    Returns the Gmail API service of the current thread for the credentials.
+
+    The service is built from the cached discovery document on first use and reused afterwards. An
+    api_endpoint replaces the root URL of the document as well, so batch requests go there too.
+
+    Args:
+        credentials (Credentials): The OAuth credentials.
+        api_endpoint (str): Overrides the root URL of the API, e.g. to target a local test server.
+
+    Returns:
+        Resource: The Gmail API service.
+    """
+    from googleapiclient.discovery import build_from_document
+
+    services = _thread_cache("services")
+    key = (id(credentials), api_endpoint)
+    cached = services.get(key)
+    if cached is None or cached[0] is not credentials:
+        document, client_options = get_discovery_document(), None
+        if api_endpoint:
+            document = dict(document, rootUrl=api_endpoint.rstrip("/") + "/")
+            client_options = {"api_endpoint": api_endpoint}
+        service = build_from_document(document, http=get_authorized_http(credentials),
+                                      client_options=client_options)
+        cached = (credentials, service)
+        services[key] = cached
+    return cached[1]
@@ -0,0 +1,174 @@
+import html
+import re
+from datetime import datetime, timezone
+from email.header import decode_header
+from email.parser import BytesParser
+from email.utils import parsedate_to_datetime
+
+# Bodies are cut to this many characters before they are stored.
+MAX_BODY_LENGTH = 100_000
+
+HIDDEN_ELEMENTS = re.compile(r"<(script|style|head)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+TAGS = re.compile(r"<[^>]+>")
+WHITESPACE = re.compile(r"[ \t\r\f\v]+")
+BLANK_LINES = re.compile(r"\n\s*\n+")
+# The blank line that separates the headers of a message from its body.
+HEADER_END = re.compile(rb"\r?\n\r?\n")
+
+
+def parse_source(source):
+    """
+    Parses the source of a message from its bytes, whatever their encoding.
+
+    The header block is parsed on its own. The body of a single-part message - most mail - is then
+    attached as it is, without running the MIME parser over it line by line; only multipart and
+    message/* content is parsed in full.
+
+    Args:
+        source (bytes): The RFC 2822 message.
+
+    Returns:
+        Message: The parsed message.
+    """
+    header_end = HEADER_END.search(source)
+    if header_end:
+        message = BytesParser().parsebytes(source[:header_end.end()], headersonly=True)
+        # A leftover payload means the header block held a line that is no header; the full
+        # parser decides where such a body starts.
+        if not message.get_payload() and message.get_content_maintype() not in ("multipart", "message"):
+            # The same surrogateescape text the full parser would store, so get_payload(decode=True)
+            # returns the original bytes.
+            message.set_payload(source[header_end.end():].decode("ascii", "surrogateescape"))
+            return message
+    return BytesParser().parsebytes(source)
+
+
+def header_text(value):
+    """
+    Returns a header as text.
+
+    Headers with raw 8-bit bytes, which RFC 2822 forbids but mailers send anyway, are decoded as
+    UTF-8 with undecodable bytes replaced. Encoded words are kept as they are, like every other header.
+
+    Args:
+        value (str or Header): The header value, or None.
+
+    Returns:
+        str: The header text, or None.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    return "".join(chunk.decode("utf-8", errors="replace") if isinstance(chunk, bytes) else chunk
+                   for chunk, _ in decode_header(value))
+
+
+def html_to_text(html_body):
+    """
+    Reduces an HTML body to its visible text.
+
+    Args:
+        html_body (str): The HTML source.
+
+    Returns:
+        str: The text with tags removed and entities resolved.
+    """
+    text = html.unescape(TAGS.sub(" ", HIDDEN_ELEMENTS.sub(" ", html_body)))
+    lines = (WHITESPACE.sub(" ", line).strip() for line in text.splitlines())
+    return BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+
+
+def received_timestamp(date_header, internal_date=None):
+    """
+    Determines when a message was received.
+
+    Gmail's internalDate is preferred; otherwise the Date header is parsed with its timezone, so
+    negative offsets and headers without a weekday are understood too.
+
+    Args:
+        date_header (str): The Date header, or None.
+        internal_date (str): The internalDate of the Gmail message resource in milliseconds, or None.
+
+    Returns:
+        int: The Unix time, or None if neither source can be read.
+    """
+    if internal_date:
+        try:
+            return int(internal_date) // 1000
+        except (TypeError, ValueError):
+            pass
+    if date_header:
+        try:
+            received = parsedate_to_datetime(str(date_header))
+        except (TypeError, ValueError, IndexError):
+            return None
+        if received.tzinfo is None:
+            # RFC 2822 treats -0000 as UTC with unknown origin.
+            received = received.replace(tzinfo=timezone.utc)
+        return int(received.timestamp())
+    return None
+
+
+def format_timestamp(timestamp):
+    """
+    Formats a Unix time as the YYYY-MM-DD HH:MM UTC text of the inbox date column.
+
+    Args:
+        timestamp (int): The Unix time, or None.
+
+    Returns:
+        str: The formatted time, or None.
+    """
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d %H:%M")
+
+
+def decode_part(part):
+    """
+    Decodes the transfer encoding and charset of a single MIME part.
+
+    Args:
+        part (Message): A non multipart message part.
+
+    Returns:
+        str: The decoded text; undecodable bytes are replaced.
+    """
+    payload = part.get_payload(decode=True) or b""
+    charset = part.get_content_charset() or "utf-8"
+    try:
+        return payload.decode(charset, errors="replace")
+    except LookupError:
+        return payload.decode("utf-8", errors="replace")
+
+
+def extract_body(parsed_message, max_length=MAX_BODY_LENGTH):
+    """
+    Extracts the text body of a message, walking every part of multipart messages.
+
+    The first text/plain part is used; without one, the first text/html part is converted to text.
+    Attachments are ignored.
+
+    Args:
+        parsed_message (Message): The parsed message.
+        max_length (int): The maximum number of characters kept.
+
+    Returns:
+        str: The body text, or None if the message has no text part.
+    """
+    plain_body, html_body = None, None
+    for part in parsed_message.walk():
+        if part.is_multipart() or part.get_content_disposition() == "attachment":
+            continue
+        content_type = part.get_content_type()
+        if content_type == "text/plain" and plain_body is None:
+            plain_body = decode_part(part)
+        elif content_type == "text/html" and html_body is None:
+            html_body = decode_part(part)
+
+    if plain_body is not None:
+        body = plain_body
+    elif html_body is not None:
+        body = html_to_text(html_body)
+    else:
+        return None
+    return body[:max_length]
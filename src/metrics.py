@@ -0,0 +1,232 @@
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRIC_HELP = {
+    "gmail_api_calls_total": "Gmail API calls sent, by method. Batch requests count once.",
+    "gmail_api_retries_total": "Gmail API calls retried after a retryable error, by method.",
+    "gmail_api_errors_total": "Gmail API calls or batch items that failed for good, by method.",
+    "gmail_api_call_seconds": "Latency of a single Gmail API call attempt, by method.",
+    "gmail_stage_seconds": "Time spent per page, or per call, in a pipeline stage.",
+    "gmail_stage_items_total": "Messages handled by a pipeline stage.",
+    "gmail_message_bytes_total": "Bytes of message source downloaded.",
+    "gmail_rule_query_seconds": "Time spent evaluating a rule against the database, by rule.",
+    "gmail_rule_matches_total": "Messages matched, by rule.",
+    "gmail_outbox_actions_total": "Outbox actions completed, rescheduled for a retry or dead-lettered, by status.",
+    "gmail_modify_skipped_total": "Planned label changes skipped because the stored state already reflects them.",
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Initializes an empty histogram with cumulative reporting buckets.
+
+        Args:
+            buckets (tuple): The sorted upper bounds of the buckets.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, fraction):
+        """
+        Estimates a quantile as the upper bound of the bucket it falls into.
+
+        Args:
+            fraction (float): The quantile, between 0 and 1.
+
+        Returns:
+            float: The estimate, capped at the largest observed value.
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Initializes an empty, thread safe registry of counters and latency histograms for one run.
+        """
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+
+    def inc(self, name, value=1, **labels):
+        """
+        Adds to a counter.
+
+        Args:
+            name (str): The metric name.
+            value (float): The amount added.
+            **labels: The label values of the series.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Records a value, usually a duration in seconds, in a histogram.
+
+        Args:
+            name (str): The metric name.
+            value (float): The observed value.
+            **labels: The label values of the series.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Records the duration of the with block in a histogram, also when it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def value(self, name, **labels):
+        """
+        Returns the current value of a counter, 0 if it was never incremented.
+        """
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def to_prometheus(self):
+        """
+        Renders every series in the Prometheus text exposition format.
+
+        Returns:
+            str: The exposition text.
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+
+            described = set()
+            for (name, labels), value in counters:
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+            for (name, labels), histogram in histograms:
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Summarises the run for humans and dashboards.
+
+        Returns:
+            dict: The run timing, every counter and, per histogram, its count, sum, mean, estimated
+            p50 / p95 and maximum.
+        """
+        with self.lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, []).append({"labels": dict(labels), "value": value})
+            histograms = {}
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                histograms.setdefault(name, []).append({
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 6),
+                    "mean": round(histogram.sum / histogram.count, 6) if histogram.count else 0.0,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "max": round(histogram.max, 6),
+                })
+        return {
+            "started_at": self.started_at,
+            "duration_seconds": round(time.time() - self.started_at, 3),
+            "counters": counters,
+            "histograms": histograms,
+        }
+
+    def export(self, directory, name):
+        """
+        Writes <name>.prom for the Prometheus node exporter textfile collector and <name>.json
+        with the run summary.
+
+        Both files are replaced atomically, so a scrape never reads a partial file.
+
+        Args:
+            directory (str): The output directory, created if missing.
+            name (str): The base name of the files, e.g. "fetch".
+
+        Returns:
+            tuple: The paths of the Prometheus and JSON files.
+        """
+        os.makedirs(directory, exist_ok=True)
+        prometheus_path = os.path.join(directory, f"{name}.prom")
+        summary_path = os.path.join(directory, f"{name}.json")
+        self._write_atomically(prometheus_path, self.to_prometheus())
+        self._write_atomically(summary_path, json.dumps(self.summary(), indent=2))
+        return prometheus_path, summary_path
+
+    @staticmethod
+    def _write_atomically(path, content):
+        handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".metrics-")
+        try:
+            with os.fdopen(handle, "w") as file:
+                file.write(content)
+            # mkstemp creates the file readable by its owner only; the node exporter runs as another user.
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
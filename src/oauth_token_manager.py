@@ -1,19 +1,70 @@
 import os
-import yaml
+import tempfile
+import threading
 import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from google.auth.exceptions import RefreshError, TransportError
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
+from src.config_cache import load_constants
+
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl; token refreshes are then only serialised within a process.
+    fcntl = None
+
+# Tokens are refreshed this long before they expire, so a running sync never sends an expired one.
+REFRESH_MARGIN = timedelta(minutes=5)
+
+# Credentials shared by every component of the process, keyed by token file.
+_credentials_cache = {}
+# The access token last written to each token file.
+_persisted_tokens = {}
+_cache_lock = threading.RLock()
+
+
+def clear_credentials_cache():
+    """
+    Drops the credentials shared within the process, so the next request reads the token file again.
+    """
+    with _cache_lock:
+        _credentials_cache.clear()
+        _persisted_tokens.clear()
+
+
+@contextmanager
+def token_file_lock(token_file):
+    """
+    Holds an exclusive lock next to the token file, so concurrent processes refresh and write it one at a time.
+
+    Args:
+        token_file (str): The path of the token file.
+    """
+    with open(f"{token_file}.lock", "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
 
 class OAuthTokenManager:
-    def __init__(self):
+    def __init__(self, token_file=None):
         """
         Initializes the OAuthTokenManager by loading configuration constants from file path.
+
+        Args:
+            token_file (str): The token file of the mailbox, defaults to token.json next to this module.
         """
         base_path = os.path.dirname(__file__)
         self.config_file = os.path.join(base_path, 'constants.yaml')
         self.credentials_file = os.path.join(base_path, 'client.json')
-        self.token_file = os.path.join(base_path, 'token.json')
+        self.token_file = token_file or os.path.join(base_path, 'token.json')
         self.constants = self.load_config()
 
     def load_config(self):
@@ -24,25 +75,34 @@ class OAuthTokenManager:
             dict: A dictionary containing the configuration constants.
         """
         try:
-            with open(self.config_file, "r") as file:
-                return yaml.safe_load(file)
+            return load_constants(self.config_file)
         except FileNotFoundError:
             raise RuntimeError(f"Configuration file '{self.config_file}' not found.")
-        except yaml.YAMLError as error:
-            raise RuntimeError(f"Error parsing the YAML configuration file: {error}")
+        except ValueError as error:
+            raise RuntimeError(str(error))
 
     def save_token(self, creds):
         """
         Saves the OAuth credentials to a JSON file.
 
+        The token is written to a temporary file that then replaces the token file, so readers never
+        see a partially written token.
+
         Args:
             creds (Credentials): The OAuth credentials to save.
         """
         try:
-            with open(self.token_file, "w+") as token:
-                token.write(creds.to_json())
-                return
-        except IOError as error:
+            handle, temporary_file = tempfile.mkstemp(dir=os.path.dirname(self.token_file), suffix=".tmp")
+            try:
+                with os.fdopen(handle, "w") as token:
+                    token.write(creds.to_json())
+                os.replace(temporary_file, self.token_file)
+            except BaseException:
+                os.remove(temporary_file)
+                raise
+            with _cache_lock:
+                _persisted_tokens[self.token_file] = creds.token
+        except (IOError, OSError) as error:
             raise RuntimeError(f"Error saving the token to '{self.token_file}': {error}")
 
     def generate_new_token(self):
@@ -55,7 +115,8 @@ class OAuthTokenManager:
         try:
             flow = InstalledAppFlow.from_client_secrets_file(self.credentials_file, self.constants["SCOPE"])
             creds = flow.run_local_server(port=0)
-            self.save_token(creds)
+            with token_file_lock(self.token_file):
+                self.save_token(creds)
             return True
         except Exception as error:
             logging.error(f"Error generating a new token: {error}")
@@ -65,12 +126,44 @@ class OAuthTokenManager:
         """
         Validates and retrieves the OAuth credentials. Generates a new token if none exist.
 
+        The credentials are loaded once per process and shared by every caller. They are refreshed
+        silently shortly before they expire, and a refreshed token is written back to the token file.
+
         Returns:
             Credentials: The valid OAuth credentials.
 
         Raises:
             RuntimeError: If the credentials could not be retrieved or validated.
         """
+        with _cache_lock:
+            creds = _credentials_cache.get(self.token_file)
+        if creds is None:
+            # Loading may wait for an interactive login, which must not block the other mailboxes.
+            loaded = self.load_credentials()
+            with _cache_lock:
+                creds = _credentials_cache.setdefault(self.token_file, loaded)
+                if creds is loaded:
+                    _persisted_tokens[self.token_file] = creds.token
+
+        with _cache_lock:
+            if self.needs_refresh(creds):
+                creds = self.refresh_credentials(creds)
+            elif creds.token != _persisted_tokens.get(self.token_file):
+                # The transport refreshed the shared credentials on its own; keep the file up to date.
+                with token_file_lock(self.token_file):
+                    self.save_token(creds)
+            return creds
+
+    def load_credentials(self):
+        """
+        Loads the OAuth credentials from the token file, generating a new token if none exists.
+
+        Returns:
+            Credentials: The stored OAuth credentials.
+
+        Raises:
+            RuntimeError: If the credentials could not be retrieved or loaded.
+        """
         if not os.path.exists(self.token_file):
             if not self.generate_new_token():
                 raise RuntimeError("Failed to generate a new OAuth token.")
@@ -80,4 +173,58 @@ class OAuthTokenManager:
         except Exception as error:
             raise RuntimeError(f"Error loading credentials: {error}")
 
+    @staticmethod
+    def needs_refresh(creds):
+        """
+        Checks whether the credentials are invalid or expire within the refresh margin.
+
+        Args:
+            creds (Credentials): The OAuth credentials.
+
+        Returns:
+            bool: True if the credentials should be refreshed now.
+        """
+        expiry = getattr(creds, "expiry", None)
+        if not isinstance(expiry, datetime):
+            return not creds.valid
+        # google-auth keeps expiry as a naive UTC datetime.
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return expiry - REFRESH_MARGIN <= now
+
+    def refresh_credentials(self, creds):
+        """
+        Refreshes the credentials with the refresh token and writes them back to the token file.
+
+        The refresh runs under the token file lock. A token that another process refreshed while
+        this one waited for the lock is reused instead of being refreshed again.
+
+        Args:
+            creds (Credentials): The OAuth credentials to refresh.
+
+        Returns:
+            Credentials: The refreshed OAuth credentials.
+
+        Raises:
+            RuntimeError: If the credentials could not be refreshed. A revoked or expired refresh
+                token needs a new login, which is left to the user instead of blocking a running sync.
+        """
+        with _cache_lock:
+            with token_file_lock(self.token_file):
+                if os.path.exists(self.token_file):
+                    stored = Credentials.from_authorized_user_file(self.token_file, self.constants["SCOPE"])
+                    if not self.needs_refresh(stored):
+                        creds = stored
 
+                if self.needs_refresh(creds):
+                    try:
+                        creds.refresh(Request())
+                    except RefreshError as error:
+                        raise RuntimeError(f"The OAuth token could not be refreshed, delete '{self.token_file}' "
+                                           f"and log in again: {error}")
+                    except TransportError as error:
+                        raise RuntimeError(f"Error refreshing the OAuth token: {error}")
+                    self.save_token(creds)
+
+            _credentials_cache[self.token_file] = creds
+            _persisted_tokens[self.token_file] = creds.token
+            return creds
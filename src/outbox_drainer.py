@@ -0,0 +1,144 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+from src.action_planner import BATCH_MODIFY_LIMIT
+from src.api_executor import QUOTA_UNITS
+
+
+class OutboxDrainer:
+    def __init__(self, store, executor, workers=4, claim_size=BATCH_MODIFY_LIMIT, lease_seconds=300.0,
+                 max_attempts=5, backoff_base=60.0, backoff_max=3600.0, done_retention=86400.0):
+        """
+        Initializes a pool of workers that apply the label changes waiting in the action outbox.
+
+        Every worker claims a batch of due actions under a lease, sends them through batchModify,
+        one call per label delta, and marks them done. Failed actions are retried on a later
+        drain with exponential backoff and dead-lettered after max_attempts, so a failure is never
+        silently dropped and a crashed run loses no work.
+
+        Args:
+            store (EmailStore): The store holding the outbox.
+            executor (ApiExecutor): Runs the batchModify calls and records the metrics.
+            workers (int): The number of drain threads.
+            claim_size (int): The number of actions a worker claims at once.
+            lease_seconds (float): How long a claim is held before another worker may take it over.
+            max_attempts (int): The number of failed attempts after which an action is dead-lettered.
+            backoff_base (float): The seconds before the first retry, doubled on every further attempt.
+            backoff_max (float): The upper bound of the retry delay.
+            done_retention (float): The seconds done actions are kept for inspection before purging.
+        """
+        self.store = store
+        self.executor = executor
+        self.workers = max(1, workers)
+        self.claim_size = claim_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.done_retention = done_retention
+
+    def retry_delay(self, attempts):
+        """
+        Calculates the wait before retrying an action that has failed the given number of times.
+        """
+        return min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+
+    def drain(self, service):
+        """
+        Applies every action that is due, then returns.
+
+        Actions waiting for a retry are left for a later drain rather than waited for.
+
+        Args:
+            service (Resource): The Gmail API service the batchModify requests are built with.
+
+        Returns:
+            list: The IDs of the messages whose action failed during this drain.
+        """
+        failed_ids = []
+        lock = threading.Lock()
+        threads = [threading.Thread(target=self._drain_worker, args=(service, failed_ids, lock),
+                                    name=f"outbox-drain-{number}")
+                   for number in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        try:
+            self.store.purge_done_actions(time.time() - self.done_retention)
+        except Exception as error:
+            logging.error(f"Error purging done actions: {error}")
+        return failed_ids
+
+    def _drain_worker(self, service, failed_ids, lock):
+        owner = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+        while True:
+            try:
+                actions = self.store.claim_actions(owner, self.claim_size, self.lease_seconds)
+                if not actions:
+                    return
+                failed = self.process(service, owner, actions)
+            except Exception as error:
+                # The leases expire, so a later drain picks the claimed actions up again.
+                logging.error(f"Error draining the action outbox: {error}")
+                return
+            with lock:
+                failed_ids.extend(failed)
+
+    def process(self, service, owner, actions):
+        """
+        Sends claimed actions through batchModify and records the outcome of each call.
+
+        Args:
+            service (Resource): The Gmail API service.
+            owner (str): The worker holding the lease on the actions.
+            actions (list): The claimed actions.
+
+        Returns:
+            list: The IDs of the messages whose action failed.
+        """
+        groups = {}
+        for action in actions:
+            groups.setdefault((action["add_label_ids"], action["remove_label_ids"]), []).append(action)
+        chunks = [group[start:start + BATCH_MODIFY_LIMIT]
+                  for group in groups.values() for start in range(0, len(group), BATCH_MODIFY_LIMIT)]
+
+        requests, errors = {}, {}
+        for index, chunk in enumerate(chunks):
+            try:
+                requests[index] = service.users().messages().batchModify(userId='me', body={
+                    "ids": [action["message_id"] for action in chunk],
+                    "addLabelIds": list(chunk[0]["add_label_ids"]),
+                    "removeLabelIds": list(chunk[0]["remove_label_ids"]),
+                })
+            except Exception as error:
+                errors[index] = error
+
+        metrics = self.executor.metrics
+        with metrics.timer("gmail_stage_seconds", stage="modify"):
+            _, execute_errors = self.executor.execute_all(requests, QUOTA_UNITS["messages.batchModify"])
+        errors.update(execute_errors)
+
+        completed = [action for index, chunk in enumerate(chunks) if index not in errors for action in chunk]
+        self.store.complete_actions(owner, completed)
+        metrics.inc("gmail_stage_items_total", len(completed), stage="modify")
+        metrics.inc("gmail_outbox_actions_total", len(completed), status="done")
+
+        failed_ids = []
+        now = time.time()
+        for index, error in sorted(errors.items()):
+            chunk = chunks[index]
+            logging.error(f"Error modifying {len(chunk)} emails: {error}")
+            failures = []
+            for action in chunk:
+                attempts = action["attempts"] + 1
+                retry_at = now + self.retry_delay(attempts) if attempts < self.max_attempts else None
+                failures.append((action, retry_at))
+                metrics.inc("gmail_outbox_actions_total", status="retry" if retry_at is not None else "dead")
+            self.store.fail_actions(owner, failures, str(error))
+            failed_ids.extend(action["message_id"] for action in chunk)
+        return failed_ids
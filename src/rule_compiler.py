@@ -0,0 +1,188 @@
+from src.email_store import BODY_COLUMN, FTS_COLUMNS, TRIGRAM_LENGTH, body_match_phrase
+from src.rule_engine import LABEL_PREDICATES, get_date_range
+
+# SQLite's default limit on the host parameters of one statement before version 3.32.
+DEFAULT_MAX_PARAMETERS = 999
+
+# The number of rules whose matches are packed into one integer column of a scan.
+MASK_BITS = 62
+
+
+class RuleCompiler:
+    def __init__(self, field_references, condition_symbols, use_fts=False, use_store=None):
+        """
+        Initializes a compiler that turns rules into SQL with bound parameters.
+
+        Rule values are never interpolated into the SQL, so any value is safe to use and rules
+        of the same shape - the same fields and predicates, differing only in their values -
+        compile to the same statement text. The SQL of every shape is built once and cached,
+        and SQLite's statement cache reuses the prepared statement for it.
+
+        Args:
+            field_references (dict): Maps rule field names to inbox columns.
+            condition_symbols (dict): Maps rule predicates to SQL operators.
+            use_fts (bool): The database has the inbox_fts and body_fts trigram indexes, which
+                Contains criteria go through.
+            use_store (bool): The database has the EmailStore schema: Message criteria read the
+                compressed email_bodies table and label criteria look up the message_labels table.
+                Defaults to use_fts.
+        """
+        self.field_references = field_references
+        self.condition_symbols = condition_symbols
+        self.use_fts = use_fts
+        self.use_store = use_fts if use_store is None else use_store
+        self.statements = {}
+
+    def _shape(self, criterion):
+        """
+        Describes what the SQL of a criterion depends on besides its value.
+        """
+        column = self.field_references.get(criterion["field_name"])
+        symbol = self.condition_symbols.get(criterion["predicate"])
+        indexed = (self.use_fts and symbol in ("LIKE", "NOT LIKE") and len(criterion["value"]) >= TRIGRAM_LENGTH
+                   and (column in FTS_COLUMNS or column == BODY_COLUMN))
+        return criterion["field_name"], criterion["predicate"], indexed
+
+    def _criterion_sql(self, field_name, predicate, indexed):
+        column = self.field_references.get(field_name)
+        symbol = self.condition_symbols.get(predicate)
+
+        if field_name == "Date Received":
+            # A range on the indexed epoch column is answered by an index range scan.
+            return f"({column} >= ? AND {column} < ?)"
+        if predicate in LABEL_PREDICATES:
+            if not self.use_store:
+                return f"(',' || {column} || ',') {'LIKE' if LABEL_PREDICATES[predicate] else 'NOT LIKE'} ?"
+            # The message_labels primary key finds the messages carrying a label without scanning the inbox.
+            matches = "SELECT message_id FROM message_labels WHERE label_id = ?"
+            if LABEL_PREDICATES[predicate]:
+                return f"message_id IN ({matches})"
+            # Like the other negative criteria, Lacks label never matches a message without stored labels.
+            return f"({column} IS NOT NULL AND message_id NOT IN ({matches}))"
+        if self.use_store and column == BODY_COLUMN:
+            if indexed:
+                matches = "SELECT rowid FROM body_fts WHERE body_fts MATCH ?"
+                if symbol == "LIKE":
+                    return f"id IN ({matches})"
+                return f"(message_id IN (SELECT message_id FROM email_bodies) AND id NOT IN ({matches}))"
+            # Any other comparison decompresses only the bodies it has to look at.
+            return f"message_id IN (SELECT message_id FROM email_bodies WHERE body_text(body) {symbol} ?)"
+        if indexed:
+            # The inbox_fts trigram index answers the substring match without scanning the inbox.
+            matches = f"SELECT rowid FROM inbox_fts WHERE inbox_fts.{column} LIKE ?"
+            if symbol == "LIKE":
+                return f"id IN ({matches})"
+            # NOT LIKE never matches a NULL field, so neither may the index lookup.
+            return f"({column} IS NOT NULL AND id NOT IN ({matches}))"
+        return f"{column} {symbol} ?"
+
+    def _criterion_parameters(self, criterion, indexed):
+        field_name, predicate, value = criterion["field_name"], criterion["predicate"], criterion["value"]
+        if field_name == "Date Received":
+            return list(get_date_range(predicate, int(value)))
+        if predicate in LABEL_PREDICATES:
+            return [value] if self.use_store else [f"%,{value},%"]
+        if indexed and self.field_references.get(field_name) == BODY_COLUMN:
+            return [body_match_phrase(value)]
+        if self.condition_symbols.get(predicate) in ("LIKE", "NOT LIKE"):
+            return [f"%{value}%"]
+        return [value]
+
+    def compile(self, predicate, criteria):
+        """
+        Compiles the criteria of a rule into a condition.
+
+        Args:
+            predicate (str): "All" if every criterion has to match, otherwise any of them.
+            criteria (list): The criteria of the rule.
+
+        Returns:
+            tuple: The SQL condition and the list of its parameters. A rule without criteria
+            matches every message for "All" and none for "Any", like its in-memory evaluation.
+        """
+        shapes = tuple(self._shape(criterion) for criterion in criteria)
+        key = (predicate == "All", shapes)
+        sql = self.statements.get(key)
+        if sql is None:
+            parts = [self._criterion_sql(*shape) for shape in shapes]
+            if not parts:
+                sql = "1" if predicate == "All" else "0"
+            else:
+                sql = " AND ".join(parts) if predicate == "All" else " OR ".join(parts)
+            self.statements[key] = sql
+
+        parameters = []
+        for criterion, (_, _, indexed) in zip(criteria, shapes):
+            parameters.extend(self._criterion_parameters(criterion, indexed))
+        return sql, parameters
+
+    def _anchored(self, predicate, shapes):
+        """
+        Checks whether an index finds every message a rule can match, so the rule is cheaper to run
+        as its own statement than inside a scan of the whole inbox.
+        """
+        def indexed(field_name, criterion_predicate, uses_fts):
+            return (field_name == "Date Received" or (self.use_store and criterion_predicate == "Has label")
+                    or (uses_fts and self.condition_symbols.get(criterion_predicate) == "LIKE"))
+
+        if not shapes:
+            return False
+        if predicate == "All":
+            return any(indexed(*shape) for shape in shapes)
+        return all(indexed(*shape) for shape in shapes)
+
+    def compile_rule_set(self, rules, max_parameters=DEFAULT_MAX_PARAMETERS):
+        """
+        Compiles a rule set into the statements that find the messages each rule matches.
+
+        Rules an index can answer get a statement of their own. All the other rules would each
+        need a full scan of the inbox, so they are evaluated together in a single scan instead;
+        they are only split over several scans when their parameters exceed max_parameters.
+
+        Every statement returns (message_id, mask, ...) rows for the messages matching at least one
+        of its rules, where bit i of mask k is set if the rule at position k * MASK_BITS + i matched.
+
+        Args:
+            rules (dict): The rules loaded from rules.json.
+            max_parameters (int): The number of host parameters SQLite accepts per statement.
+
+        Returns:
+            list: (sql, parameters, rule_names) tuples, one per statement.
+        """
+        statements = []
+        conditions, parameters, names = [], [], []
+        for name, rule_data in rules.items():
+            predicate, criteria = rule_data.get("predicates"), rule_data.get("criteria", [])
+            sql, rule_parameters = self.compile(predicate, criteria)
+            if self._anchored(predicate, tuple(self._shape(criterion) for criterion in criteria)):
+                statements.append((self._scan([sql]), rule_parameters, [name]))
+                continue
+            if names and len(parameters) + len(rule_parameters) > max_parameters:
+                statements.append((self._scan(conditions), parameters, names))
+                conditions, parameters, names = [], [], []
+            conditions.append(sql)
+            parameters.extend(rule_parameters)
+            names.append(name)
+        if names:
+            statements.append((self._scan(conditions), parameters, names))
+        return statements
+
+    def _scan(self, conditions):
+        key = ("scan", tuple(conditions))
+        sql = self.statements.get(key)
+        if sql is None:
+            if len(conditions) == 1:
+                sql = f"SELECT message_id, 1 FROM inbox WHERE {conditions[0]}"
+            else:
+                # Integer masks keep the per row work to arithmetic; the rules are decoded in Python.
+                masks = []
+                for first in range(0, len(conditions), MASK_BITS):
+                    terms = " + ".join(f"(CASE WHEN {condition} THEN {1 << bit} ELSE 0 END)"
+                                       for bit, condition in enumerate(conditions[first:first + MASK_BITS]))
+                    masks.append(f"{terms} AS mask{len(masks)}")
+                # LIMIT -1 keeps SQLite from flattening the subquery, which would evaluate every
+                # condition a second time for the outer WHERE.
+                sql = (f"SELECT * FROM (SELECT message_id, {', '.join(masks)} FROM inbox LIMIT -1) "
+                       f"WHERE {' OR '.join(f'mask{index} != 0' for index in range(len(masks)))}")
+            self.statements[key] = sql
+        return sql
@@ -0,0 +1,269 @@
+import copy
+import hashlib
+import json
+from datetime import datetime, timedelta
+
+from src.config_cache import FileCache, load_constants
+from src.email_store import BODY_COLUMN, split_labels
+from src.rule_index import RuleIndex
+
+# Predicates of the "Labels" field, and whether the message must carry the label.
+LABEL_PREDICATES = {"Has label": True, "Lacks label": False}
+
+# Validated rules and compiled rule sets of this process, rebuilt when their files change.
+_rules_cache = FileCache()
+_rule_set_cache = FileCache()
+
+
+def validate_rules(rules):
+    """
+    Validate the rules format and criteria.
+
+    Args:
+        rules (dict): The rules loaded from rules.json.
+
+    Raises:
+        TypeError: If a Greater than / Less than criterion has a non numeric value, or a label
+            predicate is used on another field than "Labels" or the other way round.
+    """
+    for rule_name, rule_data in rules.items():
+        for criterion in rule_data.get("criteria", []):
+            predicate = criterion.get("predicate")
+            value = criterion.get("value")
+            if predicate in ["Greater than", "Less than"] and not value.isdigit():
+                raise TypeError(f"Invalid value for predicate '{predicate}' in rule '{rule_name}'")
+            if "field_name" in criterion and (predicate in LABEL_PREDICATES) != (criterion["field_name"] == "Labels"):
+                raise TypeError(f"Invalid predicate '{predicate}' for field '{criterion['field_name']}' "
+                                f"in rule '{rule_name}'")
+
+
+def _read_rules(rules_file):
+    with open(rules_file, "r") as file:
+        rules = json.load(file)
+    validate_rules(rules)
+    return rules
+
+
+def load_rules(rules_file):
+    """
+    Loads and validates rules.json, parsing it again only after the file changed.
+
+    Args:
+        rules_file (str): The path of rules.json.
+
+    Returns:
+        dict: The rules, a copy the caller may modify.
+
+    Raises:
+        TypeError: If the rules are invalid, see validate_rules.
+    """
+    return copy.deepcopy(_rules_cache.get([rules_file], lambda: _read_rules(rules_file)))
+
+
+def rule_hash(rule_data):
+    """
+    Hashes a rule definition, so a changed rule can be told apart from the version already applied.
+
+    Args:
+        rule_data (dict): The rule definition with predicates, criteria and action.
+
+    Returns:
+        str: A short hex digest of the canonical JSON form of the rule.
+    """
+    return hashlib.sha256(json.dumps(rule_data, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_date_range(predicate, value):
+    """
+    Calculate date range based on the predicate and value.
+
+    The range covers whole local days, so it can be compared with the indexed received_at column.
+
+    Args:
+        predicate (str): "Greater than" for the coming days, anything else for the past days.
+        value (int): The number of days.
+
+    Returns:
+        tuple: The Unix time of the start of the first day and of the end of the last day; the
+        end is exclusive.
+    """
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    if predicate == "Greater than":
+        first_day, last_day = today, today + timedelta(days=value)
+    else:
+        first_day, last_day = today - timedelta(days=value), today
+    return int(first_day.timestamp()), int((last_day + timedelta(days=1)).timestamp())
+
+
+class Criterion:
+    def __init__(self, field_name, column, predicate, value):
+        """
+        Initializes a criterion that is evaluated in memory with the same semantics as its SQL form.
+
+        Args:
+            field_name (str): The rule field name, e.g. "Subject".
+            column (str): The inbox column the field refers to.
+            predicate (str): The rule predicate, e.g. "Contains".
+            value (str): The value to compare against.
+        """
+        self.field_name = field_name
+        self.column = column
+        self.predicate = predicate
+        self.value = value
+        # LIKE is case insensitive, so the comparison value is folded once up front.
+        self.folded_value = value.lower()
+
+    def matches(self, email):
+        """
+        Evaluates the criterion against an email.
+
+        Args:
+            email (dict): The email data as stored in the inbox table.
+
+        Returns:
+            bool: True if the email satisfies the criterion. A missing field never matches, like NULL in SQL.
+        """
+        field_value = email.get(self.column)
+        if field_value is None:
+            return False
+
+        if self.field_name == "Date Received":
+            start, end = get_date_range(self.predicate, int(self.value))
+            return start <= field_value < end
+        if self.predicate in LABEL_PREDICATES:
+            return (self.value in split_labels(field_value)) == LABEL_PREDICATES[self.predicate]
+        if self.predicate == "Contains":
+            return self.folded_value in field_value.lower()
+        if self.predicate == "Does not Contain":
+            return self.folded_value not in field_value.lower()
+        if self.predicate == "Equals":
+            return field_value == self.value
+        if self.predicate == "Does not equal":
+            return field_value != self.value
+        if self.predicate == "Less than":
+            return field_value < self.value
+        if self.predicate == "Greater than":
+            return field_value > self.value
+        return False
+
+
+class CompiledRule:
+    def __init__(self, name, rule_data, field_references):
+        """
+        Initializes a rule compiled from its rules.json entry.
+
+        Args:
+            name (str): The rule name.
+            rule_data (dict): The rule definition with predicates, criteria and action.
+            field_references (dict): Maps rule field names to inbox columns.
+        """
+        self.name = name
+        self.hash = rule_hash(rule_data)
+        self.match_all = rule_data.get("predicates") == "All"
+        self.criteria = [
+            Criterion(criterion["field_name"], field_references.get(criterion["field_name"]),
+                      criterion["predicate"], criterion["value"])
+            for criterion in rule_data.get("criteria", [])
+        ]
+        self.body_criteria = [criterion for criterion in self.criteria if criterion.column == BODY_COLUMN]
+        self.header_criteria = [criterion for criterion in self.criteria if criterion.column != BODY_COLUMN]
+        self.actions = rule_data.get("action", [])
+
+    def matches(self, email):
+        """
+        Evaluates the rule against an email.
+
+        Args:
+            email (dict): The email data as stored in the inbox table.
+
+        Returns:
+            bool: True if all (or, for "Any" rules, at least one) of the criteria match.
+        """
+        if self.match_all:
+            return all(criterion.matches(email) for criterion in self.criteria)
+        return any(criterion.matches(email) for criterion in self.criteria)
+
+
+class RuleSet:
+    def __init__(self, rules, field_references):
+        """
+        Initializes the RuleSet by compiling every rule once.
+
+        Args:
+            rules (dict): The rules loaded from rules.json.
+            field_references (dict): Maps rule field names to inbox columns.
+        """
+        validate_rules(rules)
+        self.rules = [CompiledRule(name, rule_data, field_references) for name, rule_data in rules.items()]
+        self.index = RuleIndex(self.rules)
+        self.needs_body = any(rule.body_criteria for rule in self.rules)
+
+    @classmethod
+    def from_files(cls, rules_file, config_file):
+        """
+        Loads and compiles the rules, reusing the rule set compiled earlier in the process while
+        neither file changed.
+
+        Args:
+            rules_file (str): The path of rules.json.
+            config_file (str): The path of constants.yaml.
+
+        Returns:
+            RuleSet: The compiled rules, shared by every caller.
+        """
+        return _rule_set_cache.get([rules_file, config_file], lambda: cls(
+            load_rules(rules_file), load_constants(config_file)["Fields_References"]))
+
+    def match(self, email):
+        """
+        Finds the rules an email satisfies.
+
+        Every field is scanned once through the rule index, so the cost per email does not grow
+        with the number of Contains / Equals rules.
+
+        Args:
+            email (dict): The email data as stored in the inbox table.
+
+        Returns:
+            list: The matching CompiledRule objects, in rule order.
+        """
+        return self.index.match(email)
+
+    def may_need_body(self, email):
+        """
+        Checks whether the outcome of any rule depends on the body of an email whose headers are known.
+
+        An "All" rule needs the body only while all of its header criteria match, and an "Any" rule
+        only while none of them does.
+
+        Args:
+            email (dict): The email data without content.
+
+        Returns:
+            bool: True if the body has to be downloaded to evaluate the rules.
+        """
+        for rule in self.rules:
+            if not rule.body_criteria:
+                continue
+            header_results = (criterion.matches(email) for criterion in rule.header_criteria)
+            if all(header_results) if rule.match_all else not any(header_results):
+                return True
+        return False
+
+    def plan_actions(self, email, planner):
+        """
+        Adds the actions of every rule the email satisfies to the planner.
+
+        Args:
+            email (dict): The email data as stored in the inbox table.
+            planner (ActionPlanner): Collects the label changes.
+
+        Returns:
+            list: The matching CompiledRule objects, in rule order.
+        """
+        matched = self.match(email)
+        for rule in matched:
+            for action in rule.actions:
+                planner.add(email["message_id"], action.get("addLabelIds", []), action.get("removeLabelIds", []),
+                            rule.hash)
+        return matched
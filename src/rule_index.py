@@ -0,0 +1,180 @@
+from collections import deque
+
+from src.email_store import split_labels
+
+# Predicates whose criteria can be answered by the index, and whether a hit satisfies them.
+INDEXED_PREDICATES = {
+    "Contains": True,
+    "Does not Contain": False,
+    "Equals": True,
+    "Does not equal": False,
+    "Has label": True,
+    "Lacks label": False,
+}
+
+
+class AhoCorasick:
+    def __init__(self, patterns):
+        """
+        Initializes an Aho-Corasick automaton that finds all of the patterns in a single pass.
+
+        Args:
+            patterns (list): The non empty strings to search for.
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for index, pattern in enumerate(patterns):
+            node = 0
+            for char in pattern:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.output[node].append(index)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def search(self, text):
+        """
+        Finds the patterns that occur in the text.
+
+        Args:
+            text (str): The text to scan.
+
+        Returns:
+            set: The indexes of the patterns found.
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return found
+
+
+class RuleIndex:
+    def __init__(self, rules):
+        """
+        Initializes the index by compiling the Contains / Equals criteria of every rule into one
+        automaton and one hash table per field, and the label criteria into a hash table of labels.
+
+        Args:
+            rules (list): The CompiledRule objects, in rule order.
+        """
+        self.rules = rules
+        self.contains = {}
+        self.equals = {}
+        self.labels = {}
+        # Criteria with an empty Contains value match every present field.
+        self.always = {}
+        self.indexed = set()
+        # Rules that can match without any indexed criterion being hit are evaluated for every email.
+        self.unanchored = []
+
+        contains_patterns = {}
+        for rule_number, rule in enumerate(self.rules):
+            anchored = False
+            for criterion_number, criterion in enumerate(rule.criteria):
+                if criterion.predicate not in INDEXED_PREDICATES or criterion.field_name == "Date Received":
+                    continue
+                key = (rule_number, criterion_number)
+                self.indexed.add(key)
+                if criterion.predicate in ("Contains", "Does not Contain"):
+                    if criterion.folded_value:
+                        contains_patterns.setdefault(criterion.column, {}).setdefault(
+                            criterion.folded_value, []).append(key)
+                    else:
+                        self.always.setdefault(criterion.column, []).append(key)
+                elif criterion.predicate in ("Has label", "Lacks label"):
+                    self.labels.setdefault(criterion.column, {}).setdefault(criterion.value, []).append(key)
+                else:
+                    self.equals.setdefault(criterion.column, {}).setdefault(criterion.value, []).append(key)
+                anchored = anchored or INDEXED_PREDICATES[criterion.predicate]
+
+            has_unindexed = any((rule_number, number) not in self.indexed for number in range(len(rule.criteria)))
+            has_negative = any(not INDEXED_PREDICATES.get(criterion.predicate, True) for criterion in rule.criteria)
+            if not anchored or (not rule.match_all and (has_unindexed or has_negative)):
+                self.unanchored.append(rule_number)
+
+        for column, patterns in contains_patterns.items():
+            values = list(patterns)
+            self.contains[column] = (AhoCorasick(values), [patterns[value] for value in values])
+
+    def hits(self, email):
+        """
+        Scans every field of the email once and collects the indexed criteria that were hit.
+
+        Args:
+            email (dict): The email data as stored in the inbox table.
+
+        Returns:
+            set: (rule number, criterion number) pairs whose pattern or value was found.
+        """
+        found = set()
+        for column, (automaton, keys) in self.contains.items():
+            field_value = email.get(column)
+            if field_value is not None:
+                for pattern_index in automaton.search(field_value.lower()):
+                    found.update(keys[pattern_index])
+        for column, values in self.equals.items():
+            field_value = email.get(column)
+            if field_value is not None:
+                found.update(values.get(field_value, ()))
+        for column, values in self.labels.items():
+            for label_id in split_labels(email.get(column)):
+                found.update(values.get(label_id, ()))
+        for column, keys in self.always.items():
+            if email.get(column) is not None:
+                found.update(keys)
+        return found
+
+    def match(self, email):
+        """
+        Finds the rules an email satisfies.
+
+        Args:
+            email (dict): The email data as stored in the inbox table.
+
+        Returns:
+            list: The matching CompiledRule objects, in rule order.
+        """
+        hits = self.hits(email)
+        candidates = set(self.unanchored)
+        candidates.update(rule_number for rule_number, _ in hits)
+
+        matched = []
+        for rule_number in sorted(candidates):
+            rule = self.rules[rule_number]
+            results = (self._satisfied(rule_number, criterion_number, criterion, email, hits)
+                       for criterion_number, criterion in enumerate(rule.criteria))
+            if all(results) if rule.match_all else any(results):
+                matched.append(rule)
+        return matched
+
+    def _satisfied(self, rule_number, criterion_number, criterion, email, hits):
+        """
+        Evaluates one criterion, reading indexed criteria from the hits instead of the email.
+        """
+        key = (rule_number, criterion_number)
+        if key not in self.indexed:
+            return criterion.matches(email)
+        if INDEXED_PREDICATES[criterion.predicate]:
+            return key in hits
+        return email.get(criterion.column) is not None and key not in hits
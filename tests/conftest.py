@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture(scope="session", autouse=True)
+def user_cache_directory(tmp_path_factory):
+    """Keeps the JSON copies of the configuration files out of the user cache directory of the developer."""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        directory = tmp_path_factory.mktemp("cache")
+        monkeypatch.setenv("XDG_CACHE_HOME", str(directory))
+        yield directory
@@ -0,0 +1,79 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from benchmarks.fake_gmail_server import FakeGmailServer, FakeMailbox
+from src.account_scheduler import Account, AccountScheduler, discover_accounts, sync_account
+from src.email_store import EmailStore
+
+
+class TestAccountScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        for name in ("beta", "alpha", "gamma"):
+            self._add_account(name)
+        os.makedirs(os.path.join(self.directory.name, "not_authorized"))
+
+    def _add_account(self, name):
+        directory = os.path.join(self.directory.name, name)
+        os.makedirs(directory)
+        with open(os.path.join(directory, "token.json"), "w") as file:
+            json.dump({"token": f"token-{name}", "refresh_token": "refresh", "client_id": "client",
+                       "client_secret": "secret", "expiry": "2099-01-01T00:00:00Z"}, file)
+
+    def test_discover_accounts_requires_a_token(self):
+        accounts = discover_accounts(self.directory.name)
+
+        self.assertEqual([account.name for account in accounts], ["alpha", "beta", "gamma"])
+        self.assertEqual(accounts[0].db_path, os.path.join(self.directory.name, "alpha", "email_db.db"))
+
+    def test_fair_order_puts_least_recently_synced_first(self):
+        accounts = discover_accounts(self.directory.name)
+        for account, synced_at in zip(accounts, (300, 100)):
+            store = EmailStore(account.db_path)
+            store.create_schema()
+            store.set_state("last_synced_at", synced_at)
+
+        ordered = AccountScheduler.fair_order(accounts)
+
+        self.assertEqual([account.name for account in ordered], ["gamma", "beta", "alpha"])
+
+    def test_units_per_account_shares_the_project_quota(self):
+        self.assertEqual(AccountScheduler(self.directory.name, processes=4).units_per_account, 250)
+        self.assertEqual(AccountScheduler(self.directory.name, processes=4, project_units_per_second=400)
+                         .units_per_account, 100)
+
+    def test_run_round_syncs_every_account_in_its_own_database(self):
+        server = FakeGmailServer(FakeMailbox(20, body_size=100))
+        server.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        scheduler = AccountScheduler(self.directory.name, processes=2, apply_rules=False, batch_size=20,
+                                     api_endpoint=server.url)
+
+        results = scheduler.run_round()
+
+        self.assertEqual(results, {"alpha": 20, "beta": 20, "gamma": 20})
+        for account in discover_accounts(self.directory.name):
+            self.assertGreater(account.last_synced_at(), 0)
+            self.assertTrue(os.path.exists(os.path.join(account.metrics_dir, "sync.prom")))
+
+    @patch('src.account_scheduler.EmailFetcher')
+    def test_failed_sync_is_not_stamped_as_synced(self, mock_fetcher):
+        mock_fetcher.return_value.sync_emails.return_value = False
+        account = discover_accounts(self.directory.name)[0]
+
+        with self.assertRaises(RuntimeError):
+            sync_account(account, 100)
+
+        mock_fetcher.return_value.store.set_state.assert_not_called()
+
+    def test_account_repr(self):
+        self.assertEqual(repr(Account("alpha", "/tmp/alpha")), "Account('alpha')")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+from unittest.mock import MagicMock, call
+from src.action_planner import ActionPlanner
+from src.api_executor import ApiExecutor
+
+
+class TestActionPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.planner = ActionPlanner()
+        self.mock_service = MagicMock()
+        self.batch_modify = self.mock_service.users.return_value.messages.return_value.batchModify
+        self.executor = ApiExecutor(max_workers=2, backoff_base=0)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_add_merges_actions_per_message(self):
+        self.planner.add("msg1", ["SPAM"], ["IMPORTANT"])
+        self.planner.add("msg1", ["STARRED", "IMPORTANT"], [])
+
+        self.assertEqual(self.planner.plan["msg1"], ({"SPAM", "STARRED", "IMPORTANT"}, set()))
+
+    def test_group_collects_messages_with_same_delta(self):
+        self.planner.add("msg1", ["SPAM"], ["IMPORTANT"])
+        self.planner.add("msg2", ["SPAM"], ["IMPORTANT"])
+        self.planner.add("msg3", ["STARRED"], [])
+        self.planner.add("msg4", ["STARRED"], ["STARRED"])
+
+        self.assertEqual(self.planner.group(), {
+            (("SPAM",), ("IMPORTANT",)): ["msg1", "msg2"],
+            (("STARRED",), ()): ["msg3"],
+            ((), ("STARRED",)): ["msg4"],
+        })
+
+    def test_execute_chunks_batch_modify_calls(self):
+        for index in range(5):
+            self.planner.add(f"msg{index}", ["SPAM"], [])
+
+        failed_ids = self.planner.execute(self.mock_service, self.executor, chunk_size=2)
+
+        self.assertEqual(failed_ids, [])
+        self.assertEqual(self.batch_modify.call_args_list, [
+            call(userId='me', body={"ids": ["msg0", "msg1"], "addLabelIds": ["SPAM"], "removeLabelIds": []}),
+            call(userId='me', body={"ids": ["msg2", "msg3"], "addLabelIds": ["SPAM"], "removeLabelIds": []}),
+            call(userId='me', body={"ids": ["msg4"], "addLabelIds": ["SPAM"], "removeLabelIds": []}),
+        ])
+
+    def test_execute_reports_failed_ids(self):
+        self.planner.add("msg1", ["SPAM"], [])
+        self.planner.add("msg2", ["STARRED"], [])
+        requests = {"msg1": MagicMock(), "msg2": MagicMock()}
+        requests["msg1"].execute.side_effect = Exception("Invalid label")
+        self.batch_modify.side_effect = lambda userId, body: requests[body["ids"][0]]
+
+        failed_ids = self.planner.execute(self.mock_service, self.executor)
+
+        self.assertEqual(failed_ids, ["msg1"])
+
+    def test_execute_records_successful_changes_in_store(self):
+        self.planner.add("msg1", ["SPAM"], ["INBOX"])
+        self.planner.add("msg2", ["STARRED"], [])
+        requests = {"msg1": MagicMock(), "msg2": MagicMock()}
+        requests["msg2"].execute.side_effect = Exception("Invalid label")
+        self.batch_modify.side_effect = lambda userId, body: requests[body["ids"][0]]
+        store = MagicMock()
+        store.get_labels_by_message.return_value = {}
+        store.get_applied_rules.return_value = {}
+
+        self.planner.execute(self.mock_service, self.executor, store=store)
+
+        store.apply_label_changes.assert_called_once_with(["msg1"], ("SPAM",), ("INBOX",))
+
+    def test_skip_applied_drops_journaled_rules_and_satisfied_labels(self):
+        self.planner.add("msg1", ["SPAM"], ["INBOX"], "rule_a")
+        self.planner.add("msg1", ["STARRED"], [], "rule_b")
+        self.planner.add("msg2", ["STARRED"], ["UNREAD"], "rule_b")
+        self.planner.add("msg3", ["STARRED"], [], "rule_b")
+        store = MagicMock()
+        store.get_labels_by_message.return_value = {"msg1": {"INBOX"}, "msg2": {"STARRED"}}
+        store.get_applied_rules.return_value = {"msg1": {"rule_b"}}
+
+        skipped = self.planner.skip_applied(store)
+
+        self.assertEqual(skipped, 1)
+        self.assertEqual(self.planner.plan, {
+            "msg1": ({"SPAM"}, {"INBOX"}),
+            "msg2": (set(), set()),
+            "msg3": ({"STARRED"}, set()),
+        })
+
+    def test_execute_journals_rules_of_successful_and_skipped_messages(self):
+        self.planner.add("msg1", ["SPAM"], [], "rule_a")
+        self.planner.add("msg2", ["SPAM"], [], "rule_a")
+        store = MagicMock()
+        store.get_labels_by_message.return_value = {"msg2": {"SPAM"}}
+        store.get_applied_rules.return_value = {}
+
+        self.planner.execute(self.mock_service, self.executor, store=store)
+
+        self.batch_modify.assert_called_once_with(
+            userId='me', body={"ids": ["msg1"], "addLabelIds": ["SPAM"], "removeLabelIds": []})
+        store.record_applied_rules.assert_called_once_with({"msg1": {"rule_a"}, "msg2": {"rule_a"}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import unittest
+from unittest.mock import patch, MagicMock
+from googleapiclient.errors import HttpError
+from src.api_executor import ApiExecutor, TokenBucket, is_retryable
+
+
+def http_error(status, headers=None):
+    response = MagicMock(status=status)
+    response.get.side_effect = lambda key, default=None: (headers or {}).get(key, default)
+    return HttpError(response, b"")
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    @patch('src.api_executor.time.sleep')
+    @patch('src.api_executor.time.monotonic')
+    def test_acquire_waits_for_refill(self, mock_monotonic, mock_sleep):
+        mock_monotonic.side_effect = [0.0, 0.0, 0.0]
+        bucket = TokenBucket(rate=10)
+
+        bucket.acquire(10)
+        bucket.acquire(5)
+
+        mock_sleep.assert_called_once_with(0.5)
+        self.assertEqual(bucket.tokens, -5)
+
+    @patch('src.api_executor.time.sleep')
+    @patch('src.api_executor.time.monotonic')
+    def test_acquire_charges_calls_above_capacity_in_full(self, mock_monotonic, mock_sleep):
+        mock_monotonic.side_effect = [0.0, 0.0, 2.0]
+        bucket = TokenBucket(rate=10)
+
+        bucket.acquire(30)
+        bucket.acquire(30)
+
+        self.assertEqual([args[0] for args, _ in mock_sleep.call_args_list], [2.0, 3.0])
+
+
+class TestApiExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ApiExecutor(max_workers=2, backoff_base=0)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable(http_error(429)))
+        self.assertTrue(is_retryable(http_error(503)))
+        self.assertTrue(is_retryable(ConnectionError()))
+        self.assertFalse(is_retryable(http_error(404)))
+        self.assertFalse(is_retryable(ValueError()))
+
+    @patch('src.api_executor.time.sleep')
+    def test_execute_retries_retryable_errors(self, mock_sleep):
+        request = MagicMock()
+        request.execute.side_effect = [http_error(429), http_error(500), {"id": "msg1"}]
+
+        result = self.executor.execute(request, cost=5)
+
+        self.assertEqual(result, {"id": "msg1"})
+        self.assertEqual(request.execute.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch('src.api_executor.time.sleep')
+    def test_execute_honours_retry_after(self, mock_sleep):
+        request = MagicMock()
+        request.execute.side_effect = [http_error(429, {"retry-after": "3"}), {}]
+
+        self.executor.execute(request)
+
+        mock_sleep.assert_called_once_with(3.0)
+
+    @patch('src.api_executor.time.sleep')
+    def test_execute_records_calls_retries_and_errors(self, mock_sleep):
+        retried, failing = MagicMock(methodId="gmail.users.messages.get"), MagicMock(methodId="gmail.users.messages.get")
+        retried.execute.side_effect = [http_error(429), {}]
+        failing.execute.side_effect = http_error(404)
+
+        self.executor.execute(retried)
+        with self.assertRaises(HttpError):
+            self.executor.execute(failing)
+
+        metrics = self.executor.metrics
+        self.assertEqual(metrics.value("gmail_api_calls_total", method="gmail.users.messages.get"), 3)
+        self.assertEqual(metrics.value("gmail_api_retries_total", method="gmail.users.messages.get"), 1)
+        self.assertEqual(metrics.value("gmail_api_errors_total", method="gmail.users.messages.get"), 1)
+
+    def test_execute_raises_non_retryable_errors(self):
+        request = MagicMock()
+        request.execute.side_effect = http_error(404)
+
+        with self.assertRaises(HttpError):
+            self.executor.execute(request)
+        request.execute.assert_called_once()
+
+    @patch('src.api_executor.time.sleep')
+    def test_execute_gives_up_after_max_retries(self, mock_sleep):
+        self.executor.max_retries = 2
+        request = MagicMock()
+        request.execute.side_effect = http_error(503)
+
+        with self.assertRaises(HttpError):
+            self.executor.execute(request)
+        self.assertEqual(request.execute.call_count, 3)
+
+    def test_execute_all_collects_results_and_errors(self):
+        ok, failing = MagicMock(), MagicMock()
+        ok.execute.return_value = {"id": "msg1"}
+        failing.execute.side_effect = http_error(400)
+
+        results, errors = self.executor.execute_all({"msg1": ok, "msg2": failing})
+
+        self.assertEqual(results, {"msg1": {"id": "msg1"}})
+        self.assertEqual(list(errors), ["msg2"])
+
+    @patch('src.api_executor.time.sleep')
+    def test_execute_batch_retries_throttled_items(self, mock_sleep):
+        service = MagicMock()
+        attempts = {}
+
+        def new_batch(callback):
+            batch = MagicMock()
+            items = []
+            batch.add.side_effect = lambda request, request_id: items.append(request_id)
+
+            def execute(**kwargs):
+                for request_id in items:
+                    attempts[request_id] = attempts.get(request_id, 0) + 1
+                    if request_id == "msg2" and attempts[request_id] == 1:
+                        callback(request_id, None, http_error(429))
+                    elif request_id == "msg3":
+                        callback(request_id, None, http_error(404))
+                    else:
+                        callback(request_id, {"id": request_id}, None)
+
+            batch.execute.side_effect = execute
+            return batch
+
+        service.new_batch_http_request.side_effect = new_batch
+        requests = {"msg1": MagicMock(), "msg2": MagicMock(), "msg3": MagicMock()}
+
+        results, errors = self.executor.execute_batch(service, requests, cost=5, batch_size=2)
+
+        self.assertEqual(results, {"msg1": {"id": "msg1"}, "msg2": {"id": "msg2"}})
+        self.assertEqual(list(errors), ["msg3"])
+        self.assertEqual(attempts, {"msg1": 1, "msg2": 2, "msg3": 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
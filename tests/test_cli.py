@@ -0,0 +1,54 @@
+import subprocess
+import sys
+import unittest
+from unittest.mock import patch
+from src.cli import main
+
+
+class TestCli(unittest.TestCase):
+
+    @patch('src.email_fetcher.EmailFetcher')
+    def test_sync_passes_the_options_to_the_fetcher(self, mock_fetcher):
+        status = main(["sync", "--db-path", "mail.db", "--batch-size", "50", "--apply-rules", "--metadata-first"])
+
+        self.assertEqual(status, 0)
+        self.assertEqual(mock_fetcher.call_args.kwargs["db_path"], "mail.db")
+        mock_fetcher.return_value.sync_emails.assert_called_once_with(
+            page_size=100, batch_size=50, apply_rules=True, metadata_first=True, fetch_bodies=False)
+
+    @patch('src.email_fetcher.EmailFetcher')
+    def test_fetch_passes_the_options_to_the_fetcher(self, mock_fetcher):
+        main(["fetch", "--max-results", "10"])
+
+        mock_fetcher.return_value.fetch_emails.assert_called_once_with(max_results=10, batch_size=None)
+
+    @patch('src.email_fetcher.EmailFetcher')
+    def test_failed_fetch_and_sync_are_reported_in_the_exit_status(self, mock_fetcher):
+        mock_fetcher.return_value.fetch_emails.return_value = False
+        mock_fetcher.return_value.sync_emails.return_value = False
+
+        self.assertEqual(main(["fetch"]), 1)
+        self.assertEqual(main(["sync"]), 1)
+
+    @patch('src.email_filter.EmailFilter')
+    def test_filter_reports_failed_modifications_in_the_exit_status(self, mock_filter):
+        mock_filter.return_value.failed_message_ids = ["msg1"]
+
+        self.assertEqual(main(["filter", "--use-index"]), 1)
+        mock_filter.return_value.apply_filters.assert_called_once_with(use_index=True)
+        mock_filter.return_value.close.assert_called_once_with()
+
+    def test_help_does_not_import_the_client_libraries(self):
+        code = ("import sys, contextlib, io\n"
+                "from src.cli import main\n"
+                "with contextlib.suppress(SystemExit), contextlib.redirect_stdout(io.StringIO()):\n"
+                "    main(['--help'])\n"
+                "print(sorted(name for name in ('googleapiclient', 'google.auth', 'yaml', 'src.email_filter')"
+                " if name in sys.modules))")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+
+        self.assertEqual(output.strip(), "[]")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from src.config_cache import FileCache, constants_cache_path, load_constants
+from src.rule_engine import RuleSet, load_rules
+
+
+class TestConfigCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache_home = os.path.join(self.directory.name, "cache")
+        environment = patch.dict(os.environ, {"XDG_CACHE_HOME": self.cache_home})
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.config_file = self._write("constants.yaml", "Fields_References:\n  From: from_id\n")
+        self.rules_file = self._write("rules.json", json.dumps({"rule": {
+            "predicates": "All", "criteria": [{"field_name": "From", "predicate": "Contains", "value": "bank"}],
+            "action": []}}))
+
+    def _write(self, name, content, mtime_ns=None):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w") as file:
+            file.write(content)
+        if mtime_ns is not None:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+        return path
+
+    def test_value_is_rebuilt_only_after_the_file_changes(self):
+        cache, builds = FileCache(), []
+
+        def build():
+            builds.append(1)
+            return len(builds)
+
+        self.assertEqual(cache.get([self.rules_file], build), 1)
+        self.assertEqual(cache.get([self.rules_file], build), 1)
+        self._write("rules.json", "{}", mtime_ns=os.stat(self.rules_file).st_mtime_ns + 1)
+
+        self.assertEqual(cache.get([self.rules_file], build), 2)
+
+    def test_constants_are_read_from_the_json_copy_without_parsing_yaml(self):
+        self.assertEqual(load_constants(self.config_file), {"Fields_References": {"From": "from_id"}})
+        self.assertTrue(os.path.exists(constants_cache_path(self.config_file)))
+        self.assertTrue(constants_cache_path(self.config_file).startswith(self.cache_home))
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ["cache", "constants.yaml", "rules.json"])
+
+        with patch("src.config_cache._constants_cache", FileCache()), patch("yaml.safe_load") as mock_load:
+            constants = load_constants(self.config_file)
+
+        mock_load.assert_not_called()
+        self.assertEqual(constants, {"Fields_References": {"From": "from_id"}})
+
+    def test_stale_json_copy_is_ignored(self):
+        load_constants(self.config_file)
+        self._write("constants.yaml", "Fields_References:\n  From: sender\n",
+                    mtime_ns=os.stat(self.config_file).st_mtime_ns + 1)
+
+        self.assertEqual(load_constants(self.config_file), {"Fields_References": {"From": "sender"}})
+
+    def test_loaded_values_can_be_modified_without_affecting_the_cache(self):
+        load_rules(self.rules_file)["rule"]["criteria"].clear()
+        load_constants(self.config_file)["Fields_References"].clear()
+
+        self.assertEqual(len(load_rules(self.rules_file)["rule"]["criteria"]), 1)
+        self.assertEqual(load_constants(self.config_file)["Fields_References"], {"From": "from_id"})
+
+    def test_rule_set_is_compiled_once_per_version_of_the_rules(self):
+        rule_set = RuleSet.from_files(self.rules_file, self.config_file)
+
+        self.assertIs(RuleSet.from_files(self.rules_file, self.config_file), rule_set)
+        self._write("rules.json", "{}", mtime_ns=os.stat(self.rules_file).st_mtime_ns + 1)
+        self.assertEqual(RuleSet.from_files(self.rules_file, self.config_file).rules, [])
+
+    def test_invalid_rules_are_rejected(self):
+        self._write("rules.json", json.dumps({"rule": {"criteria": [{"predicate": "Less than", "value": "x"}]}}))
+
+        with self.assertRaises(TypeError):
+            load_rules(self.rules_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,16 +2,21 @@ import unittest
 from unittest.mock import patch, MagicMock, call
 from email.parser import Parser
 import base64
+import os
 import re
+import tempfile
 from datetime import datetime
+from googleapiclient.errors import HttpError
 from src.email_fetcher import EmailFetcher
+from src.rule_engine import RuleSet
 
 
 class TestFetchEmails(unittest.TestCase):
 
     def setUp(self):
-        self.manager = EmailFetcher()
-        self.manager.creds = MagicMock()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.manager = EmailFetcher(credentials=MagicMock(), db_path=os.path.join(directory.name, "email_db.db"))
         self.mock_service = MagicMock()
         self.mock_messages = [
             {"id": "message1"},
@@ -27,7 +32,7 @@ class TestFetchEmails(unittest.TestCase):
             base64.urlsafe_b64decode(self.mock_raw_message["raw"]).decode("UTF-8")
         )
 
-    @patch('src.email_fetcher.build')
+    @patch('src.email_fetcher.get_gmail_service')
     @patch('src.email_fetcher.EmailFetcher.create_table')
     @patch('src.email_fetcher.EmailFetcher.save_to_database')
     def test_fetch_emails_success(self, mock_save_to_database, mock_create_table, mock_build):
@@ -37,13 +42,13 @@ class TestFetchEmails(unittest.TestCase):
             "messages": self.mock_messages}
         self.mock_service.users.return_value.messages.return_value.get.return_value.execute.return_value = self.mock_raw_message
 
-        with patch('src.email_fetcher.message_from_string', return_value=self.mock_parsed_message):
+        with patch('src.email_fetcher.parse_source', return_value=self.mock_parsed_message):
             # Act
             self.manager.fetch_emails()
 
             # Assert
             mock_create_table.assert_called_once()
-            mock_build.assert_called_once_with('gmail', 'v1', credentials=self.manager.creds)
+            mock_build.assert_called_once_with(self.manager.creds, None)
             self.mock_service.users.return_value.messages.return_value.list.assert_called_once_with(userId='me',
                                                                                                     labelIds=['INBOX'],
                                                                                                     maxResults=50)
@@ -55,6 +60,7 @@ class TestFetchEmails(unittest.TestCase):
                 "from_id": "test@example.com",
                 "to_id": "recipient@example.com",
                 "date": "2023-08-21 12:34",
+                "received_at": 1692621296,
                 "message_id": "message1",
                 "content_type": "text/plain",
                 "content": "This is a test email.",
@@ -63,7 +69,35 @@ class TestFetchEmails(unittest.TestCase):
             }]
             mock_save_to_database.assert_called_once_with(expected_data)
 
-    @patch('src.email_fetcher.build')
+    def test_parse_metadata_keeps_messages_without_a_date(self):
+        email = EmailFetcher.parse_metadata({"id": "message1", "labelIds": ["INBOX"], "payload": {"headers": [
+            {"name": "From", "value": "test@example.com"}, {"name": "Date", "value": "sometime last week"}]}})
+
+        self.assertEqual((email["message_id"], email["date"], email["received_at"]), ("message1", None, None))
+
+    def test_parse_metadata_prefers_internal_date(self):
+        email = EmailFetcher.parse_metadata({"id": "message1", "internalDate": "1692621296000", "payload": {
+            "headers": [{"name": "Date", "value": "Mon, 21 Aug 2023 07:34:56 -0700"}]}})
+
+        self.assertEqual((email["date"], email["received_at"]), ("2023-08-21 12:34", 1692621296))
+
+    def test_parse_message_multipart(self):
+        raw = (
+            "From: test@example.com\nTo: recipient@example.com\nDate: Mon, 21 Aug 2023 12:34:56 +0000\n"
+            "Subject: Test\nMIME-Version: 1.0\nContent-Type: multipart/alternative; boundary=XYZ\n\n"
+            "--XYZ\nContent-Type: text/plain; charset=utf-8\n\nPlain part\n"
+            "--XYZ\nContent-Type: text/html; charset=utf-8\n\n<p>HTML part</p>\n--XYZ--\n"
+        )
+        raw_message = {"raw": base64.urlsafe_b64encode(raw.encode("UTF-8")).decode("UTF-8"), "id": "message1",
+                       "labelIds": ["INBOX", "UNREAD"]}
+
+        email = EmailFetcher.parse_message(raw_message)
+
+        self.assertEqual(email["content"], "Plain part")
+        self.assertEqual(email["content_type"], "multipart/alternative; boundary=XYZ")
+        self.assertEqual(email["labels"], "INBOX,UNREAD")
+
+    @patch('src.email_fetcher.get_gmail_service')
     @patch('src.email_fetcher.EmailFetcher.create_table')
     @patch('src.email_fetcher.EmailFetcher.save_to_database')
     def test_fetch_emails_no_messages(self, mock_save_to_database, mock_create_table, mock_build):
@@ -77,22 +111,360 @@ class TestFetchEmails(unittest.TestCase):
 
         # Assert
         mock_create_table.assert_called_once()
-        mock_build.assert_called_once_with('gmail', 'v1', credentials=self.manager.creds)
+        mock_build.assert_called_once_with(self.manager.creds, None)
         self.mock_service.users.return_value.messages.return_value.list.assert_called_once_with(userId='me',
                                                                                                 labelIds=['INBOX'],
                                                                                                 maxResults=50)
         mock_save_to_database.assert_called_once_with([])
 
-    @patch('src.email_fetcher.build')
+    @patch('src.email_fetcher.get_gmail_service')
+    @patch('src.email_fetcher.EmailFetcher.create_table')
+    @patch('src.email_fetcher.EmailFetcher.save_to_database')
+    def test_fetch_emails_batched(self, mock_save_to_database, mock_create_table, mock_build):
+        # Arrange
+        mock_build.return_value = self.mock_service
+        self.mock_service.users.return_value.messages.return_value.list.return_value.execute.return_value = {
+            "messages": [{"id": "message1"}, {"id": "message2"}, {"id": "message3"}]}
+        batches = []
+
+        def new_batch(callback):
+            batch = MagicMock()
+            batch.request_ids = []
+            batch.add.side_effect = lambda request, request_id: batch.request_ids.append(request_id)
+
+            def execute(http=None):
+                for request_id in batch.request_ids:
+                    if request_id == "message2":
+                        callback(request_id, None, Exception("Not found"))
+                    else:
+                        callback(request_id, dict(self.mock_raw_message, id=request_id), None)
+
+            batch.execute.side_effect = execute
+            batches.append(batch)
+            return batch
+
+        self.mock_service.new_batch_http_request.side_effect = new_batch
+
+        # Act
+        self.manager.fetch_emails(batch_size=2)
+
+        # Assert
+        self.assertEqual([batch.request_ids for batch in batches], [["message1", "message2"], ["message3"]])
+        self.mock_service.users.return_value.messages.return_value.get.return_value.execute.assert_not_called()
+        saved = mock_save_to_database.call_args[0][0]
+        self.assertEqual([email["message_id"] for email in saved], ["message1", "message3"])
+
+    def _mock_get(self):
+        self.mock_service.users.return_value.messages.return_value.get.side_effect = \
+            lambda userId, id, format: MagicMock(execute=MagicMock(return_value=dict(self.mock_raw_message, id=id)))
+
+    @patch('src.email_fetcher.get_gmail_service')
+    @patch('src.email_fetcher.EmailFetcher.save_to_database')
+    def test_sync_emails_full_listing_follows_pages(self, mock_save_to_database, mock_build):
+        # Arrange
+        mock_build.return_value = self.mock_service
+        users = self.mock_service.users.return_value
+        users.getProfile.return_value.execute.return_value = {"historyId": "1000"}
+        users.messages.return_value.list.return_value.execute.side_effect = [
+            {"messages": [{"id": "message1"}, {"id": "message2"}], "nextPageToken": "page2"},
+            {"messages": [{"id": "message3"}]},
+        ]
+        self._mock_get()
+
+        # Act
+        self.manager.sync_emails(page_size=2)
+
+        # Assert
+        users.messages.return_value.list.assert_has_calls([
+            call(userId='me', labelIds=['INBOX'], maxResults=2, pageToken=None),
+            call(userId='me', labelIds=['INBOX'], maxResults=2, pageToken="page2"),
+        ], any_order=True)
+        saved = [[email["message_id"] for email in args[0]] for args, _ in mock_save_to_database.call_args_list]
+        self.assertEqual(saved, [["message1", "message2"], ["message3"]])
+        self.assertEqual(self.manager.get_checkpoint(), "1000")
+
+    @patch('src.email_fetcher.get_gmail_service')
+    @patch('src.email_fetcher.EmailFetcher.save_to_database')
+    def test_sync_emails_incremental_uses_history(self, mock_save_to_database, mock_build):
+        # Arrange
+        self.manager.create_table()
+        self.manager.save_checkpoint("900")
+        mock_build.return_value = self.mock_service
+        users = self.mock_service.users.return_value
+        users.getProfile.return_value.execute.return_value = {"historyId": "1000"}
+        users.history.return_value.list.return_value.execute.return_value = {
+            "history": [{"messagesAdded": [{"message": {"id": "message4"}}]},
+                        {"messagesAdded": [{"message": {"id": "message4"}}, {"message": {"id": "message5"}}]}]}
+        self._mock_get()
+
+        # Act
+        self.manager.sync_emails()
+
+        # Assert
+        users.messages.return_value.list.assert_not_called()
+        self.assertEqual(users.history.return_value.list.call_args.kwargs["startHistoryId"], "900")
+        saved = [email["message_id"] for email in mock_save_to_database.call_args[0][0]]
+        self.assertEqual(saved, ["message4", "message5"])
+        self.assertEqual(self.manager.get_checkpoint(), "1000")
+
+    @patch('src.email_fetcher.get_gmail_service')
+    @patch('src.email_fetcher.EmailFetcher.save_to_database')
+    def test_sync_emails_expired_checkpoint_falls_back_to_full_listing(self, mock_save_to_database, mock_build):
+        # Arrange
+        self.manager.create_table()
+        self.manager.save_checkpoint("1")
+        mock_build.return_value = self.mock_service
+        users = self.mock_service.users.return_value
+        users.getProfile.return_value.execute.return_value = {"historyId": "1000"}
+        users.history.return_value.list.return_value.execute.side_effect = HttpError(MagicMock(status=404), b"")
+        users.messages.return_value.list.return_value.execute.return_value = {"messages": [{"id": "message1"}]}
+        self._mock_get()
+
+        # Act
+        self.manager.sync_emails()
+
+        # Assert
+        users.messages.return_value.list.assert_called_once()
+        self.assertEqual([email["message_id"] for email in mock_save_to_database.call_args[0][0]], ["message1"])
+        self.assertEqual(self.manager.get_checkpoint(), "1000")
+
+    def _mock_history(self, *message_ids):
+        users = self.mock_service.users.return_value
+        users.getProfile.return_value.execute.return_value = {"historyId": "1000"}
+        users.history.return_value.list.return_value.execute.return_value = {
+            "history": [{"messagesAdded": [{"message": {"id": message_id}} for message_id in message_ids]}]}
+
+    @patch('src.email_fetcher.get_gmail_service')
+    @patch('src.email_fetcher.EmailFetcher.save_to_database')
+    def test_sync_emails_retries_messages_that_were_not_stored(self, mock_save_to_database, mock_build):
+        # Arrange
+        self.manager.create_table()
+        self.manager.save_checkpoint("900")
+        mock_build.return_value = self.mock_service
+        self._mock_history("message4", "message5")
+        self._mock_get()
+        mock_save_to_database.return_value = False
+
+        # Act
+        synced = self.manager.sync_emails()
+
+        # Assert
+        self.assertFalse(synced)
+        self.assertEqual(self.manager.get_checkpoint(), "1000")
+        self.assertEqual(self.manager.get_retry_ids(), {"message4": 1, "message5": 1})
+
+        self._mock_history()
+        mock_save_to_database.return_value = True
+        self.assertTrue(self.manager.sync_emails())
+        saved = [email["message_id"] for email in mock_save_to_database.call_args[0][0]]
+        self.assertEqual(saved, ["message4", "message5"])
+        self.assertEqual(self.manager.get_retry_ids(), {})
+
+    @patch('src.email_fetcher.get_gmail_service')
+    @patch('src.email_fetcher.EmailFetcher.save_to_database')
+    @patch('src.email_fetcher.MAX_MESSAGE_RETRIES', 2)
+    def test_sync_emails_gives_up_on_messages_that_keep_failing(self, mock_save_to_database, mock_build):
+        # Arrange
+        self.manager.create_table()
+        self.manager.save_checkpoint("900")
+        mock_build.return_value = self.mock_service
+        self._mock_history("message4", "message5")
+
+        def get(userId, id, format):
+            if id == "message5":
+                return MagicMock(execute=MagicMock(side_effect=Exception("Not found")))
+            return MagicMock(execute=MagicMock(return_value=dict(self.mock_raw_message, id=id)))
+        self.mock_service.users.return_value.messages.return_value.get.side_effect = get
+
+        # Act
+        self.manager.sync_emails()
+        retries = self.manager.get_retry_ids()
+        self._mock_history()
+        self.manager.sync_emails()
+
+        # Assert
+        self.assertEqual(retries, {"message5": 1})
+        self.assertEqual(self.manager.get_retry_ids(), {})
+
+    @patch('src.email_fetcher.get_gmail_service')
+    @patch('src.email_fetcher.EmailFetcher.save_to_database')
+    def test_sync_emails_applies_rules_at_ingest(self, mock_save_to_database, mock_build):
+        # Arrange
+        mock_build.return_value = self.mock_service
+        users = self.mock_service.users.return_value
+        users.getProfile.return_value.execute.return_value = {"historyId": "1000"}
+        users.messages.return_value.list.return_value.execute.return_value = {"messages": [{"id": "message1"}]}
+        self._mock_get()
+        self.manager.rule_set = RuleSet({"rule_1": {
+            "predicates": "Any",
+            "criteria": [{"field_name": "From", "predicate": "Contains", "value": "example.com"}],
+            "action": [{"addLabelIds": ["STARRED"], "removeLabelIds": ["INBOX"]}]
+        }}, {"From": "from_id"})
+
+        # Act
+        self.manager.sync_emails(apply_rules=True)
+
+        # Assert
+        users.messages.return_value.batchModify.assert_called_once_with(
+            userId='me', body={"ids": ["message1"], "addLabelIds": ["STARRED"], "removeLabelIds": ["INBOX"]})
+
+    @patch('src.email_fetcher.get_gmail_service')
+    @patch('src.email_fetcher.EmailFetcher.save_to_database')
+    def test_sync_emails_keeps_failed_actions_in_the_outbox(self, mock_save_to_database, mock_build):
+        # Arrange
+        mock_build.return_value = self.mock_service
+        users = self.mock_service.users.return_value
+        users.getProfile.return_value.execute.return_value = {"historyId": "1000"}
+        users.messages.return_value.list.return_value.execute.return_value = {"messages": [{"id": "message1"}]}
+        users.messages.return_value.batchModify.return_value.execute.side_effect = Exception("Invalid label")
+        self._mock_get()
+        self.manager.rule_set = RuleSet({"rule_1": {
+            "predicates": "Any",
+            "criteria": [{"field_name": "From", "predicate": "Contains", "value": "example.com"}],
+            "action": [{"addLabelIds": ["STARRED"], "removeLabelIds": []}]
+        }}, {"From": "from_id"})
+
+        # Act
+        self.manager.sync_emails(apply_rules=True)
+
+        # Assert
+        self.assertEqual(self.manager.store.count_actions()["pending"], 1)
+        self.assertEqual(self.manager.get_checkpoint(), "1000")
+
+    @patch('src.email_fetcher.get_gmail_service')
+    @patch('src.email_fetcher.EmailFetcher.save_to_database')
+    def test_sync_emails_without_rules_sends_no_actions(self, mock_save_to_database, mock_build):
+        # Arrange
+        mock_build.return_value = self.mock_service
+        users = self.mock_service.users.return_value
+        users.getProfile.return_value.execute.return_value = {"historyId": "1000"}
+        users.messages.return_value.list.return_value.execute.return_value = {"messages": [{"id": "message1"}]}
+        self._mock_get()
+
+        # Act
+        self.manager.sync_emails()
+
+        # Assert
+        users.messages.return_value.batchModify.assert_not_called()
+
+    def _mock_metadata_and_raw_get(self):
+        def get(userId, id, format, **params):
+            if format == "metadata":
+                self.assertEqual(params["metadataHeaders"], ["From", "To", "Subject", "Date", "Content-Type"])
+                sender = "alerts@bank.com" if id == "message1" else "friend@example.com"
+                response = {"id": id, "labelIds": ["INBOX"], "payload": {"headers": [
+                    {"name": "From", "value": sender},
+                    {"name": "Subject", "value": "Hello"},
+                    {"name": "Date", "value": "Mon, 21 Aug 2023 12:34:56 +0000"}]}}
+            else:
+                response = dict(self.mock_raw_message, id=id)
+            return MagicMock(execute=MagicMock(return_value=response))
+
+        self.mock_service.users.return_value.messages.return_value.get.side_effect = get
+
+    def _body_rule_set(self):
+        return RuleSet({"rule_1": {
+            "predicates": "All",
+            "criteria": [{"field_name": "From", "predicate": "Contains", "value": "bank"},
+                         {"field_name": "Message", "predicate": "Contains", "value": "test email"}],
+            "action": [{"addLabelIds": ["STARRED"], "removeLabelIds": []}]
+        }}, {"From": "from_id", "Message": "content"})
+
+    @patch('src.email_fetcher.get_gmail_service')
+    @patch('src.email_fetcher.EmailFetcher.save_to_database')
+    def test_sync_emails_metadata_first_downloads_bodies_on_demand(self, mock_save_to_database, mock_build):
+        # Arrange
+        mock_build.return_value = self.mock_service
+        users = self.mock_service.users.return_value
+        users.getProfile.return_value.execute.return_value = {"historyId": "1000"}
+        users.messages.return_value.list.return_value.execute.return_value = {
+            "messages": [{"id": "message1"}, {"id": "message2"}]}
+        self._mock_metadata_and_raw_get()
+        self.manager.rule_set = self._body_rule_set()
+
+        # Act
+        self.manager.sync_emails(metadata_first=True)
+
+        # Assert
+        raw_calls = [kwargs["id"] for _, kwargs in users.messages.return_value.get.call_args_list
+                     if kwargs["format"] == "raw"]
+        self.assertEqual(raw_calls, ["message1"])
+        saved = mock_save_to_database.call_args[0][0]
+        self.assertEqual([(email["message_id"], email["content"]) for email in saved],
+                         [("message1", "This is a test email."), ("message2", None)])
+        self.assertEqual(saved[1]["from_id"], "friend@example.com")
+        self.assertEqual(saved[1]["date"], "2023-08-21 12:34")
+
+    @patch('src.email_fetcher.get_gmail_service')
+    @patch('src.email_fetcher.EmailFetcher.save_to_database')
+    def test_sync_emails_metadata_first_can_fetch_every_body(self, mock_save_to_database, mock_build):
+        # Arrange
+        mock_build.return_value = self.mock_service
+        users = self.mock_service.users.return_value
+        users.getProfile.return_value.execute.return_value = {"historyId": "1000"}
+        users.messages.return_value.list.return_value.execute.return_value = {
+            "messages": [{"id": "message1"}, {"id": "message2"}]}
+        self._mock_metadata_and_raw_get()
+
+        # Act
+        self.manager.sync_emails(metadata_first=True, fetch_bodies=True)
+
+        # Assert
+        saved = mock_save_to_database.call_args[0][0]
+        self.assertEqual([email["content"] for email in saved], ["This is a test email."] * 2)
+
+    def test_parse_messages_skips_malformed_messages(self):
+        latin1 = "Subject: Caf\u00e9\nContent-Type: text/plain; charset=iso-8859-1\n\nCaf\u00e9".encode("iso-8859-1")
+        raw_messages = [{"id": "broken", "raw": "not base64!"},
+                        {"id": "latin1", "raw": base64.urlsafe_b64encode(latin1).decode()},
+                        self.mock_raw_message]
+
+        with patch('src.email_fetcher.logging.error') as mock_logging_error:
+            inbox_data = self.manager.parse_messages(self.manager.metrics, raw_messages)
+
+        self.assertEqual([email["message_id"] for email in inbox_data], ["latin1", "message1"])
+        self.assertEqual(inbox_data[0]["content"], "Caf\u00e9")
+        self.assertIn("broken", mock_logging_error.call_args[0][0])
+
+    @patch('src.email_fetcher.PARALLEL_PARSE_MIN_BYTES', 0)
+    def test_parse_messages_in_worker_processes(self):
+        self.manager.parse_processes = 2
+        self.addCleanup(self.manager.close_parse_pool)
+        raw_messages = [dict(self.mock_raw_message, id=f"message{index}") for index in range(5)]
+
+        inbox_data = self.manager.parse_messages(self.manager.metrics, raw_messages)
+
+        self.assertIsNotNone(self.manager.parse_pool)
+        self.assertEqual(inbox_data, [EmailFetcher.parse_message(message) for message in raw_messages])
+
+    @patch('src.email_fetcher.get_gmail_service')
+    @patch('src.email_fetcher.EmailFetcher.save_to_database')
+    def test_sync_emails_parse_error_keeps_the_checkpoint(self, mock_save_to_database, mock_build):
+        mock_build.return_value = self.mock_service
+        users = self.mock_service.users.return_value
+        users.getProfile.return_value.execute.return_value = {"historyId": "1000"}
+        users.messages.return_value.list.return_value.execute.return_value = {"messages": [{"id": "message1"}]}
+        self._mock_get()
+
+        with patch.object(self.manager, 'parse_page', side_effect=Exception("Parser crashed")), \
+                patch('src.email_fetcher.logging.error') as mock_logging_error:
+            self.manager.sync_emails()
+
+        mock_logging_error.assert_called_once_with("Error syncing emails: Parser crashed")
+        mock_save_to_database.assert_not_called()
+        self.assertIsNone(self.manager.get_checkpoint())
+
+    @patch('src.email_fetcher.get_gmail_service')
     @patch('src.email_fetcher.logging.error')
     def test_fetch_emails_exception(self, mock_logging_error, mock_build):
         # Arrange
         mock_build.side_effect = Exception("An error occurred")
 
         # Act
-        self.manager.fetch_emails()
+        fetched = self.manager.fetch_emails()
 
         # Assert
+        self.assertFalse(fetched)
         mock_logging_error.assert_called_once_with("Error fetching emails: An error occurred")
 
 
@@ -1,13 +1,18 @@
 import unittest
 from unittest.mock import patch, MagicMock, call
+import os
 import sqlite3
+import tempfile
+import time
 from src.email_filter import EmailFilter
+from src.email_store import EmailStore
 
 
 class TestEmailFilter(unittest.TestCase):
 
     def setUp(self):
-        self.filter_manager = EmailFilter()
+        self.filter_manager = EmailFilter(credentials=MagicMock())
+        self.addCleanup(self.filter_manager.close)
         self.filter_manager.db_path = 'file:testdb?mode=memory&cache=shared'
         self.filter_manager.rules = {
             "rule1": {
@@ -16,57 +21,368 @@ class TestEmailFilter(unittest.TestCase):
             }
         }
 
-        self.connection = sqlite3.connect(self.filter_manager.db_path)
-        self.cursor = self.connection.cursor()
-
-        self.cursor.execute("DROP TABLE IF EXISTS inbox")
-        self.cursor.execute("CREATE TABLE IF NOT EXISTS inbox (message_id TEXT)")
-        self.cursor.execute("INSERT INTO inbox (message_id) VALUES ('msg1'), ('msg2')")
-        self.connection.commit()
+        # The shared in-memory database lives as long as this connection is open.
+        self.connection = sqlite3.connect(self.filter_manager.db_path, uri=True)
         self.addCleanup(self.connection.close)
+        store = EmailStore(self.filter_manager.db_path)
+        store.create_schema()
+        store.upsert_emails([{"message_id": "msg1"}, {"message_id": "msg2"}])
 
-    @patch('src.email_filter.build')
+    @patch('src.email_filter.get_gmail_service')
     def test_apply_filters_success(self, mock_build):
         mock_service = MagicMock()
         mock_build.return_value = mock_service
 
-        # Mock the search_emails method
-        with patch.object(self.filter_manager, 'search_emails', return_value=[{"message_id": "msg1"}]):
+        # Mock the search_rules method
+        with patch.object(self.filter_manager, 'search_rules', return_value=[("msg1", "rule1")]):
             result = self.filter_manager.apply_filters()
 
             self.assertTrue(result)
-            mock_build.assert_called_once_with('gmail', 'v1', credentials=self.filter_manager.credentials)
-            mock_service.users().messages().modify.assert_called_once_with(
+            mock_build.assert_called_once_with(self.filter_manager.credentials, None)
+            mock_service.users().messages().batchModify.assert_called_once_with(
                 userId='me',
-                id='msg1',
-                body={"addLabelIds": ["Label1"], "removeLabelIds": ["Label2"]}
+                body={"ids": ["msg1"], "addLabelIds": ["Label1"], "removeLabelIds": ["Label2"]}
             )
+            mock_service.users().messages().modify.assert_not_called()
+            self.assertEqual(self.filter_manager.failed_message_ids, [])
+
+    @patch('src.email_filter.get_gmail_service')
+    def test_apply_filters_merges_rules_per_message(self, mock_build):
+        mock_service = MagicMock()
+        mock_build.return_value = mock_service
+        self.filter_manager.rules["rule2"] = {
+            "criteria": [],
+            "action": [{"addLabelIds": ["Label3"], "removeLabelIds": []}]
+        }
+
+        matches = [("msg1", "rule1"), ("msg2", "rule1"), ("msg2", "rule2")]
+        with patch.object(self.filter_manager, 'search_rules', return_value=matches):
+            self.filter_manager.apply_filters()
 
-    @patch('src.email_filter.build')
+        mock_service.users().messages().batchModify.assert_has_calls([
+            call(userId='me', body={"ids": ["msg1"], "addLabelIds": ["Label1"], "removeLabelIds": ["Label2"]}),
+            call(userId='me', body={"ids": ["msg2"], "addLabelIds": ["Label1", "Label3"],
+                                    "removeLabelIds": ["Label2"]}),
+        ], any_order=True)
+
+    @patch('src.email_filter.get_gmail_service')
     def test_apply_filters_exception_handling(self, mock_build):
         mock_service = MagicMock()
         mock_build.return_value = mock_service
 
-        # Mock the search_emails method
-        with patch.object(self.filter_manager, 'search_emails', return_value=[{"message_id": "msg1"}]):
-            mock_service.users().messages().modify.side_effect = Exception("Modification error")
+        # Mock the search_rules method
+        with patch.object(self.filter_manager, 'search_rules', return_value=[("msg1", "rule1")]):
+            mock_service.users().messages().batchModify.side_effect = Exception("Modification error")
             result = self.filter_manager.apply_filters()
 
             self.assertTrue(result)
-            mock_build.assert_called_once_with('gmail', 'v1', credentials=self.filter_manager.credentials)
-            mock_service.users().messages().modify.assert_called_once_with(
+            mock_build.assert_called_once_with(self.filter_manager.credentials, None)
+            mock_service.users().messages().batchModify.assert_called_once_with(
                 userId='me',
-                id='msg1',
-                body={"addLabelIds": ["Label1"], "removeLabelIds": ["Label2"]}
+                body={"ids": ["msg1"], "addLabelIds": ["Label1"], "removeLabelIds": ["Label2"]}
             )
+            self.assertEqual(self.filter_manager.failed_message_ids, ["msg1"])
+
+    @patch('src.email_filter.get_gmail_service')
+    def test_apply_filters_without_changes_loads_no_credentials(self, mock_build):
+        with patch('src.oauth_token_manager.OAuthTokenManager') as mock_manager, \
+                patch.object(self.filter_manager, 'search_rules', return_value=[]):
+            self.assertTrue(self.filter_manager.apply_filters())
+
+        mock_build.assert_not_called()
+        mock_manager.assert_not_called()
+        self.assertEqual(self.filter_manager.failed_message_ids, [])
 
     def test_search_emails(self):
-        query_conditions = "message_id = 'msg1'"
+        query_conditions = ("message_id = ?", ["msg1"])
         with patch.object(self.filter_manager, '_form_query_conditions', return_value=query_conditions):
             result = self.filter_manager.search_emails(predicate="Equals", conditions={"message_id": "msg1"})
 
             self.assertEqual(result, [{'message_id': 'msg1'}])
 
+    def _use_store(self, emails):
+        self.filter_manager.close()
+        handle, self.filter_manager.db_path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.addCleanup(os.remove, self.filter_manager.db_path)
+        store = EmailStore(self.filter_manager.db_path)
+        store.create_schema()
+        store.upsert_emails(emails)
+
+    def _search(self, predicate, conditions):
+        return sorted(email["message_id"] for email in self.filter_manager.search_emails(predicate, conditions))
+
+    def test_search_emails_date_received_scans_the_received_at_index(self):
+        now = int(time.time())
+        self._use_store([
+            {"message_id": "msg1", "received_at": now - 3600},
+            {"message_id": "msg2", "received_at": now - 40 * 86400},
+            {"message_id": "msg3", "received_at": None},
+        ])
+        conditions = [{"field_name": "Date Received", "predicate": "Less than", "value": "30"}]
+
+        query, parameters = self.filter_manager._form_query_conditions("All", conditions)
+        with sqlite3.connect(self.filter_manager.db_path) as connection:
+            plan = " ".join(row[3] for row in connection.execute(
+                f"EXPLAIN QUERY PLAN SELECT message_id FROM inbox WHERE {query}", parameters))
+
+        self.assertIn("USING INDEX inbox_received_at (received_at>? AND received_at<?)", plan)
+        self.assertEqual(self._search("All", conditions), ["msg1"])
+
+    def test_search_emails_contains_uses_fts_index(self):
+        self._use_store([
+            {"message_id": "msg1", "from_id": "jobs@glassdoor.com", "subject": "New CREDIT offer"},
+            {"message_id": "msg2", "from_id": "courses@udemymail.com", "subject": "Genpact update"},
+            {"message_id": "msg3", "from_id": None, "subject": "Hi"},
+        ])
+        conditions = [{"field_name": "From", "predicate": "Contains", "value": "glassdoor"},
+                      {"field_name": "Subject", "predicate": "Contains", "value": "genpact"}]
+
+        query, _ = self.filter_manager._form_query_conditions("Any", conditions)
+
+        self.assertIn("inbox_fts", query)
+        self.assertEqual(self._search("Any", conditions), ["msg1", "msg2"])
+        self.assertEqual(self._search("All", conditions), [])
+
+    def test_search_emails_does_not_contain_uses_fts_index(self):
+        self._use_store([
+            {"message_id": "msg1", "from_id": "jobs@glassdoor.com", "subject": "New CREDIT offer"},
+            {"message_id": "msg2", "from_id": "courses@udemymail.com", "subject": "Genpact update"},
+            {"message_id": "msg3", "from_id": None, "subject": "Hi"},
+        ])
+
+        result = self._search("All", [{"field_name": "From", "predicate": "Does not Contain", "value": "glassdoor"}])
+
+        self.assertEqual(result, ["msg2"])
+
+    def test_search_emails_label_criteria_use_message_labels(self):
+        self._use_store([
+            {"message_id": "msg1", "labels": "INBOX,UNREAD"},
+            {"message_id": "msg2", "labels": "INBOX"},
+            {"message_id": "msg3", "labels": None},
+        ])
+        conditions = [{"field_name": "Labels", "predicate": "Has label", "value": "UNREAD"}]
+
+        query, parameters = self.filter_manager._form_query_conditions("All", conditions)
+        with sqlite3.connect(self.filter_manager.db_path) as connection:
+            plan = " ".join(row[3] for row in connection.execute(
+                f"EXPLAIN QUERY PLAN SELECT message_id FROM inbox WHERE {query}", parameters))
+
+        self.assertIn("message_labels USING PRIMARY KEY (label_id=?)", plan)
+        self.assertEqual(self._search("All", conditions), ["msg1"])
+        self.assertEqual(self._search("All", [{"field_name": "Labels", "predicate": "Lacks label",
+                                               "value": "UNREAD"}]), ["msg2"])
+
+    def test_search_emails_without_fts_indexes_scans_the_inbox(self):
+        with patch('src.email_store.trigram_supported', return_value=False):
+            self._use_store([
+                {"message_id": "msg1", "subject": "New CREDIT offer", "content": "Your statement",
+                 "labels": "INBOX,UNREAD"},
+                {"message_id": "msg2", "subject": "Genpact update", "content": "Hello", "labels": "INBOX"},
+            ])
+        conditions = [{"field_name": "Subject", "predicate": "Contains", "value": "credit"},
+                      {"field_name": "Message", "predicate": "Contains", "value": "statement"},
+                      {"field_name": "Labels", "predicate": "Has label", "value": "UNREAD"}]
+
+        query, _ = self.filter_manager._form_query_conditions("All", conditions)
+
+        self.assertNotIn("_fts", query)
+        self.assertEqual(self._search("All", conditions), ["msg1"])
+
+    def test_search_emails_short_values_fall_back_to_scan(self):
+        self._use_store([
+            {"message_id": "msg1", "subject": "New CREDIT offer"},
+            {"message_id": "msg2", "subject": "Hi"},
+        ])
+        conditions = [{"field_name": "Subject", "predicate": "Contains", "value": "hi"}]
+
+        query = self.filter_manager._form_query_conditions("All", conditions)
+
+        self.assertEqual(query, ("subject LIKE ?", ["%hi%"]))
+        self.assertEqual(self._search("All", conditions), ["msg2"])
+
+    def test_search_emails_binds_values_with_quotes(self):
+        self._use_store([
+            {"message_id": "msg1", "subject": "Don't miss out"},
+            {"message_id": "msg2", "subject": "Hi"},
+        ])
+
+        self.assertEqual(self._search("All", [{"field_name": "Subject", "predicate": "Contains",
+                                               "value": "don't"}]), ["msg1"])
+        self.assertEqual(self._search("All", [{"field_name": "Subject", "predicate": "Equals",
+                                               "value": "Don't miss out"}]), ["msg1"])
+
+    def test_rules_of_the_same_shape_share_one_statement(self):
+        self._use_store([])
+        first = self.filter_manager._form_query_conditions("All", [
+            {"field_name": "From", "predicate": "Contains", "value": "glassdoor"}])
+        second = self.filter_manager._form_query_conditions("All", [
+            {"field_name": "From", "predicate": "Contains", "value": "udemymail"}])
+
+        self.assertIs(first[0], second[0])
+        self.assertEqual((first[1], second[1]), (["%glassdoor%"], ["%udemymail%"]))
+        self.assertEqual(len(self.filter_manager.compiler.statements), 1)
+
+    def test_search_rules_scans_the_inbox_once_for_unindexed_rules(self):
+        self._use_store([
+            {"message_id": "msg1", "from_id": "jobs@glassdoor.com", "subject": "New CREDIT offer"},
+            {"message_id": "msg2", "from_id": "courses@udemymail.com", "subject": "Genpact update"},
+            {"message_id": "msg3", "from_id": "friend@example.com", "subject": "Hi"},
+        ])
+        rules = {
+            "jobs": {"predicates": "Any", "criteria": [
+                {"field_name": "From", "predicate": "Contains", "value": "glassdoor"},
+                {"field_name": "Subject", "predicate": "Contains", "value": "genpact"}]},
+            "friend": {"predicates": "All", "criteria": [
+                {"field_name": "From", "predicate": "Equals", "value": "friend@example.com"}]},
+            "no_offer": {"predicates": "All", "criteria": [
+                {"field_name": "Subject", "predicate": "Does not Contain", "value": "offer"}]},
+            "nothing": {"predicates": "Any", "criteria": []},
+        }
+        statements = []
+        self.filter_manager.connect().set_trace_callback(statements.append)
+
+        pairs = self.filter_manager.search_rules(rules)
+
+        self.assertEqual(sorted(pairs), [("msg1", "jobs"), ("msg2", "jobs"), ("msg2", "no_offer"),
+                                         ("msg3", "friend"), ("msg3", "no_offer")])
+        self.assertEqual([name for message_id, name in pairs if message_id == "msg2"], ["jobs", "no_offer"])
+        # One indexed statement for "jobs" and one scan for the other rules.
+        self.assertEqual(len([statement for statement in statements if "FROM inbox" in statement]), 2)
+        self.assertEqual({dict(labels)["rule"] for name, labels in self.filter_manager.metrics.histograms
+                          if name == "gmail_rule_query_seconds"}, {"jobs", "scan"})
+        for rule_name, rule_data in rules.items():
+            self.assertEqual(self._search(rule_data["predicates"], rule_data["criteria"]),
+                             sorted(message_id for message_id, name in pairs if name == rule_name))
+
+    @patch('src.email_filter.get_gmail_service')
+    def test_apply_filters_indexed_matches_query_path(self, mock_build):
+        emails = [
+            {"message_id": "msg1", "from_id": "jobs@glassdoor.com", "subject": "New CREDIT offer"},
+            {"message_id": "msg2", "from_id": "courses@udemymail.com", "subject": "Genpact update"},
+            {"message_id": "msg3", "from_id": "friend@example.com", "subject": "Hi"},
+        ]
+        self.filter_manager.rules = {
+            "rule_2": {"predicates": "Any", "criteria": [
+                {"field_name": "From", "predicate": "Contains", "value": "glassdoor"},
+                {"field_name": "From", "predicate": "Contains", "value": "udemymail"}],
+                "action": [{"addLabelIds": ["SPAM"], "removeLabelIds": ["IMPORTANT"]}]},
+            "rule_3": {"predicates": "Any", "criteria": [
+                {"field_name": "Subject", "predicate": "Contains", "value": "CRED"}],
+                "action": [{"addLabelIds": ["STARRED"], "removeLabelIds": []}]},
+        }
+        calls = {}
+        for use_index in (False, True):
+            self._use_store(emails)
+            mock_service = MagicMock()
+            mock_build.return_value = mock_service
+            self.filter_manager.apply_filters(use_index=use_index)
+            calls[use_index] = sorted(str(args) for args in mock_service.users().messages().batchModify.call_args_list)
+
+        self.assertEqual(len(calls[True]), 2)
+        self.assertEqual(calls[True], calls[False])
+
+    @patch('src.email_filter.get_gmail_service')
+    def test_apply_filters_skips_applied_and_satisfied_actions(self, mock_build):
+        self._use_store([
+            {"message_id": "msg1", "from_id": "jobs@glassdoor.com", "labels": "INBOX"},
+            {"message_id": "msg2", "from_id": "alerts@glassdoor.com", "labels": "INBOX,STARRED"},
+        ])
+        self.filter_manager.rules = {"rule": {"predicates": "All", "criteria": [
+            {"field_name": "From", "predicate": "Contains", "value": "glassdoor"}],
+            "action": [{"addLabelIds": ["STARRED"], "removeLabelIds": []}]}}
+        batch_modify = mock_build.return_value.users.return_value.messages.return_value.batchModify
+
+        self.filter_manager.apply_filters()
+        self.filter_manager.apply_filters()
+
+        batch_modify.assert_called_once_with(
+            userId='me', body={"ids": ["msg1"], "addLabelIds": ["STARRED"], "removeLabelIds": []})
+        self.assertEqual(self.filter_manager.metrics.value("gmail_modify_skipped_total"), 2)
+
+        # A changed rule has a new hash and is applied again.
+        self.filter_manager.rules["rule"]["action"] = [{"addLabelIds": ["IMPORTANT"], "removeLabelIds": ["STARRED"]}]
+        self.filter_manager.apply_filters()
+
+        self.assertEqual(batch_modify.call_args, call(
+            userId='me', body={"ids": ["msg1", "msg2"], "addLabelIds": ["IMPORTANT"], "removeLabelIds": ["STARRED"]}))
+
+    @patch('src.outbox_drainer.OutboxDrainer.retry_delay', return_value=0)
+    @patch('src.email_filter.get_gmail_service')
+    def test_apply_filters_dead_letters_a_change_that_keeps_failing(self, mock_build, mock_retry_delay):
+        self._use_store([{"message_id": "msg1", "from_id": "jobs@glassdoor.com", "labels": "INBOX"}])
+        self.filter_manager.rules = {"rule": {"predicates": "All", "criteria": [
+            {"field_name": "From", "predicate": "Contains", "value": "glassdoor"}],
+            "action": [{"addLabelIds": ["Label_1"], "removeLabelIds": []}]}}
+        batch_modify = mock_build.return_value.users.return_value.messages.return_value.batchModify
+        batch_modify.return_value.execute.side_effect = Exception("Invalid label")
+
+        for _ in range(8):
+            self.filter_manager.apply_filters()
+
+        self.assertEqual(batch_modify.return_value.execute.call_count, 5)
+        self.assertEqual(EmailStore(self.filter_manager.db_path).count_actions(),
+                         {"pending": 0, "done": 0, "dead": 1})
+
+    def test_search_emails_message_criteria_read_compressed_bodies(self):
+        self._use_store([
+            {"message_id": "msg1", "subject": "One", "content": "Your OTP is 1234"},
+            {"message_id": "msg2", "subject": "Two", "content": "ok"},
+            {"message_id": "msg3", "subject": "Three", "content": None},
+        ])
+
+        self.assertEqual(self._search("All", [{"field_name": "Message", "predicate": "Contains", "value": "otp is"}]),
+                         ["msg1"])
+        self.assertEqual(self._search("All", [{"field_name": "Message", "predicate": "Does not Contain",
+                                               "value": "otp"}]), ["msg2"])
+        self.assertEqual(self._search("All", [{"field_name": "Message", "predicate": "Contains", "value": "k"}]),
+                         ["msg2"])
+        self.assertEqual(self._search("All", [{"field_name": "Message", "predicate": "Equals", "value": "ok"}]),
+                         ["msg2"])
+
+    @patch('src.email_filter.get_gmail_service')
+    def test_apply_filters_indexed_loads_bodies_for_message_rules(self, mock_build):
+        self._use_store([
+            {"message_id": "msg1", "subject": "One", "content": "Your OTP is 1234"},
+            {"message_id": "msg2", "subject": "Two", "content": "ok"},
+        ])
+        self.filter_manager.rules = {"otp": {"predicates": "Any", "criteria": [
+            {"field_name": "Message", "predicate": "Contains", "value": "OTP"}],
+            "action": [{"addLabelIds": ["STARRED"], "removeLabelIds": []}]}}
+        mock_service = MagicMock()
+        mock_build.return_value = mock_service
+
+        self.filter_manager.apply_filters(use_index=True)
+
+        mock_service.users().messages().batchModify.assert_called_once_with(
+            userId='me', body={"ids": ["msg1"], "addLabelIds": ["STARRED"], "removeLabelIds": []})
+
+    @patch('src.email_filter.get_gmail_service')
+    def test_apply_filters_indexed_reads_bodies_of_a_migrated_database(self, mock_build):
+        self.filter_manager.close()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filter_manager.db_path = os.path.join(directory.name, "email_db.db")
+        with sqlite3.connect(self.filter_manager.db_path) as connection:
+            connection.execute("CREATE TABLE inbox (id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT, "
+                               "from_id TEXT, to_id TEXT, date TEXT, content_type TEXT, content TEXT, "
+                               "subject TEXT, labels TEXT)")
+            connection.executemany("INSERT INTO inbox (message_id, content) VALUES (?, ?)",
+                                   [("msg1", "Your OTP is 1234"), ("msg2", "ok")])
+        store = EmailStore(self.filter_manager.db_path)
+        store.create_schema()
+        store.upsert_emails([{"message_id": "msg3", "content": "Another OTP"}])
+        self.filter_manager.rules = {"otp": {"predicates": "Any", "criteria": [
+            {"field_name": "Message", "predicate": "Contains", "value": "OTP"}],
+            "action": [{"addLabelIds": ["STARRED"], "removeLabelIds": []}]}}
+        mock_service = MagicMock()
+        mock_build.return_value = mock_service
+
+        self.filter_manager.apply_filters(use_index=True)
+
+        mock_service.users().messages().batchModify.assert_called_once_with(
+            userId='me', body={"ids": ["msg1", "msg3"], "addLabelIds": ["STARRED"], "removeLabelIds": []})
+
     def test_validate_rules_success(self):
         # No exceptions should be raised for valid rules
         self.filter_manager._validate_rules()
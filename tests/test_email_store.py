@@ -0,0 +1,270 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+from src.email_store import EmailStore, LazyEmail, compress_body
+
+
+class TestEmailStore(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.db_path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.addCleanup(self._remove_database)
+        self.store = EmailStore(self.db_path)
+        self.email = {
+            "message_id": "msg1",
+            "from_id": "test@example.com",
+            "to_id": "recipient@example.com",
+            "date": "2023-08-21 12:34",
+            "content_type": "text/plain",
+            "content": "This is a test email.",
+            "subject": "Test",
+            "labels": "INBOX"
+        }
+
+    def _remove_database(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
+
+    def _rows(self):
+        with sqlite3.connect(self.db_path) as connection:
+            return connection.execute("SELECT message_id, subject, labels FROM inbox ORDER BY message_id").fetchall()
+
+    def test_create_schema_enables_wal(self):
+        self.store.create_schema()
+
+        with sqlite3.connect(self.db_path) as connection:
+            self.assertEqual(connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+    def test_upsert_emails_is_idempotent(self):
+        self.store.create_schema()
+
+        self.store.upsert_emails([self.email])
+        self.store.upsert_emails([self.email])
+
+        self.assertEqual(self._rows(), [("msg1", "Test", "INBOX")])
+
+    def test_upsert_emails_updates_existing_rows(self):
+        self.store.create_schema()
+        self.store.upsert_emails([self.email])
+
+        self.store.upsert_emails([dict(self.email, labels="INBOX,STARRED"), dict(self.email, message_id="msg2")])
+
+        self.assertEqual(self._rows(), [("msg1", "Test", "INBOX,STARRED"), ("msg2", "Test", "INBOX")])
+
+    def test_upsert_emails_rolls_back_on_error(self):
+        self.store.create_schema()
+
+        with self.assertRaises(sqlite3.Error):
+            self.store.upsert_emails([dict(self.email, message_id="msg2"), dict(self.email, subject=object())])
+
+        self.assertEqual(self._rows(), [])
+
+    def test_create_schema_deduplicates_existing_database(self):
+        with sqlite3.connect(self.db_path) as connection:
+            connection.execute("""
+                CREATE TABLE inbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT, from_id TEXT, to_id TEXT, date TEXT,
+                    content_type TEXT, content TEXT, subject TEXT, labels TEXT
+                )
+            """)
+            connection.executemany("INSERT INTO inbox (message_id, subject, labels) VALUES (?, ?, ?)",
+                                   [("msg1", "Test", "INBOX"), ("msg1", "Test", "INBOX,STARRED"),
+                                    ("msg2", "Other", "INBOX")])
+
+        self.store.create_schema()
+
+        self.assertEqual(self._rows(), [("msg1", "Test", "INBOX,STARRED"), ("msg2", "Other", "INBOX")])
+        with self.assertRaises(sqlite3.IntegrityError), sqlite3.connect(self.db_path) as connection:
+            connection.execute("INSERT INTO inbox (message_id) VALUES ('msg2')")
+
+    def test_create_schema_adds_indexed_received_at(self):
+        with sqlite3.connect(self.db_path) as connection:
+            connection.execute("""
+                CREATE TABLE inbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT, from_id TEXT, to_id TEXT, date TEXT,
+                    content_type TEXT, content TEXT, subject TEXT, labels TEXT
+                )
+            """)
+            connection.executemany("INSERT INTO inbox (message_id, date) VALUES (?, ?)",
+                                   [("msg1", "2023-08-21 12:34"), ("msg2", None)])
+
+        self.store.create_schema()
+
+        with sqlite3.connect(self.db_path) as connection:
+            rows = connection.execute("SELECT message_id, received_at FROM inbox ORDER BY message_id").fetchall()
+            plan = connection.execute("EXPLAIN QUERY PLAN SELECT id FROM inbox WHERE received_at >= 0").fetchall()
+        self.assertEqual(rows, [("msg1", 1692621240), ("msg2", None)])
+        self.assertIn("inbox_received_at", plan[0][3])
+
+    def _fts_matches(self, column, value):
+        with sqlite3.connect(self.db_path) as connection:
+            return connection.execute(f"SELECT i.message_id FROM inbox_fts f JOIN inbox i ON i.id = f.rowid "
+                                      f"WHERE f.{column} LIKE ? ORDER BY i.message_id", (f"%{value}%",)).fetchall()
+
+    def test_fts_index_follows_upserts(self):
+        self.store.create_schema()
+        self.store.upsert_emails([self.email, dict(self.email, message_id="msg2", subject="Invoice due")])
+
+        self.store.upsert_emails([dict(self.email, subject="Renamed")])
+
+        self.assertEqual(self._fts_matches("subject", "Test"), [])
+        self.assertEqual(self._fts_matches("subject", "renam"), [("msg1",)])
+        self.assertEqual(self._fts_matches("subject", "voice"), [("msg2",)])
+
+    def test_create_schema_indexes_existing_rows(self):
+        with sqlite3.connect(self.db_path) as connection:
+            connection.execute("""
+                CREATE TABLE inbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT, from_id TEXT, to_id TEXT, date TEXT,
+                    content_type TEXT, content TEXT, subject TEXT, labels TEXT
+                )
+            """)
+            connection.execute("INSERT INTO inbox (message_id, from_id) VALUES ('msg1', 'jobs@glassdoor.com')")
+
+        self.store.create_schema()
+
+        self.assertEqual(self._fts_matches("from_id", "glassdoor"), [("msg1",)])
+
+    def _body_matches(self, value):
+        with sqlite3.connect(self.db_path) as connection:
+            return connection.execute("SELECT i.message_id FROM body_fts f JOIN inbox i ON i.id = f.rowid "
+                                      "WHERE body_fts MATCH ? ORDER BY i.message_id",
+                                      (f'body:"{value}"',)).fetchall()
+
+    def test_upsert_emails_stores_compressed_bodies(self):
+        self.store.create_schema()
+
+        self.store.upsert_emails([self.email])
+
+        with sqlite3.connect(self.db_path) as connection:
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(inbox)")]
+            stored = connection.execute("SELECT body FROM email_bodies WHERE message_id = 'msg1'").fetchone()[0]
+        self.assertNotIn("content", columns)
+        self.assertEqual(stored, compress_body("This is a test email."))
+        self.assertEqual(self.store.get_body("msg1"), "This is a test email.")
+        self.assertEqual(self._body_matches("test emai"), [("msg1",)])
+
+    def test_upsert_emails_indexes_each_body_once(self):
+        self.store.create_schema()
+
+        self.store.upsert_emails([self.email])
+        self.store.upsert_emails([self.email, dict(self.email, message_id="msg2", content=None)])
+
+        with sqlite3.connect(self.db_path) as connection:
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM email_bodies").fetchone()[0], 1)
+        self.assertEqual(self._body_matches("test"), [("msg1",)])
+        self.assertIsNone(self.store.get_body("msg2"))
+
+    @patch('src.email_store.trigram_supported', return_value=False)
+    def test_create_schema_skips_fts_indexes_without_trigram_support(self, mock_supported):
+        self.store.create_schema()
+
+        self.store.upsert_emails([self.email])
+
+        with sqlite3.connect(self.db_path) as connection:
+            tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self.assertNotIn("inbox_fts", tables)
+        self.assertNotIn("body_fts", tables)
+        self.assertEqual(self._rows(), [("msg1", "Test", "INBOX")])
+        self.assertEqual(self.store.get_body("msg1"), "This is a test email.")
+
+    def test_create_schema_indexes_bodies_stored_without_trigram_support(self):
+        with patch('src.email_store.trigram_supported', return_value=False):
+            self.store.create_schema()
+            self.store.upsert_emails([self.email])
+
+        self.store.create_schema()
+
+        self.assertEqual(self._body_matches("test emai"), [("msg1",)])
+        self.assertEqual(self._fts_matches("subject", "test"), [("msg1",)])
+
+    def test_create_schema_moves_inline_bodies(self):
+        with sqlite3.connect(self.db_path) as connection:
+            connection.execute("""
+                CREATE TABLE inbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT, from_id TEXT, to_id TEXT, date TEXT,
+                    content_type TEXT, content TEXT, subject TEXT, labels TEXT
+                )
+            """)
+            connection.execute("CREATE VIRTUAL TABLE inbox_fts USING fts5(subject, from_id, to_id, content, "
+                               "content='inbox', content_rowid='id', tokenize='trigram')")
+            connection.execute("CREATE TRIGGER inbox_fts_insert AFTER INSERT ON inbox BEGIN "
+                               "INSERT INTO inbox_fts (rowid, subject, from_id, to_id, content) "
+                               "VALUES (new.id, new.subject, new.from_id, new.to_id, new.content); END")
+            connection.execute("INSERT INTO inbox (message_id, subject, content) VALUES ('msg1', 'Hi', 'Old body')")
+
+        self.store.create_schema()
+        self.store.upsert_emails([dict(self.email, message_id="msg2")])
+
+        self.assertEqual(self.store.get_body("msg1"), "Old body")
+        self.assertEqual(self._body_matches("old bo"), [("msg1",)])
+        self.assertEqual(self._fts_matches("subject", "test"), [("msg2",)])
+        with sqlite3.connect(self.db_path) as connection:
+            self.assertEqual(connection.execute("SELECT content FROM inbox WHERE message_id = 'msg1'").fetchone(),
+                             (None,))
+
+    def test_create_schema_fills_message_labels_from_existing_rows(self):
+        with sqlite3.connect(self.db_path) as connection:
+            connection.execute("""
+                CREATE TABLE inbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT, from_id TEXT, to_id TEXT, date TEXT,
+                    content_type TEXT, content TEXT, subject TEXT, labels TEXT
+                )
+            """)
+            connection.execute("INSERT INTO inbox (message_id, labels) VALUES ('msg1', 'INBOX,UNREAD'), ('msg2', NULL)")
+
+        self.store.create_schema()
+
+        self.assertEqual(self.store.get_labels("msg1"), {"INBOX", "UNREAD"})
+        self.assertEqual(self.store.get_labels("msg2"), set())
+
+    def test_upsert_emails_replaces_message_labels(self):
+        self.store.create_schema()
+        self.store.upsert_emails([dict(self.email, labels="INBOX,UNREAD")])
+        self.store.upsert_emails([dict(self.email, labels="INBOX,STARRED")])
+
+        self.assertEqual(self.store.get_labels("msg1"), {"INBOX", "STARRED"})
+
+    def test_apply_label_changes_updates_labels_column(self):
+        self.store.create_schema()
+        self.store.upsert_emails([dict(self.email, labels="INBOX,UNREAD")])
+
+        self.store.apply_label_changes(["msg1", "unknown"], add_label_ids=["STARRED"], remove_label_ids=["UNREAD"])
+
+        self.assertEqual(self.store.get_labels("msg1"), {"INBOX", "STARRED"})
+        self.assertEqual(self.store.get_labels("unknown"), set())
+        self.assertEqual(sorted(self._rows()[0][2].split(",")), ["INBOX", "STARRED"])
+
+    def test_applied_rules_journal_round_trip(self):
+        self.store.create_schema()
+        self.store.upsert_emails([self.email])
+
+        self.store.record_applied_rules({"msg1": {"rule_a", "rule_b"}, "msg2": {"rule_a"}})
+        self.store.prune_applied_rules(["rule_a"])
+
+        self.assertEqual(self.store.get_applied_rules(["msg1", "msg2", "msg3"]),
+                         {"msg1": {"rule_a"}, "msg2": {"rule_a"}})
+        self.assertEqual(self.store.get_labels_by_message(["msg1", "msg2"]), {"msg1": {"INBOX"}})
+
+    def test_lazy_email_decompresses_on_access(self):
+        email = LazyEmail({"message_id": "msg1"}, compress_body("Body"))
+
+        self.assertNotIn("content", email)
+        self.assertEqual(email.get("content"), "Body")
+        self.assertIsNone(LazyEmail({}, None).get("content"))
+
+    def test_state_round_trip(self):
+        self.store.create_schema()
+
+        self.assertIsNone(self.store.get_state("history_id"))
+        self.store.set_state("history_id", 1234)
+
+        self.assertEqual(self.store.get_state("history_id"), "1234")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+from google.oauth2.credentials import Credentials
+from benchmarks.fake_gmail_server import FakeGmailServer, FakeMailbox, error_body
+from src.email_fetcher import EmailFetcher
+from src.email_watcher import EmailWatcher
+
+
+class TestEmailWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.mailbox = FakeMailbox(30, body_size=100)
+        self.server = FakeGmailServer(self.mailbox)
+        self.server.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.fetcher = EmailFetcher(max_workers=2, credentials=Credentials(token="test"),
+                                    db_path=os.path.join(self.directory.name, "email_db.db"),
+                                    api_endpoint=self.server.url, units_per_second=100_000)
+        self.fetcher.rules_file = os.path.join(self.directory.name, "rules.json")
+        with open(self.fetcher.rules_file, "w") as file:
+            json.dump({"rule": {"predicates": "All",
+                                "criteria": [{"field_name": "From", "predicate": "Contains", "value": "@example.com"}],
+                                "action": [{"addLabelIds": ["Label_1"], "removeLabelIds": []}]}}, file)
+        self.watcher = EmailWatcher(self.fetcher, min_interval=0.01, max_interval=0.05, page_size=10, batch_size=10)
+
+    def _start(self):
+        thread = threading.Thread(target=self.watcher.run)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(self.watcher.stop)
+        return thread
+
+    def _wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_next_interval_backs_off_while_idle(self):
+        watcher = EmailWatcher(MagicMock(), min_interval=10, max_interval=60, backoff_factor=2)
+
+        self.assertEqual(watcher.next_interval(10, 0), 20)
+        self.assertEqual(watcher.next_interval(40, 0), 60)
+        self.assertEqual(watcher.next_interval(60, 3), 10)
+
+    def test_run_labels_existing_and_new_mail(self):
+        self._start()
+
+        self.assertTrue(self._wait_for(lambda: "Label_1" in self.mailbox.label_ids(0)))
+        new_id = self.mailbox.deliver(2)[0]
+        self.assertTrue(self._wait_for(lambda: "Label_1" in self.mailbox.label_ids(self.mailbox.index(new_id))))
+        self.assertNotIn("Label_1", self.mailbox.label_ids(1))
+
+    def test_stop_drains_queued_work_and_keeps_the_checkpoint(self):
+        self.fetcher.create_table()
+        thread = self._start()
+        self.assertTrue(self._wait_for(lambda: self.fetcher.get_checkpoint() is not None))
+
+        self.watcher.stop()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(self.watcher.evaluate_queue.empty())
+        self.assertTrue(self.watcher.action_queue.empty())
+        self.assertIn("Label_1", self.mailbox.label_ids(28))
+
+    def test_failed_label_changes_stay_in_the_outbox(self):
+        dispatch = self.server.dispatch
+
+        def reject_modify(method, path, query, body):
+            if path.endswith("batchModify"):
+                return 400, error_body(400, "invalidArgument", "Invalid label.")
+            return dispatch(method, path, query, body)
+
+        self.server.dispatch = reject_modify
+        self.fetcher.create_table()
+        thread = self._start()
+        self.assertTrue(self._wait_for(lambda: self.fetcher.get_checkpoint() is not None))
+
+        self.watcher.stop()
+        thread.join(5)
+
+        self.assertNotIn("Label_1", self.mailbox.label_ids(0))
+        self.assertGreater(self.fetcher.store.count_actions()["pending"], 0)
+
+
+    def test_messages_that_fail_to_download_are_retried_by_the_next_poll(self):
+        failing_id = self.mailbox.message_id(2)
+        dispatch, requested = self.server.dispatch, []
+
+        def reject_once(method, path, query, body):
+            message_id = path.rstrip("/").rsplit("/", 1)[-1]
+            requested.append(message_id)
+            if message_id == failing_id and requested.count(message_id) == 1:
+                return 404, error_body(404, "notFound", "Requested entity was not found.")
+            return dispatch(method, path, query, body)
+
+        self.server.dispatch = reject_once
+        self.fetcher.create_table()
+        self.fetcher.store.set_state("retry_message_ids", json.dumps({"abc": 1}))
+        thread = self._start()
+
+        self.assertTrue(self._wait_for(lambda: bool(self.fetcher.store.get_labels(failing_id))))
+        self.watcher.stop()
+        thread.join(5)
+
+        self.assertIn("abc", requested)
+        self.assertNotIn(failing_id, self.fetcher.get_retry_ids())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from google.oauth2.credentials import Credentials
+from benchmarks.fake_gmail_server import FakeGmailServer, FakeMailbox
+from src.email_fetcher import EmailFetcher
+from src.email_filter import EmailFilter
+
+
+class TestFakeGmailServer(unittest.TestCase):
+
+    def setUp(self):
+        self.mailbox = FakeMailbox(120, body_size=200)
+        self.server = FakeGmailServer(self.mailbox)
+        self.server.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.db_path = os.path.join(self.directory.name, "email_db.db")
+        self.credentials = Credentials(token="test")
+
+    def _fetcher(self):
+        return EmailFetcher(max_workers=4, credentials=self.credentials, db_path=self.db_path,
+                            api_endpoint=self.server.url, units_per_second=100_000)
+
+    def _message_ids(self):
+        with sqlite3.connect(self.db_path) as connection:
+            return {row[0] for row in connection.execute("SELECT message_id FROM inbox")}
+
+    def test_sync_emails_fetches_the_whole_mailbox(self):
+        self._fetcher().sync_emails(page_size=50, batch_size=25)
+
+        self.assertEqual(self._message_ids(), {self.mailbox.message_id(index) for index in range(120)})
+
+    def test_sync_emails_exports_stage_metrics(self):
+        fetcher = self._fetcher()
+        fetcher.metrics_dir = os.path.join(self.directory.name, "metrics")
+
+        fetcher.sync_emails(page_size=50, batch_size=25)
+
+        self.assertEqual(fetcher.metrics.value("gmail_stage_items_total", stage="get"), 120)
+        self.assertEqual(fetcher.metrics.value("gmail_stage_items_total", stage="db_write"), 120)
+        self.assertGreater(fetcher.metrics.value("gmail_message_bytes_total"), 120 * 200)
+        with open(os.path.join(fetcher.metrics_dir, "sync.json")) as file:
+            stages = {series["labels"]["stage"] for series in json.load(file)["histograms"]["gmail_stage_seconds"]}
+        # Without apply_rules nothing is enqueued, so no modify stage runs.
+        self.assertEqual(stages, {"list", "get", "parse", "db_write"})
+
+    def test_sync_emails_picks_up_delivered_messages_through_history(self):
+        fetcher = self._fetcher()
+        fetcher.sync_emails(page_size=50, batch_size=50)
+
+        new_ids = self.mailbox.deliver(3)
+        fetcher.sync_emails(page_size=50, batch_size=50)
+
+        self.assertTrue(set(new_ids) <= self._message_ids())
+        self.assertEqual(fetcher.get_checkpoint(), str(self.mailbox.history_id))
+
+    def test_apply_filters_modifies_labels(self):
+        self._fetcher().sync_emails(page_size=50, batch_size=50)
+        rules_file = os.path.join(self.directory.name, "rules.json")
+        with open(rules_file, "w") as file:
+            json.dump({"rule": {"predicates": "All",
+                                "criteria": [{"field_name": "From", "predicate": "Contains", "value": "@example.com"}],
+                                "action": [{"addLabelIds": ["Label_1"], "removeLabelIds": ["INBOX"]}]}}, file)
+
+        email_filter = EmailFilter(credentials=self.credentials, db_path=self.db_path, rules_file=rules_file,
+                                   api_endpoint=self.server.url, units_per_second=100_000)
+        email_filter.apply_filters()
+
+        self.assertEqual(email_filter.failed_message_ids, [])
+        self.assertEqual(self.mailbox.label_ids(0), ["Label_1"])
+        self.assertIn("INBOX", self.mailbox.label_ids(1))
+
+    def test_history_older_than_retention_is_not_found(self):
+        self.mailbox.deliver(2)
+
+        status, _ = self.server.dispatch("GET", "/gmail/v1/users/me/history", {"startHistoryId": ["1"]}, b"")
+
+        self.assertEqual(status, 404)
+
+    def test_error_rate_answers_with_rate_limit_errors(self):
+        self.server.error_rate = 1.0
+
+        status, response = self.server.dispatch("GET", "/gmail/v1/users/me/profile", {}, b"")
+
+        self.assertEqual(status, 429)
+        self.assertEqual(response["error"]["errors"][0]["reason"], "rateLimitExceeded")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+from src import gmail_client
+from src.gmail_client import get_authorized_http, get_discovery_document, get_gmail_service
+
+
+class TestGmailClient(unittest.TestCase):
+
+    def setUp(self):
+        self.credentials = MagicMock()
+
+    def _in_thread(self, function, *args):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(function(*args)))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_discovery_document_is_parsed_once(self):
+        with patch.object(gmail_client, "_discovery_document", None), \
+                patch("googleapiclient.discovery_cache.get_static_doc", return_value='{"name": "gmail"}') as mock_doc:
+            self.assertEqual(get_discovery_document(), {"name": "gmail"})
+            self.assertIs(get_discovery_document(), get_discovery_document())
+
+        mock_doc.assert_called_once_with("gmail", "v1")
+
+    def test_authorized_http_is_reused_within_a_thread(self):
+        http = get_authorized_http(self.credentials)
+
+        self.assertIs(get_authorized_http(self.credentials), http)
+        self.assertIs(http.credentials, self.credentials)
+        self.assertIsNot(get_authorized_http(MagicMock()), http)
+
+    def test_authorized_http_is_not_shared_between_threads(self):
+        http = get_authorized_http(self.credentials)
+
+        self.assertIsNot(self._in_thread(get_authorized_http, self.credentials), http)
+
+    @patch("googleapiclient.discovery.build_from_document")
+    def test_service_is_built_once_per_thread(self, mock_build):
+        mock_build.side_effect = lambda *args, **kwargs: MagicMock()
+
+        service = get_gmail_service(self.credentials)
+
+        self.assertIs(get_gmail_service(self.credentials), service)
+        self.assertIsNot(self._in_thread(get_gmail_service, self.credentials), service)
+        self.assertEqual(mock_build.call_count, 2)
+        self.assertIs(mock_build.call_args_list[0].kwargs["http"], get_authorized_http(self.credentials))
+
+    @patch("googleapiclient.discovery.build_from_document")
+    def test_service_targets_the_given_endpoint(self, mock_build):
+        get_gmail_service(self.credentials, api_endpoint="http://127.0.0.1:8080")
+
+        self.assertEqual(mock_build.call_args.kwargs["client_options"], {"api_endpoint": "http://127.0.0.1:8080"})
+        self.assertEqual(mock_build.call_args.args[0]["rootUrl"], "http://127.0.0.1:8080/")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+from email.message import EmailMessage
+from email.parser import BytesParser
+from src.message_parser import (extract_body, format_timestamp, header_text, html_to_text, parse_source,
+                                received_timestamp)
+
+
+class TestMessageParser(unittest.TestCase):
+
+    def _multipart(self, plain=None, html=None, attachment=None):
+        message = EmailMessage()
+        message["Subject"] = "Test"
+        if plain is not None:
+            message.set_content(plain)
+        if html is not None:
+            if plain is None:
+                message.set_content(html, subtype="html")
+            else:
+                message.add_alternative(html, subtype="html")
+        if attachment is not None:
+            message.add_attachment(attachment, filename="notes.txt")
+        return message
+
+    def test_extract_body_prefers_plain_text(self):
+        message = self._multipart(plain="Plain body\n", html="<p>HTML body</p>")
+
+        self.assertEqual(extract_body(message), "Plain body\n")
+
+    def test_extract_body_falls_back_to_html(self):
+        message = self._multipart(html="<html><head><style>p {}</style></head><body><p>Hello &amp; bye</p></body>")
+        message.add_attachment("not the body", filename="notes.txt")
+
+        self.assertEqual(extract_body(message), "Hello & bye")
+
+    def test_extract_body_ignores_attachments(self):
+        message = EmailMessage()
+        message.set_content("<b>Body</b>", subtype="html")
+        message.add_attachment("attached text", filename="notes.txt")
+
+        self.assertEqual(extract_body(message), "Body")
+
+    def test_extract_body_decodes_charset_and_transfer_encoding(self):
+        message = EmailMessage()
+        message.set_content("Grüße aus Köln\n", charset="iso-8859-1", cte="quoted-printable")
+
+        self.assertEqual(extract_body(message), "Grüße aus Köln\n")
+
+    def test_extract_body_caps_length(self):
+        message = self._multipart(plain="x" * 50)
+
+        self.assertEqual(extract_body(message, max_length=10), "x" * 10)
+
+    def test_extract_body_without_text_part(self):
+        message = EmailMessage()
+        message.set_content(b"\x00\x01", maintype="application", subtype="octet-stream")
+
+        self.assertIsNone(extract_body(message))
+
+    def test_html_to_text(self):
+        self.assertEqual(html_to_text("<div>One</div>\n\n\n<div>Two&nbsp;<script>x()</script></div>"),
+                         "One\n\nTwo")
+
+
+    def test_received_timestamp_parses_any_offset_and_missing_weekday(self):
+        self.assertEqual(received_timestamp("Mon, 21 Aug 2023 12:34:56 +0000"), 1692621296)
+        self.assertEqual(received_timestamp("Mon, 21 Aug 2023 07:34:56 -0500"), 1692621296)
+        self.assertEqual(received_timestamp("21 Aug 2023 14:34:56 +0200"), 1692621296)
+        self.assertEqual(received_timestamp("21 Aug 2023 12:34:56 -0000"), 1692621296)
+
+    def test_received_timestamp_prefers_internal_date(self):
+        self.assertEqual(received_timestamp("Mon, 21 Aug 2023 12:34:56 +0000", "1700000000123"), 1700000000)
+        self.assertEqual(received_timestamp(None, "1700000000123"), 1700000000)
+
+    def test_received_timestamp_without_a_usable_source(self):
+        self.assertIsNone(received_timestamp("not a date"))
+        self.assertIsNone(received_timestamp(None))
+        self.assertIsNone(format_timestamp(None))
+        self.assertEqual(format_timestamp(1692621296), "2023-08-21 12:34")
+
+    def test_parse_source_single_part_matches_the_full_parser(self):
+        source = (b"From: a@example.com\r\nSubject: Test\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                  b"Content-Transfer-Encoding: quoted-printable\r\n\r\ncaf=C3=A9\r\nsecond line\r\n")
+
+        message = parse_source(source)
+
+        self.assertEqual(message.get_payload(decode=True), BytesParser().parsebytes(source).get_payload(decode=True))
+        self.assertEqual(extract_body(message), "caf\u00e9\r\nsecond line\r\n")
+
+    def test_parse_source_parses_multipart_in_full(self):
+        message = parse_source(bytes(self._multipart(plain="Plain body\n", html="<p>HTML body</p>")))
+
+        self.assertTrue(message.is_multipart())
+        self.assertEqual(extract_body(message), "Plain body\n")
+
+    def test_parse_source_accepts_any_charset(self):
+        message = parse_source(b"Subject: caf\xe9\r\nContent-Type: text/plain; charset=iso-8859-1\r\n\r\ncaf\xe9")
+
+        self.assertEqual(header_text(message.get("Subject")), "caf\ufffd")
+        self.assertEqual(extract_body(message), "caf\u00e9")
+        self.assertIsNone(header_text(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import json
+import os
+import stat
+import tempfile
+import unittest
+from src.metrics import Histogram, Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_counters_are_kept_per_label_set(self):
+        self.metrics.inc("gmail_api_calls_total", method="get")
+        self.metrics.inc("gmail_api_calls_total", 2, method="get")
+        self.metrics.inc("gmail_api_calls_total", method="list")
+
+        self.assertEqual(self.metrics.value("gmail_api_calls_total", method="get"), 3)
+        self.assertEqual(self.metrics.value("gmail_api_calls_total", method="list"), 1)
+        self.assertEqual(self.metrics.value("gmail_api_calls_total", method="modify"), 0)
+
+    def test_histogram_quantiles_use_bucket_bounds(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.05, 0.5, 2.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.75), 1.0)
+        self.assertEqual(histogram.quantile(1.0), 2.0)
+
+    def test_to_prometheus_renders_counters_and_histograms(self):
+        self.metrics.inc("gmail_rule_matches_total", 4, rule='say "hi"')
+        self.metrics.observe("gmail_stage_seconds", 0.02, stage="parse")
+
+        text = self.metrics.to_prometheus()
+
+        self.assertIn("# TYPE gmail_rule_matches_total counter", text)
+        self.assertIn('gmail_rule_matches_total{rule="say \\"hi\\""} 4', text)
+        self.assertIn("# TYPE gmail_stage_seconds histogram", text)
+        self.assertIn('gmail_stage_seconds_bucket{stage="parse",le="0.01"} 0', text)
+        self.assertIn('gmail_stage_seconds_bucket{stage="parse",le="0.025"} 1', text)
+        self.assertIn('gmail_stage_seconds_bucket{stage="parse",le="+Inf"} 1', text)
+        self.assertIn('gmail_stage_seconds_count{stage="parse"} 1', text)
+
+    def test_timer_records_when_the_block_raises(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.timer("gmail_stage_seconds", stage="db_write"):
+                raise ValueError()
+
+        summary = self.metrics.summary()
+
+        self.assertEqual(summary["histograms"]["gmail_stage_seconds"][0]["count"], 1)
+
+    def test_export_writes_prometheus_and_json_files(self):
+        self.metrics.inc("gmail_stage_items_total", 10, stage="get")
+
+        with tempfile.TemporaryDirectory() as directory:
+            prometheus_path, summary_path = self.metrics.export(os.path.join(directory, "metrics"), "sync")
+
+            with open(prometheus_path) as file:
+                self.assertIn('gmail_stage_items_total{stage="get"} 10', file.read())
+            with open(summary_path) as file:
+                summary = json.load(file)
+            self.assertEqual(summary["counters"]["gmail_stage_items_total"],
+                             [{"labels": {"stage": "get"}, "value": 10}])
+            self.assertEqual(sorted(os.listdir(os.path.dirname(summary_path))), ["sync.json", "sync.prom"])
+
+    def test_exported_files_are_readable_by_other_users(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for path in self.metrics.export(directory, "sync"):
+                self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o644)
+
+
+if __name__ == '__main__':
+    unittest.main()
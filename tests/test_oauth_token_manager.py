@@ -1,13 +1,21 @@
 import unittest
 from unittest.mock import patch, MagicMock, mock_open
+import json
 import os
-from src.oauth_token_manager import OAuthTokenManager
+import tempfile
+from datetime import datetime, timedelta
+from google.auth.exceptions import RefreshError, TransportError
+from src.oauth_token_manager import OAuthTokenManager, clear_credentials_cache
 
 
 class TestOAuthTokenManager(unittest.TestCase):
 
     def setUp(self):
-        self.manager = OAuthTokenManager()
+        clear_credentials_cache()
+        self.addCleanup(clear_credentials_cache)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.manager = OAuthTokenManager(os.path.join(directory.name, "token.json"))
         self.mock_credentials = MagicMock()
         self.mock_scope = ["https://www.googleapis.com/auth/some_scope"]
 
@@ -91,5 +99,86 @@ class TestOAuthTokenManager(unittest.TestCase):
         self.assertFalse(result)
 
 
+    def _use_token_file(self, expiry):
+        self._write_token("old-token", expiry)
+
+    def _write_token(self, token, expiry):
+        with open(self.manager.token_file, "w") as file:
+            json.dump({"token": token, "refresh_token": "refresh", "client_id": "id", "client_secret": "secret",
+                       "token_uri": "https://oauth2.googleapis.com/token", "scopes": self.manager.constants["SCOPE"],
+                       "expiry": expiry.strftime("%Y-%m-%dT%H:%M:%SZ")}, file)
+
+    def _stored_token(self):
+        with open(self.manager.token_file) as file:
+            return json.load(file)["token"]
+
+    def test_get_valid_credentials_shares_credentials_across_instances(self):
+        self._use_token_file(datetime.utcnow() + timedelta(hours=1))
+
+        creds = self.manager.get_valid_credentials()
+        other = OAuthTokenManager(self.manager.token_file)
+
+        self.assertIs(other.get_valid_credentials(), creds)
+
+    @patch('src.oauth_token_manager.Credentials.refresh', autospec=True)
+    def test_get_valid_credentials_refreshes_ahead_of_expiry(self, mock_refresh):
+        self._use_token_file(datetime.utcnow() + timedelta(minutes=2))
+
+        def refresh(creds, request):
+            creds.token = "new-token"
+            creds.expiry = datetime.utcnow() + timedelta(hours=1)
+
+        mock_refresh.side_effect = refresh
+
+        creds = self.manager.get_valid_credentials()
+
+        mock_refresh.assert_called_once()
+        self.assertEqual(creds.token, "new-token")
+        self.assertEqual(self._stored_token(), "new-token")
+        self.assertEqual([name for name in os.listdir(os.path.dirname(self.manager.token_file))
+                          if name.endswith(".tmp")], [])
+
+    @patch('src.oauth_token_manager.Credentials.refresh', autospec=True)
+    def test_refresh_reuses_token_refreshed_by_another_process(self, mock_refresh):
+        self._use_token_file(datetime.utcnow() + timedelta(minutes=2))
+        creds = self.manager.load_credentials()
+        self._write_token("other-process-token", datetime.utcnow() + timedelta(hours=1))
+
+        refreshed = self.manager.refresh_credentials(creds)
+
+        mock_refresh.assert_not_called()
+        self.assertEqual(refreshed.token, "other-process-token")
+        self.assertIs(self.manager.get_valid_credentials(), refreshed)
+
+    @patch('src.oauth_token_manager.OAuthTokenManager.generate_new_token')
+    @patch('src.oauth_token_manager.Credentials.refresh', autospec=True)
+    def test_revoked_refresh_token_raises_without_prompting_a_login(self, mock_refresh, mock_generate_new_token):
+        self._use_token_file(datetime.utcnow() - timedelta(minutes=1))
+        mock_refresh.side_effect = RefreshError("invalid_grant")
+
+        with self.assertRaises(RuntimeError):
+            self.manager.get_valid_credentials()
+
+        mock_generate_new_token.assert_not_called()
+        self.assertEqual(self._stored_token(), "old-token")
+
+    @patch('src.oauth_token_manager.Credentials.refresh', autospec=True)
+    def test_network_error_during_refresh_raises_runtime_error(self, mock_refresh):
+        self._use_token_file(datetime.utcnow() - timedelta(minutes=1))
+        mock_refresh.side_effect = TransportError("connection reset")
+
+        with self.assertRaises(RuntimeError):
+            self.manager.get_valid_credentials()
+
+    def test_save_token_persists_tokens_refreshed_by_the_transport(self):
+        self._use_token_file(datetime.utcnow() + timedelta(hours=1))
+        creds = self.manager.get_valid_credentials()
+
+        creds.token = "transport-token"
+        self.manager.get_valid_credentials()
+
+        self.assertEqual(self._stored_token(), "transport-token")
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,103 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock
+from src.action_planner import ActionPlanner
+from src.api_executor import ApiExecutor
+from src.email_store import EmailStore
+from src.outbox_drainer import OutboxDrainer
+
+
+class TestOutboxDrainer(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.db_path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        self.addCleanup(self._remove_database)
+        self.store = EmailStore(self.db_path)
+        self.store.create_schema()
+        self.store.upsert_emails([{"message_id": f"msg{index}", "labels": "INBOX"} for index in range(3)])
+
+        self.mock_service = MagicMock()
+        self.batch_modify = self.mock_service.users.return_value.messages.return_value.batchModify
+        self.executor = ApiExecutor(max_workers=2, backoff_base=0)
+        self.addCleanup(self.executor.shutdown)
+        self.drainer = OutboxDrainer(self.store, self.executor, workers=2, max_attempts=2)
+
+    def _remove_database(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
+
+    def _enqueue(self, *actions):
+        planner = ActionPlanner()
+        for message_id, add_label_ids, remove_label_ids in actions:
+            planner.add(message_id, add_label_ids, remove_label_ids, "rule_a")
+        return planner.enqueue(self.store)
+
+    def _make_due(self):
+        with self.store.transaction() as connection:
+            connection.execute("UPDATE action_outbox SET available_at = 0")
+
+    def test_drain_applies_actions_and_records_them(self):
+        self._enqueue(("msg0", ["STARRED"], ["INBOX"]), ("msg1", ["STARRED"], ["INBOX"]), ("msg2", [], []))
+
+        failed_ids = self.drainer.drain(self.mock_service)
+
+        self.assertEqual(failed_ids, [])
+        self.batch_modify.assert_called_once_with(
+            userId='me', body={"ids": ["msg0", "msg1"], "addLabelIds": ["STARRED"], "removeLabelIds": ["INBOX"]})
+        self.assertEqual(self.store.count_actions(), {"pending": 0, "done": 2, "dead": 0})
+        self.assertEqual(self.store.get_labels("msg0"), {"STARRED"})
+        self.assertEqual(self.store.get_applied_rules(["msg0", "msg2"]), {"msg0": {"rule_a"}, "msg2": {"rule_a"}})
+
+    def test_failed_actions_are_retried_later_then_dead_lettered(self):
+        self.batch_modify.return_value.execute.side_effect = Exception("Invalid label")
+        self._enqueue(("msg0", ["STARRED"], []))
+
+        self.assertEqual(self.drainer.drain(self.mock_service), ["msg0"])
+        self.assertEqual(self.drainer.drain(self.mock_service), [])
+        self.assertEqual(self.store.count_actions(), {"pending": 1, "done": 0, "dead": 0})
+
+        self.drainer.backoff_base = 0
+        self._make_due()
+        self.assertEqual(self.drainer.drain(self.mock_service), ["msg0"])
+        self.assertEqual(self.store.count_actions(), {"pending": 0, "done": 0, "dead": 1})
+        self.assertEqual(self.executor.metrics.value("gmail_outbox_actions_total", status="dead"), 1)
+
+    def test_enqueueing_the_same_plan_keeps_its_backoff(self):
+        self.batch_modify.return_value.execute.side_effect = Exception("Invalid label")
+        self._enqueue(("msg0", ["STARRED"], []))
+        self.drainer.drain(self.mock_service)
+
+        self._enqueue(("msg0", ["STARRED"], []))
+
+        self.assertEqual(self.drainer.drain(self.mock_service), [])
+        self._enqueue(("msg0", ["IMPORTANT"], []))
+        self.assertEqual(self.drainer.drain(self.mock_service), ["msg0"])
+
+    def test_expired_lease_is_claimed_again(self):
+        self._enqueue(("msg0", ["STARRED"], []))
+        self.assertEqual(len(self.store.claim_actions("crashed-worker", 10, lease_seconds=60)), 1)
+
+        self.assertEqual(self.store.claim_actions("other-worker", 10, lease_seconds=60), [])
+
+        with self.store.transaction() as connection:
+            connection.execute("UPDATE action_outbox SET lease_expires_at = ?", (time.time() - 1,))
+        self.drainer.drain(self.mock_service)
+
+        self.assertEqual(self.store.count_actions(), {"pending": 0, "done": 1, "dead": 0})
+
+    def test_enqueue_replaces_the_pending_action_of_a_message(self):
+        self._enqueue(("msg0", ["STARRED"], []))
+        self._enqueue(("msg0", ["IMPORTANT"], []))
+
+        actions = self.store.claim_actions("worker", 10, lease_seconds=60)
+
+        self.assertEqual([(action["message_id"], action["add_label_ids"]) for action in actions],
+                         [("msg0", ("IMPORTANT",))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+from src.rule_compiler import MASK_BITS, RuleCompiler
+
+FIELD_REFERENCES = {"From": "from_id", "Subject": "subject", "Date Received": "received_at", "Labels": "labels"}
+CONDITION_SYMBOLS = {"Contains": "LIKE", "Does not Contain": "NOT LIKE", "Equals": "==", "Does not equal": "!="}
+
+
+class TestRuleCompiler(unittest.TestCase):
+
+    def setUp(self):
+        self.compiler = RuleCompiler(FIELD_REFERENCES, CONDITION_SYMBOLS, use_fts=True)
+
+    def _rule(self, predicates, *criteria):
+        return {"predicates": predicates, "criteria": [
+            {"field_name": field_name, "predicate": predicate, "value": value}
+            for field_name, predicate, value in criteria]}
+
+    def test_compile_binds_every_value(self):
+        sql, parameters = self.compiler.compile("Any", self._rule(
+            "Any", ("From", "Equals", "o'brien@example.com"), ("Subject", "Contains", "it's")
+        )["criteria"])
+
+        self.assertNotIn("brien", sql)
+        self.assertEqual(parameters, ["o'brien@example.com", "%it's%"])
+
+    def test_indexed_rules_get_their_own_statement(self):
+        rules = {
+            "indexed": self._rule("All", ("Subject", "Contains", "invoice"), ("From", "Equals", "a@b.com")),
+            "recent": self._rule("All", ("Date Received", "Less than", "2")),
+            "scan_1": self._rule("Any", ("Subject", "Contains", "invoice"), ("From", "Equals", "a@b.com")),
+            "scan_2": self._rule("All", ("Subject", "Does not Contain", "promo")),
+        }
+
+        statements = self.compiler.compile_rule_set(rules)
+
+        self.assertEqual([names for _, _, names in statements], [["indexed"], ["recent"], ["scan_1", "scan_2"]])
+
+    def test_scan_packs_rules_into_masks_and_respects_parameter_limit(self):
+        rules = {f"rule_{number}": self._rule("All", ("From", "Equals", f"sender{number}@example.com"))
+                 for number in range(MASK_BITS + 3)}
+
+        (sql, parameters, names), = self.compiler.compile_rule_set(rules)
+        split = self.compiler.compile_rule_set(rules, max_parameters=MASK_BITS)
+
+        self.assertIn("mask1", sql)
+        self.assertEqual(len(parameters), len(names))
+        self.assertEqual([len(names) for _, _, names in split], [MASK_BITS, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+from src.rule_engine import RuleSet
+
+FIELD_REFERENCES = {
+    "From": "from_id",
+    "Subject": "subject",
+    "Message": "content",
+    "Date Received": "received_at",
+    "To": "to_id",
+    "Labels": "labels",
+}
+
+
+class TestRuleSet(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = {
+            "rule_1": {
+                "predicates": "All",
+                "criteria": [
+                    {"field_name": "Date Received", "predicate": "Less than", "value": "30"},
+                    {"field_name": "Subject", "predicate": "Contains", "value": "invoice"}
+                ],
+                "action": [{"addLabelIds": ["STARRED"], "removeLabelIds": []}]
+            },
+            "rule_2": {
+                "predicates": "Any",
+                "criteria": [
+                    {"field_name": "From", "predicate": "Contains", "value": "glassdoor"},
+                    {"field_name": "From", "predicate": "Equals", "value": "news@udemymail.com"}
+                ],
+                "action": [{"addLabelIds": ["SPAM"], "removeLabelIds": ["IMPORTANT"]}]
+            }
+        }
+        self.rule_set = RuleSet(self.rules, FIELD_REFERENCES)
+        self.yesterday = int((datetime.now() - timedelta(days=1)).timestamp())
+
+    def _matching(self, **email):
+        return [rule.name for rule in self.rule_set.match(dict({"message_id": "msg1"}, **email))]
+
+    def test_match_all_requires_every_criterion(self):
+        self.assertEqual(self._matching(received_at=self.yesterday, subject="Your INVOICE"), ["rule_1"])
+        self.assertEqual(self._matching(received_at=978343200, subject="Your invoice"), [])
+        self.assertEqual(self._matching(received_at=self.yesterday, subject=None), [])
+
+    def test_date_received_covers_today(self):
+        self.assertEqual(self._matching(received_at=int(datetime.now().timestamp()), subject="invoice"), ["rule_1"])
+
+    def test_match_any_requires_one_criterion(self):
+        self.assertEqual(self._matching(from_id="Jobs <jobs@Glassdoor.com>"), ["rule_2"])
+        self.assertEqual(self._matching(from_id="news@udemymail.com"), ["rule_2"])
+        self.assertEqual(self._matching(from_id="NEWS@udemymail.com"), [])
+
+    def test_negative_predicates_skip_missing_fields(self):
+        rule_set = RuleSet({"rule": {"predicates": "All", "criteria": [
+            {"field_name": "Subject", "predicate": "Does not Contain", "value": "promo"},
+            {"field_name": "From", "predicate": "Does not equal", "value": "me@example.com"}
+        ]}}, FIELD_REFERENCES)
+
+        self.assertTrue(rule_set.match({"subject": "Hello", "from_id": "you@example.com"}))
+        self.assertFalse(rule_set.match({"subject": "Big PROMO", "from_id": "you@example.com"}))
+        self.assertFalse(rule_set.match({"subject": None, "from_id": "you@example.com"}))
+
+    def test_plan_actions_adds_actions_of_matching_rules(self):
+        planner = MagicMock()
+
+        self.rule_set.plan_actions({"message_id": "msg1", "from_id": "jobs@glassdoor.com"}, planner)
+
+        planner.add.assert_called_once_with("msg1", ["SPAM"], ["IMPORTANT"], self.rule_set.rules[1].hash)
+
+    def test_rule_hash_changes_with_the_rule(self):
+        changed = dict(self.rules, rule_2=dict(self.rules["rule_2"], action=[{"addLabelIds": ["STARRED"]}]))
+        old_hashes = [rule.hash for rule in self.rule_set.rules]
+        new_hashes = [rule.hash for rule in RuleSet(changed, FIELD_REFERENCES).rules]
+
+        self.assertEqual(old_hashes[0], new_hashes[0])
+        self.assertNotEqual(old_hashes[1], new_hashes[1])
+
+    def test_may_need_body_only_while_headers_leave_the_rule_open(self):
+        rule_set = RuleSet({
+            "all_rule": {"predicates": "All", "criteria": [
+                {"field_name": "From", "predicate": "Contains", "value": "bank"},
+                {"field_name": "Message", "predicate": "Contains", "value": "OTP"}]},
+            "any_rule": {"predicates": "Any", "criteria": [
+                {"field_name": "Subject", "predicate": "Contains", "value": "invoice"},
+                {"field_name": "Message", "predicate": "Contains", "value": "invoice"}]},
+        }, FIELD_REFERENCES)
+
+        self.assertTrue(rule_set.may_need_body({"from_id": "alerts@bank.com", "subject": "Invoice"}))
+        self.assertTrue(rule_set.may_need_body({"from_id": "friend@example.com", "subject": "Hello"}))
+        self.assertFalse(rule_set.may_need_body({"from_id": "friend@example.com", "subject": "Invoice"}))
+        self.assertFalse(self.rule_set.may_need_body({"from_id": "friend@example.com", "subject": "Hello"}))
+
+    def test_label_predicates_check_stored_labels(self):
+        rule_set = RuleSet({
+            "unread": {"predicates": "All", "criteria": [
+                {"field_name": "Labels", "predicate": "Has label", "value": "UNREAD"}]},
+            "not_starred": {"predicates": "All", "criteria": [
+                {"field_name": "Labels", "predicate": "Lacks label", "value": "STARRED"}]},
+        }, FIELD_REFERENCES)
+
+        self.assertEqual([rule.name for rule in rule_set.match({"labels": "INBOX,UNREAD"})],
+                         ["unread", "not_starred"])
+        self.assertEqual([rule.name for rule in rule_set.match({"labels": "STARRED"})], [])
+        self.assertEqual(rule_set.match({"labels": None}), [])
+
+    def test_label_predicates_are_only_valid_for_labels(self):
+        for field_name, predicate in (("Subject", "Has label"), ("Labels", "Contains")):
+            with self.assertRaises(TypeError):
+                RuleSet({"rule": {"predicates": "All", "criteria": [
+                    {"field_name": field_name, "predicate": predicate, "value": "UNREAD"}]}}, FIELD_REFERENCES)
+
+    def test_invalid_rules_are_rejected(self):
+        self.rules["rule_1"]["criteria"][0]["value"] = "thirty"
+
+        with self.assertRaises(TypeError):
+            RuleSet(self.rules, FIELD_REFERENCES)
+
+
+if __name__ == '__main__':
+    unittest.main()
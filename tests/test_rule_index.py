@@ -0,0 +1,98 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+from src.rule_engine import CompiledRule
+from src.rule_index import AhoCorasick, RuleIndex
+
+FIELD_REFERENCES = {"From": "from_id", "Subject": "subject", "Date Received": "received_at", "Labels": "labels"}
+
+
+class TestAhoCorasick(unittest.TestCase):
+
+    def test_search_finds_overlapping_patterns(self):
+        automaton = AhoCorasick(["he", "she", "his", "hers"])
+
+        self.assertEqual(automaton.search("ushers"), {0, 1, 3})
+        self.assertEqual(automaton.search("this"), {2})
+        self.assertEqual(automaton.search("xyz"), set())
+
+
+class TestRuleIndex(unittest.TestCase):
+
+    def _rule(self, name, predicates, *criteria, action=None):
+        return CompiledRule(name, {
+            "predicates": predicates,
+            "criteria": [{"field_name": field, "predicate": predicate, "value": value}
+                         for field, predicate, value in criteria],
+            "action": action or []
+        }, FIELD_REFERENCES)
+
+    def test_match_uses_index_for_contains_and_equals(self):
+        rules = [
+            self._rule("glassdoor", "Any", ("From", "Contains", "glassdoor")),
+            self._rule("exact", "All", ("From", "Equals", "ceo@example.com"), ("Subject", "Contains", "urgent")),
+            self._rule("other", "Any", ("Subject", "Contains", "lottery")),
+        ]
+        index = RuleIndex(rules)
+
+        self.assertEqual(index.unanchored, [])
+        self.assertEqual([rule.name for rule in index.match({"from_id": "jobs@GLASSDOOR.com", "subject": "Hi"})],
+                         ["glassdoor"])
+        self.assertEqual([rule.name for rule in index.match({"from_id": "ceo@example.com", "subject": "URGENT"})],
+                         ["exact"])
+        self.assertEqual(index.match({"from_id": "ceo@example.com", "subject": "Hi"}), [])
+
+    def test_match_uses_index_for_labels(self):
+        rules = [
+            self._rule("unread", "All", ("Labels", "Has label", "UNREAD")),
+            self._rule("unread_news", "All", ("Labels", "Has label", "UNREAD"), ("From", "Contains", "news")),
+        ]
+        index = RuleIndex(rules)
+
+        self.assertEqual(index.unanchored, [])
+        self.assertEqual([rule.name for rule in index.match({"labels": "INBOX,UNREAD", "from_id": "news@x.com"})],
+                         ["unread", "unread_news"])
+        self.assertEqual(index.match({"labels": "INBOX", "from_id": "news@x.com"}), [])
+
+    def test_rules_that_match_without_hits_are_always_evaluated(self):
+        rules = [
+            self._rule("negative", "All", ("Subject", "Does not Contain", "promo")),
+            self._rule("any_date", "Any", ("Subject", "Contains", "x"), ("Date Received", "Less than", "5")),
+        ]
+        index = RuleIndex(rules)
+        now = int(datetime.now().timestamp())
+
+        self.assertEqual(index.unanchored, [0, 1])
+        self.assertEqual([rule.name for rule in index.match({"subject": "Hello", "received_at": now})],
+                         ["negative", "any_date"])
+        self.assertEqual(index.match({"subject": "Promo", "received_at": 978343200}), [])
+
+    def test_match_agrees_with_rule_evaluation(self):
+        generator = random.Random(7)
+        words = ["alpha", "beta", "gamma", "delta", "al", "ta", "", "mm"]
+        predicates = ["Contains", "Does not Contain", "Equals", "Does not equal", "Less than"]
+        recent = int((datetime.now() - timedelta(days=2)).timestamp())
+
+        rules = []
+        for number in range(60):
+            criteria = []
+            for _ in range(generator.randint(1, 3)):
+                if generator.random() < 0.1:
+                    criteria.append(("Date Received", generator.choice(["Less than", "Greater than"]), "10"))
+                else:
+                    criteria.append((generator.choice(["From", "Subject"]), generator.choice(predicates),
+                                     generator.choice(words)))
+            rules.append(self._rule(f"rule_{number}", generator.choice(["All", "Any"]), *criteria))
+        index = RuleIndex(rules)
+
+        for _ in range(300):
+            email = {
+                "from_id": generator.choice([None, " ".join(generator.sample(words, 2))]),
+                "subject": generator.choice([None, "", " ".join(generator.sample(words, 3)).upper()]),
+                "received_at": generator.choice([None, recent, 978343200]),
+            }
+            self.assertEqual(index.match(email), [rule for rule in rules if rule.matches(email)], email)
+
+
+if __name__ == '__main__':
+    unittest.main()